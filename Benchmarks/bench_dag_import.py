@@ -0,0 +1,77 @@
+"""
+Время разбора dags/dag.py: так файл исполняет планировщик Airflow при
+каждом обходе каталога DAG.
+
+Запуск из корня проекта (в окружении Airflow):
+    python -m Benchmarks.bench_dag_import --repeat 10
+
+Каждый замер идёт в новом процессе интерпретатора, поэтому кэш импортов
+не переносится между замерами. Печатаются медиана времени исполнения
+файла, тяжёлые модули, которые оказались импортированы (их быть не должно:
+они импортируются внутри задач), и самые долгие импорты по -X importtime.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Модули, которые не должны загружаться при разборе DAG
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'psycopg', 'clickhouse_connect', 'openpyxl')
+
+probe = """
+import json, runpy, sys, time
+start = time.perf_counter()
+runpy.run_path({path!r})
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def run_probe(path, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else [])
+    command += ['-c', probe.format(path=path, heavy=HEAVY_MODULES)]
+    result = subprocess.run(command, capture_output=True, text=True, check=True, cwd=os.getcwd())
+    return result.stdout.strip().splitlines()[-1], result.stderr
+
+
+def slowest_imports(stderr, top):
+    # Строки -X importtime: "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Только модули верхнего уровня вложенности: их время включает вложенные импорты
+        if not name.startswith('  '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dag', default=os.path.join('dags', 'dag.py'))
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15, help="сколько самых долгих импортов показать")
+    args = parser.parse_args()
+
+    timings = []
+    heavy = set()
+    for _ in range(args.repeat):
+        line, _ = run_probe(args.dag)
+        result = json.loads(line)
+        timings.append(result['seconds'])
+        heavy.update(result['heavy'])
+    print(f"Разбор {args.dag}: медиана {statistics.median(timings) * 1000:.0f} мс, "
+          f"мин {min(timings) * 1000:.0f} мс, макс {max(timings) * 1000:.0f} мс ({args.repeat} замеров)")
+    print(f"Тяжёлые модули при разборе: {', '.join(sorted(heavy)) if heavy else 'нет'}")
+
+    _, stderr = run_probe(args.dag, importtime=True)
+    print("Самые долгие импорты (с вложенными):")
+    for cumulative, name in slowest_imports(stderr, args.top):
+        print(f"{cumulative / 1000:>10.1f} мс  {name}")
+
+
+if __name__ == '__main__':
+    main()
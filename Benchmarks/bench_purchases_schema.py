@@ -0,0 +1,92 @@
+"""
+Сравнение схем purchases (basic и optimized): объём на диске и сканы
+get_sum_all_time / get_sum_all_time_by_gender.
+
+Запуск из корня проекта:
+    python -m Benchmarks.bench_purchases_schema --rows 10000000 --repeat 5
+
+Данные генерируются на стороне ClickHouse в таблицах bench_purchases_basic
+и bench_purchases_optimized, которые удаляются после замера.
+"""
+import argparse
+import statistics
+import time
+import SQL_Requests.clickhouse_query as ch_query
+from DBMS_Classes.ClickHouseClient import ClickHouseClient
+
+TABLES = {
+    'basic': 'bench_purchases_basic',
+    'optimized': 'bench_purchases_optimized',
+}
+
+generate_purchases = """
+INSERT INTO {table} (clientcode, gender, price, amount, timestamp)
+SELECT
+    rand64(1) % 50000,
+    if(rand(2) % 2 = 0, 'M', 'F'),
+    round(10 + (rand(3) % 99000) / 100, 2),
+    1 + rand(4) % 10,
+    toDateTime('2022-01-01 00:00:00') + rand(5) % (3 * 365 * 86400)
+FROM numbers({rows})
+"""
+
+storage_query = """
+SELECT sum(data_compressed_bytes), sum(data_uncompressed_bytes), sum(bytes_on_disk)
+FROM system.parts
+WHERE database = currentDatabase() AND table = %(table)s AND active
+"""
+
+QUERIES = {
+    'get_sum_all_time': (ch_query.get_sum_all_time, {}),
+    'get_sum_all_time_by_gender': (ch_query.get_sum_all_time_by_gender, {'gender': 'F'}),
+}
+
+
+def create(client, schema, table, rows):
+    client.command(f"DROP TABLE IF EXISTS {table}")
+    if schema == 'basic':
+        client.command(ch_query.create_purchases.replace('purchases', table, 1))
+    else:
+        client.command(ch_query.create_purchases_optimized.format(table=table))
+    client.command(generate_purchases.format(table=table, rows=rows),
+                   settings={'max_partitions_per_insert_block': 0})
+    client.command(f"OPTIMIZE TABLE {table} FINAL")
+
+
+def measure(client, table, sql, parameters, repeat):
+    sql = sql.replace('purchases', table)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = client.query(sql, parameters=parameters, settings={'use_query_cache': 0})
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result.summary.get('read_rows'), result.summary.get('read_bytes')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help="не удалять таблицы после замера")
+    args = parser.parse_args()
+
+    with ClickHouseClient() as client:
+        try:
+            for schema, table in TABLES.items():
+                create(client, schema, table, args.rows)
+                compressed, uncompressed, on_disk = client.query(
+                    storage_query, parameters={'table': table}).result_rows[0]
+                print(f"{schema:>10}: на диске {on_disk / 2 ** 20:.1f} МиБ, "
+                      f"сжатие {uncompressed / max(compressed, 1):.2f}x")
+                for name, (sql, parameters) in QUERIES.items():
+                    median, read_rows, read_bytes = measure(client, table, sql, parameters, args.repeat)
+                    print(f"{'':>12}{name}: {median * 1000:.1f} мс, "
+                          f"прочитано {read_rows} строк, {int(read_bytes or 0) / 2 ** 20:.1f} МиБ")
+        finally:
+            if not args.keep:
+                for table in TABLES.values():
+                    client.command(f"DROP TABLE IF EXISTS {table}")
+
+
+if __name__ == '__main__':
+    main()
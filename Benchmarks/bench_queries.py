@@ -0,0 +1,63 @@
+"""
+Задержка запросов сервиса PurchasesQueries: первый (холодный) и
+повторный (из кэша) вызов, скан purchases и чтение дневных агрегатов.
+
+Запуск из корня проекта (после загрузки данных в ClickHouse):
+    python -m Benchmarks.bench_queries --repeat 20
+
+Замеры идут по уже загруженным purchases, date_purchases и
+date_purchases_by_gender; таблицы не изменяются. Холодный вызов
+повторяется repeat раз со сбросом кэша, печатаются медианы.
+"""
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta
+from DBMS_Classes.ClickHouseClient import ClickHouseClient
+from ETL_Stages.query_service import PurchasesQueries
+
+
+def data_range(client):
+    low, high = client.query("SELECT min(timestamp), max(timestamp) FROM purchases").result_rows[0]
+    start = datetime.combine(low.date(), datetime.min.time())
+    return start, datetime.combine(high.date(), datetime.min.time()) + timedelta(days=1)
+
+
+def measure(service, call, repeat):
+    cold, warm = [], []
+    for _ in range(repeat):
+        service.invalidate()
+        start = time.perf_counter()
+        call()
+        cold.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        call()
+        warm.append(time.perf_counter() - start)
+    return statistics.median(cold), statistics.median(warm)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with ClickHouseClient() as client:
+        start, end = data_range(client)
+        middle = start + (end - start) / 2
+        middle = datetime.combine(middle.date(), datetime.min.time())
+        queries = {
+            'revenue за всё время': lambda service: service.revenue(),
+            'totals за половину периода': lambda service: service.totals(start, middle),
+            'totals по полу F': lambda service: service.totals(start, end, gender='F'),
+            'daily за половину периода': lambda service: service.daily(middle, end),
+        }
+        for name, query in queries.items():
+            print(name)
+            for source, use_rollups in (('purchases', False), ('агрегаты', True)):
+                service = PurchasesQueries(client, use_rollups=use_rollups)
+                cold, warm = measure(service, lambda: query(service), args.repeat)
+                print(f"{source:>12}: первый вызов {cold * 1000:.1f} мс, из кэша {warm * 1000:.2f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Замер этапов ETL по отдельности: чтение, подготовка, загрузка temp_data,
+нормализация, перенос в ClickHouse и агрегаты.
+
+Запуск из корня проекта:
+    python -m Benchmarks.generate_dataset data/sales_1m.parquet --rows 1e6
+    python -m Benchmarks.bench_stages data/sales_1m.parquet --output results/stages.json
+    python -m Benchmarks.bench_stages data/sales_1m.parquet --compare results/stages.json
+
+Для каждого этапа записываются метрики ETL_Stages.metrics: настенное и
+процессорное время, строки, строк в секунду, время запросов нормализации и
+пиковый RSS процесса после этапа (с --tracemalloc - ещё пик памяти Python
+внутри этапа). Результаты пишутся в JSON вместе с хешем коммита, чтобы
+сравнивать прогоны разных версий (--compare).
+
+Запускать только на локальных экземплярах: транзакция PostgreSQL
+откатывается в конце, но таблицы ClickHouse пересоздаются.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime
+import config
+import SQL_Requests.postgresql_query as query
+from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase
+from DBMS_Classes.ClickHouseClient import ClickHouseClient
+from ETL_Stages.prepare import prepare_frame
+from ETL_Stages.readers import iter_chunks, DEFAULT_CHUNK_SIZE
+from ETL_Stages.staging import load_temp_data, begin_staging, finish_staging, STAGING_MODES
+from ETL_Stages.transfer import transfer_purchases, DEFAULT_BATCH_SIZE
+from ETL_Stages.clickhouse_schema import create_tables, drop_tables, fill_aggregates, ROLLUP_MODES
+from ETL_Stages.metrics import RunMetrics
+from ETL_Stages.scheduler import levels, NORMALIZATION_STEPS
+
+STAGES = ('read', 'prepare', 'staging', 'normalization', 'transfer', 'aggregation')
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(path, chunk_size, batch_size, staging_mode, rollup_mode, metrics):
+    with PostgreSQLDatabase() as cur, ClickHouseClient() as client:
+        begin_staging(cur, staging_mode)
+        cur.execute(query.create_query2)
+
+        # Этапы чтения, подготовки и загрузки идут потоком, как в main.py;
+        # время каждого складывается по всем порциям
+        chunks = iter_chunks(path, chunk_size)
+        while True:
+            with metrics.stage('read') as stage:
+                df = next(chunks, None)
+                if df is not None:
+                    stage.add(rows_out=len(df))
+            if df is None:
+                break
+            with metrics.stage('prepare') as stage:
+                prepared = prepare_frame(df, (), {})
+                stage.add(rows_in=len(df), rows_out=len(prepared), rejected=prepared.rejected)
+            with metrics.stage('staging') as stage:
+                stage.add(rows_in=len(prepared), rows_out=load_temp_data(cur, prepared))
+        with metrics.stage('staging') as stage, stage.statement('finish_staging'):
+            finish_staging(cur, staging_mode)
+
+        with metrics.stage('normalization') as stage:
+            for level in levels():
+                for name in level:
+                    stage.execute(cur, name, NORMALIZATION_STEPS[name][0])
+            stage.add(rows_out=stage.statements['sale_items']['rows'])
+
+        drop_tables(client)
+        create_tables(client, rollup_mode)
+        with metrics.stage('transfer') as stage:
+            stats = transfer_purchases(cur.connection, client, batch_size)
+            stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+
+        with metrics.stage('aggregation') as stage:
+            fill_aggregates(client, rollup_mode)
+            stage.add(rows_in=stats['inserted'], rows_out=stats['inserted'])
+
+        # temp_data и нормализованные таблицы возвращаются к состоянию до замера
+        cur.connection.rollback()
+
+
+def compare(report, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {stage['stage']: stage for stage in json.load(f)['stages']}
+    for stage in report:
+        previous = baseline.get(stage['stage'])
+        if not previous or not previous['wall_seconds'] or not stage['wall_seconds']:
+            continue
+        print(f"{stage['stage']:>14}: {previous['wall_seconds']:.2f} с -> {stage['wall_seconds']:.2f} с "
+              f"({stage['wall_seconds'] / previous['wall_seconds']:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="исходный файл (.xlsx, .csv, .parquet)")
+    parser.add_argument('--chunk-size', type=int, default=getattr(config, 'chunk_size', DEFAULT_CHUNK_SIZE))
+    parser.add_argument('--batch-size', type=int,
+                        default=getattr(config, 'transfer_batch_size', DEFAULT_BATCH_SIZE))
+    parser.add_argument('--staging-mode', default='logged', choices=STAGING_MODES)
+    parser.add_argument('--rollup-mode', default='scan', choices=ROLLUP_MODES)
+    parser.add_argument('--tracemalloc', action='store_true', help="пик памяти Python по этапам (замедляет)")
+    parser.add_argument('--output', default='bench_stages.json')
+    parser.add_argument('--compare', help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args()
+
+    metrics = RunMetrics(trace_memory_stages=STAGES if args.tracemalloc else ())
+    run(args.path, args.chunk_size, args.batch_size, args.staging_mode, args.rollup_mode, metrics)
+    report = metrics.report()['stages']
+
+    for stage in report:
+        throughput = f"{stage['rows_per_second']:,.0f} строк/с" if stage['rows_per_second'] else '-'
+        print(f"{stage['stage']:>14}: {stage['wall_seconds']:.2f} с (CPU {stage['cpu_seconds']:.2f} с), "
+              f"{stage['rows_out']} строк, {throughput}, RSS {stage['peak_rss_mb']:.0f} МиБ")
+    if args.compare:
+        compare(report, args.compare)
+
+    result = {
+        'commit': _commit(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'dataset': {'path': args.path, 'bytes': os.path.getsize(args.path)},
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('path', 'output', 'compare')},
+        'python': platform.python_version(),
+        'stages': report,
+    }
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
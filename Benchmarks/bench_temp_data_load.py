@@ -0,0 +1,46 @@
+"""
+Сравнение загрузки temp_data: бинарный COPY против executemany(insert_query1).
+
+Запуск из корня проекта:
+    python -m Benchmarks.bench_temp_data_load --rows 100000 --chunk-size 50000
+
+Данные генерируются, загрузка выполняется в транзакции, которая
+откатывается после каждого замера, поэтому содержимое temp_data не меняется.
+"""
+import argparse
+import time
+import SQL_Requests.postgresql_query as query
+from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase
+from ETL_Stages.prepare import prepare_frame
+from ETL_Stages.staging import load_temp_data, LOAD_MODES
+from Benchmarks.generate_dataset import generate_frame
+
+
+def run(mode, chunks):
+    with PostgreSQLDatabase() as cur:
+        cur.execute(query.create_query)
+        start = time.perf_counter()
+        loaded = sum(load_temp_data(cur, prepared, mode) for prepared in chunks)
+        elapsed = time.perf_counter() - start
+        cur.connection.rollback()
+    return loaded, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--chunk-size', type=int, default=50_000)
+    parser.add_argument('--modes', nargs='+', default=list(LOAD_MODES), choices=LOAD_MODES)
+    args = parser.parse_args()
+
+    df = generate_frame(args.rows)
+    chunks = [prepare_frame(df.iloc[i:i + args.chunk_size])
+              for i in range(0, len(df), args.chunk_size)]
+
+    for mode in args.modes:
+        loaded, elapsed = run(mode, chunks)
+        print(f"{mode:>12}: {loaded} строк за {elapsed:.2f} с ({loaded / elapsed:,.0f} строк/с)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Сравнение стратегий переноса temp_data -> purchases: через процесс Python
+(transfer_purchases) и напрямую из ClickHouse табличной функцией postgresql().
+
+Запуск из корня проекта:
+    python -m Benchmarks.bench_transfer --rows 1000000 --repeat 3
+
+Данные генерируются и загружаются в таблицу PostgreSQL bench_temp_data
+(структура temp_data), перенос идёт в таблицу ClickHouse bench_purchases.
+Обе таблицы удаляются после замера. ClickHouse читает PostgreSQL через
+именованную коллекцию config.clickhouse_postgresql_collection.
+"""
+import argparse
+import statistics
+import time
+import SQL_Requests.postgresql_query as query
+import SQL_Requests.clickhouse_query as ch_query
+from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase, table_function_settings
+from DBMS_Classes.ClickHouseClient import ClickHouseClient
+from ETL_Stages.prepare import prepare_frame
+from ETL_Stages.staging import coerce_columns
+from ETL_Stages.transfer import transfer_purchases, iter_batches, DEFAULT_BATCH_SIZE
+from ETL_Stages.direct_transfer import transfer_direct
+from Benchmarks.generate_dataset import iter_frames
+
+# Стратегии без контрольной точки: checkpoint переносит только temp_data
+STRATEGIES = ('python', 'clickhouse')
+
+SOURCE = 'bench_temp_data'
+TARGET = 'bench_purchases'
+
+checksum_query = f"""
+SELECT count(), round(sum(price * amount), 2), sum(clientcode), sum(toUInt32(timestamp))
+FROM {TARGET}
+"""
+
+
+def load_source(cur, rows, chunk_rows):
+    cur.execute(f"DROP TABLE IF EXISTS {SOURCE}")
+    cur.execute(f"CREATE TABLE {SOURCE} (LIKE temp_data)")
+    copy_sql = query.copy_temp_data.replace('temp_data', SOURCE, 1)
+    for frame in iter_frames(rows, chunk_rows):
+        prepared = prepare_frame(frame)
+        with cur.copy(copy_sql) as copy:
+            copy.set_types(query.temp_data_types)
+            for row in zip(*coerce_columns(prepared)):
+                copy.write_row(row)
+    # ClickHouse читает источник своим соединением
+    cur.connection.commit()
+
+
+def run(strategy, conn, client, batch_size):
+    client.command(f"TRUNCATE TABLE {TARGET}")
+    start = time.perf_counter()
+    if strategy == 'python':
+        batches = iter_batches(conn, batch_size, query.select_purchases_source.replace('temp_data', SOURCE))
+        stats = transfer_purchases(conn, client, batch_size, batches=batches, table=TARGET)
+        conn.rollback()
+    else:
+        stats = transfer_direct(conn, client, table_function_settings(), SOURCE, TARGET)
+    return time.perf_counter() - start, stats['inserted'], client.query(checksum_query).result_rows[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=lambda value: int(float(value)), default=1_000_000)
+    parser.add_argument('--chunk-rows', type=int, default=100_000)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--strategies', nargs='+', default=list(STRATEGIES), choices=STRATEGIES)
+    parser.add_argument('--keep', action='store_true', help="не удалять таблицы после замера")
+    args = parser.parse_args()
+
+    with PostgreSQLDatabase() as cur, ClickHouseClient() as client:
+        try:
+            load_source(cur, args.rows, args.chunk_rows)
+            client.command(f"DROP TABLE IF EXISTS {TARGET}")
+            client.command(ch_query.create_purchases.replace('purchases', TARGET, 1))
+
+            checksums = {}
+            for strategy in args.strategies:
+                timings = []
+                for _ in range(args.repeat):
+                    elapsed, inserted, checksums[strategy] = run(strategy, cur.connection, client, args.batch_size)
+                    timings.append(elapsed)
+                median = statistics.median(timings)
+                print(f"{strategy:>10}: {median:.2f} с, {inserted} строк ({inserted / median:,.0f} строк/с)")
+            if len(set(checksums.values())) > 1:
+                print(f"Результаты стратегий различаются: {checksums}")
+        finally:
+            if not args.keep:
+                client.command(f"DROP TABLE IF EXISTS {TARGET}")
+                cur.connection.rollback()
+                cur.execute(f"DROP TABLE IF EXISTS {SOURCE}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Генератор синтетических данных продаж в формате исходного файла (26 колонок temp_data).
+
+Запуск из корня проекта:
+    python -m Benchmarks.generate_dataset data/sales_1m.parquet --rows 1e6
+    python -m Benchmarks.generate_dataset data/sales.xlsx --rows 1e5 --clients 50000 --items 20000
+
+Формат определяется по расширению: .xlsx, .csv или .parquet. Данные
+генерируются и записываются порциями, поэтому память не зависит от --rows.
+При одинаковых параметрах и --seed файл получается одинаковым.
+"""
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+DEFAULT_BRANCHES = 50
+DEFAULT_CLIENTS = 10_000
+DEFAULT_ITEMS = 5_000
+DEFAULT_CHUNK_ROWS = 500_000
+
+# Строк в чеке (FICHENO) в среднем
+LINES_PER_SALE = 5
+
+# Ограничение листа Excel без строки заголовка
+EXCEL_MAX_ROWS = 1_048_575
+
+
+def _labels(prefix, values):
+    return prefix + pd.Series(values).astype(str)
+
+
+def generate_frame(rows, seed=0, branches=DEFAULT_BRANCHES, clients=DEFAULT_CLIENTS,
+                   items=DEFAULT_ITEMS, first_id=1, start='2023-01-01', days=365):
+    """
+    Порция из rows строк с ID от first_id.
+
+    branches, clients, items - число различных филиалов, клиентов и товаров;
+    производные справочники (бренды, категории, города, продавцы) зависят от них.
+    """
+    rng = np.random.default_rng(seed)
+    client = rng.integers(1, clients + 1, rows)
+    branch = rng.integers(1, branches + 1, rows)
+    item = rng.integers(1, items + 1, rows)
+    ids = np.arange(first_id, first_id + rows)
+    dates = pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days * 24, rows), 'h')
+    amount = rng.integers(1, 10, rows).astype(float)
+    price = rng.uniform(10, 1000, rows).round(2)
+    brand = item % 300
+    category = item % 10
+    return pd.DataFrame({
+        'ID': ids,
+        'ITEMCODE': _labels('IT', item),
+        'ITEMNAME': _labels('Item ', item),
+        'FICHENO': _labels('F', ids // LINES_PER_SALE),
+        'DATE_': dates,
+        'AMOUNT': amount,
+        'PRICE': price,
+        'LINENETTOTAL': amount * price,
+        'LINENET': amount * price,
+        'BRANCHNR': branch,
+        'BRANCH': _labels('Branch ', branch),
+        'SALESMAN': _labels('Salesman ', branch) + '-' + pd.Series(client % 10).astype(str),
+        'CITY': _labels('City ', branch % 20),
+        'REGION': _labels('Region ', branch % 5),
+        'LATITUDE': rng.uniform(36, 42, rows),
+        'LONGITUDE': rng.uniform(26, 45, rows),
+        'CLIENTCODE': pd.Series(client).astype(str),
+        'CLIENTNAME': _labels('Client ', client),
+        'BRANDCODE': _labels('BR', brand),
+        'BRAND': _labels('Brand ', brand),
+        'CATEGORY_NAME1': _labels('Cat ', category),
+        'CATEGORY_NAME2': _labels('Cat ', category) + '-' + pd.Series(item % 7).astype(str),
+        'CATEGORY_NAME3': (_labels('Cat ', category) + '-' + pd.Series(item % 7).astype(str)
+                           + '-' + pd.Series(item % 3).astype(str)),
+        'STARTDATE': dates,
+        'ENDDATE': dates + pd.Timedelta(days=30),
+        'GENDER': rng.choice(['M', 'F'], rows),
+    })
+
+
+def iter_frames(rows, chunk_rows=DEFAULT_CHUNK_ROWS, seed=0, **cardinality):
+    """Порции generate_frame общим объёмом rows строк; у каждой порции своё зерно."""
+    for index, offset in enumerate(range(0, rows, chunk_rows)):
+        yield generate_frame(min(chunk_rows, rows - offset), seed=(seed, index),
+                             first_id=offset + 1, **cardinality)
+
+
+def _write_csv(path, frames):
+    for index, frame in enumerate(frames):
+        frame.to_csv(path, mode='w' if index == 0 else 'a', header=index == 0, index=False)
+
+
+def _write_parquet(path, frames):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for frame in frames:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _write_excel(path, frames):
+    from openpyxl import Workbook
+
+    # write_only пишет строки потоком, не держа лист в памяти
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    header = False
+    for frame in frames:
+        if not header:
+            sheet.append(list(frame.columns))
+            header = True
+        for row in frame.astype(object).itertuples(index=False, name=None):
+            sheet.append([value.to_pydatetime() if isinstance(value, pd.Timestamp) else value
+                          for value in row])
+    workbook.save(path)
+
+
+_WRITERS = {
+    '.xlsx': _write_excel,
+    '.csv': _write_csv,
+    '.parquet': _write_parquet,
+}
+
+
+def write_dataset(path, rows, chunk_rows=DEFAULT_CHUNK_ROWS, seed=0, **cardinality):
+    """
+    Запись набора из rows строк в path.
+
+    Исключения:
+        ValueError: Если формат не поддерживается или строк больше, чем помещается в лист Excel
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    writer = _WRITERS.get(suffix)
+    if writer is None:
+        raise ValueError(f"Неподдерживаемый формат файла: {path}")
+    if suffix == '.xlsx' and rows > EXCEL_MAX_ROWS:
+        raise ValueError(f"В лист Excel помещается не больше {EXCEL_MAX_ROWS} строк")
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    writer(path, iter_frames(rows, chunk_rows, seed, **cardinality))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    # Допускается запись вида 1e6
+    parser.add_argument('--rows', type=lambda value: int(float(value)), default=100_000)
+    parser.add_argument('--branches', type=int, default=DEFAULT_BRANCHES)
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS)
+    parser.add_argument('--items', type=int, default=DEFAULT_ITEMS)
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_dataset(args.path, args.rows, args.chunk_rows, args.seed,
+                  branches=args.branches, clients=args.clients, items=args.items)
+    print(f"Записано {args.rows} строк в {args.path} ({os.path.getsize(args.path) / 2 ** 20:.1f} МиБ)")
+
+
+if __name__ == '__main__':
+    main()
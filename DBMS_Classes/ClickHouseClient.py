@@ -1,12 +1,17 @@
 import clickhouse_connect
+from DBMS_Classes.ClickHouseClientPool import client_settings, shared_pool
 
 
 class ClickHouseClient:
-    def __init__(self):
+    def __init__(self, pool=None):
+        # Без явного пула используется общий пул процесса, если он настроен
+        self._pool = pool if pool is not None else shared_pool()
         self._client = None
         try:
-            self._client = clickhouse_connect.get_client(
-                host="host.docker.internal", port=8123, username='admin', password='admin')
+            if self._pool is not None:
+                self._client = self._pool.getclient()
+            else:
+                self._client = clickhouse_connect.get_client(**client_settings())
             print("Соединение с клиентом ClickHouse установлено")
         except Exception as e:
             print("Ошибка при соединении с клиентом ClickHouse", e)
@@ -15,4 +20,12 @@ class ClickHouseClient:
         return self._client
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        print("Соединение с клиентом ClickHouse закрыто")
+        if self._client is None:
+            return
+        if self._pool is not None:
+            # Клиент остаётся открытым для следующих вызовов
+            self._pool.putclient(self._client)
+        else:
+            self._client.close()
+            print("Соединение с клиентом ClickHouse закрыто")
+        self._client = None
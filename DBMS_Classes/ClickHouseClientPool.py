@@ -0,0 +1,134 @@
+import atexit
+import queue
+import threading
+import clickhouse_connect
+import config
+
+
+def client_settings():
+    """Параметры подключения к ClickHouse из config (с прежними значениями по умолчанию)."""
+    return {
+        'host': getattr(config, 'clickhouse_host', 'host.docker.internal'),
+        'port': getattr(config, 'clickhouse_port', 8123),
+        'username': getattr(config, 'clickhouse_user', 'admin'),
+        'password': getattr(config, 'clickhouse_password', 'admin'),
+    }
+
+
+class ClickHouseClientPool:
+    """
+    Пул клиентов clickhouse_connect.
+
+    Клиент не рассчитан на одновременные запросы из нескольких потоков
+    (у него одна сессия), поэтому каждый поток берёт свой клиент из пула.
+    Перед выдачей клиент проверяется через ping(), неотвечающий закрывается
+    и заменяется новым. Клиенты создаются по мере необходимости, но не
+    больше max_size одновременно.
+    """
+
+    def __init__(self, max_size=4, timeout=30.0, **settings):
+        self._settings = settings or client_settings()
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _discard(self, client):
+        with self._lock:
+            self._clients.discard(client)
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def getclient(self):
+        """
+        Проверенный клиент из пула; вернуть его нужно через putclient.
+
+        Исключения:
+            TimeoutError: Если все клиенты заняты дольше timeout секунд
+            RuntimeError: Если пул закрыт
+        """
+        if self._closed:
+            raise RuntimeError("Пул клиентов ClickHouse закрыт")
+        if not self._slots.acquire(timeout=self._timeout):
+            raise TimeoutError(f"Нет свободного клиента ClickHouse за {self._timeout} с")
+        try:
+            while True:
+                try:
+                    client = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if client.ping():
+                    return client
+                self._discard(client)
+
+            client = clickhouse_connect.get_client(**self._settings)
+            with self._lock:
+                self._clients.add(client)
+            return client
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putclient(self, client):
+        if self._closed:
+            self._discard(client)
+        else:
+            self._idle.put(client)
+        self._slots.release()
+
+    def check(self):
+        """Проверка свободных клиентов, неотвечающие закрываются."""
+        alive = []
+        while True:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if client.ping():
+                alive.append(client)
+            else:
+                self._discard(client)
+        for client in alive:
+            self._idle.put(client)
+
+    def close(self):
+        """Закрытие всех клиентов; занятые закрываются при возврате в пул."""
+        if self._closed:
+            return
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        print("Пул клиентов ClickHouse закрыт")
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_pool():
+    """
+    Общий для процесса пул размером config.clickhouse_pool_size или None,
+    если пул не настроен. Пул закрывается при завершении процесса.
+    """
+    global _shared
+    size = getattr(config, 'clickhouse_pool_size', 0)
+    if size <= 0:
+        return None
+    with _shared_lock:
+        if _shared is None:
+            _shared = ClickHouseClientPool(max_size=size)
+            atexit.register(_shared.close)
+    return _shared
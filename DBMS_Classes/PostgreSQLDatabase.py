@@ -1,14 +1,63 @@
 from psycopg import connect, DatabaseError
 from psycopg.errors import ConnectionTimeout
+import config
 from config import *
+from DBMS_Classes.PostgreSQLPool import shared_pool
+
+
+def connection_string():
+    return f"postgresql://{user}:{password}@{host}:{port}/{dbname}"
+
+
+def table_function_settings():
+    """
+    Параметры табличной функции postgresql() для прямого переноса в ClickHouse.
+
+    Адрес PostgreSQL, видимый серверу ClickHouse, база и учётные данные
+    хранятся на его стороне в именованной коллекции
+    (config.clickhouse_postgresql_collection), поэтому пароль не попадает
+    в текст запроса, system.query_log и журналы сервера.
+    """
+    return {
+        'collection': getattr(config, 'clickhouse_postgresql_collection', None),
+    }
+
+
+def new_connection():
+    """Отдельное соединение для параллельных шагов (без курсора и фиксации при выходе)."""
+    return connect(conninfo=connection_string(), autocommit=False)
+
+
+def connection_source(reserve=1):
+    """
+    Функции получения и освобождения соединения для параллельных шагов.
+
+    reserve - сколько соединений вызывающий держит одновременно: общий
+    пул расширяется (PostgreSQLPool.reserve), если config.postgres_pool_size
+    для этого мал.
+
+    Возвращает:
+        tuple: (getconn, putconn) общего пула, если задан config.postgres_pool_size,
+            иначе новое соединение и его закрытие
+    """
+    pool = shared_pool()
+    if pool is not None:
+        pool.reserve(reserve)
+        return pool.getconn, pool.putconn
+    return new_connection, lambda conn: conn.close()
 
 
 class PostgreSQLDatabase:
-    def __init__(self):
-        conn_string = f"postgresql://{user}:{password}@{host}:{port}/{dbname}"
+    def __init__(self, pool=None):
+        # Без явного пула используется общий пул процесса, если он настроен
+        self._pool = pool if pool is not None else shared_pool()
+        conn_string = connection_string()
         self._connection = None
         try:
-            self._connection = connect(conninfo=conn_string, autocommit=False)
+            if self._pool is not None:
+                self._connection = self._pool.getconn()
+            else:
+                self._connection = connect(conninfo=conn_string, autocommit=False)
             if self._connection:
                 print("Соединение PostgreSQL создано успешно")
         except ConnectionTimeout as error:
@@ -28,6 +77,12 @@ class PostgreSQLDatabase:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self._connection:
-            self._connection.commit()
-            self._connection.close()
-            print("Соединение PostgreSQL закрыто")
+            try:
+                self._connection.commit()
+            finally:
+                if self._pool is not None:
+                    # Соединение остаётся открытым для следующих вызовов
+                    self._pool.putconn(self._connection)
+                else:
+                    self._connection.close()
+                    print("Соединение PostgreSQL закрыто")
@@ -0,0 +1,92 @@
+import atexit
+import threading
+from psycopg_pool import ConnectionPool
+import config
+
+
+class PostgreSQLPool:
+    """
+    Пул соединений PostgreSQL на psycopg_pool.
+
+    Соединение проверяется перед выдачей (check_connection): разорванное
+    сервером соединение заменяется новым, а не возвращается вызывающему.
+    Возвращённые в пул соединения откатываются, если транзакция не была
+    зафиксирована.
+    """
+
+    def __init__(self, min_size=1, max_size=4, timeout=30.0, max_idle=600.0):
+        # PostgreSQLDatabase сам импортирует этот модуль, поэтому импорт здесь
+        from DBMS_Classes.PostgreSQLDatabase import connection_string
+
+        self._pool = ConnectionPool(
+            conninfo=connection_string(), min_size=min_size, max_size=max_size, timeout=timeout,
+            max_idle=max_idle, kwargs={'autocommit': False},
+            check=ConnectionPool.check_connection, open=True, name='etl')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def getconn(self):
+        """
+        Соединение из пула; вернуть его нужно через putconn.
+
+        Исключения:
+            PoolTimeout: Если свободное соединение не появилось за timeout секунд
+        """
+        return self._pool.getconn()
+
+    def putconn(self, conn):
+        self._pool.putconn(conn)
+
+    def connection(self):
+        """Контекстный менеджер: соединение фиксируется при выходе и возвращается в пул."""
+        return self._pool.connection()
+
+    def reserve(self, count):
+        """
+        Увеличение max_size, чтобы сверх уже выданных соединений можно было
+        одновременно взять ещё count: иначе шаги, которые держат соединения
+        до общей фиксации, ждали бы друг друга до PoolTimeout.
+        """
+        stats = self._pool.get_stats()
+        required = stats.get('pool_size', 0) - stats.get('pool_available', 0) + count
+        if required > self._pool.max_size:
+            self._pool.resize(self._pool.min_size, required)
+
+    def check(self):
+        """Проверка свободных соединений пула, разорванные заменяются."""
+        self._pool.check()
+
+    def stats(self):
+        return self._pool.get_stats()
+
+    def close(self):
+        if not self._pool.closed:
+            self._pool.close()
+            print("Пул соединений PostgreSQL закрыт")
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_pool():
+    """
+    Общий для процесса пул размером config.postgres_pool_size или None,
+    если пул не настроен. Пул закрывается при завершении процесса.
+    """
+    global _shared
+    size = getattr(config, 'postgres_pool_size', 0)
+    if size <= 0:
+        return None
+    with _shared_lock:
+        if _shared is None:
+            _shared = PostgreSQLPool(
+                min_size=getattr(config, 'postgres_pool_min_size', 1), max_size=size,
+                timeout=getattr(config, 'postgres_pool_timeout', 30.0))
+            atexit.register(_shared.close)
+    return _shared
+
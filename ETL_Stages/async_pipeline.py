@@ -0,0 +1,186 @@
+import asyncio
+import inspect
+import clickhouse_connect
+from psycopg import AsyncConnection
+import SQL_Requests.postgresql_query as query
+import SQL_Requests.clickhouse_query as ch_query
+from ETL_Stages.prepare import prepare_frame
+from ETL_Stages.readers import iter_chunks, DEFAULT_CHUNK_SIZE
+from ETL_Stages.staging import coerce_columns, staging_statements, finishing_statements
+from ETL_Stages.transfer import (convert_columns, PURCHASES_COLUMNS, DEFAULT_BATCH_SIZE,
+                                 DEFAULT_QUEUE_SIZE)
+from ETL_Stages.quality import TYPE_RULES
+
+DEFAULT_STAGE_WORKERS = 2
+DEFAULT_LOAD_WORKERS = 2
+
+_DONE = object()
+
+
+async def _maybe_await(result):
+    # В части версий clickhouse_connect close() асинхронного клиента синхронный
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+async def _gather(*coroutines):
+    # Если один этап упал, остальные отменяются: иначе производитель
+    # навсегда останется ждать места в очереди, которую никто не читает
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for pending in tasks:
+            pending.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def _prepared_chunks(path, chunk_size, rules, cache):
+    if cache is not None:
+        yield from cache.chunks(path, chunk_size, (), {}, rules)
+        return
+    for df in iter_chunks(path, chunk_size):
+        yield prepare_frame(df, (), {}, rules)
+
+
+async def _read(path, chunk_size, prepared_queue, stats, rules, cache, quarantine):
+    # Разбор и подготовка файла - блокирующая работа, она выполняется вне
+    # цикла событий, чтобы в это время шли сетевые операции других этапов
+    chunks = _prepared_chunks(path, chunk_size, rules, cache)
+    while True:
+        prepared = await asyncio.to_thread(next, chunks, None)
+        if prepared is None:
+            return
+        stats['read'] += len(prepared)
+        stats['rejected'] += prepared.rejected
+        if quarantine is not None and prepared.quarantine is not None:
+            await asyncio.to_thread(quarantine.add, 'prepare', prepared.quarantine)
+        await prepared_queue.put(prepared)
+
+
+async def _stage(conninfo, prepared_queue, stats):
+    async with await AsyncConnection.connect(conninfo) as conn:
+        while True:
+            prepared = await prepared_queue.get()
+            if prepared is _DONE:
+                return
+            if not len(prepared):
+                continue
+            async with conn.cursor() as cur:
+                async with cur.copy(query.copy_temp_data) as copy:
+                    copy.set_types(query.temp_data_types)
+                    for row in zip(*coerce_columns(prepared)):
+                        await copy.write_row(row)
+            await conn.commit()
+            stats['staged'] += len(prepared)
+
+
+async def _extract(conninfo, batch_size, batch_queue, load_workers, stats):
+    async with await AsyncConnection.connect(conninfo) as conn:
+        async with conn.cursor(name='temp_data_transfer') as cur:
+            cur.itersize = batch_size
+            await cur.execute(query.select_purchases_source)
+            while True:
+                batch = await cur.fetchmany(batch_size)
+                if not batch:
+                    break
+                stats['extracted'] += len(batch)
+                await batch_queue.put(batch)
+    for _ in range(load_workers):
+        await batch_queue.put(_DONE)
+
+
+async def _load(client, batch_queue, stats, rules, quarantine):
+    while True:
+        batch = await batch_queue.get()
+        if batch is _DONE:
+            return
+        # Приведение пачки и запись отклонённых строк в quarantine блокируют,
+        # поэтому идут в отдельном потоке, как и разбор файлов
+        columns, rejected = await asyncio.to_thread(convert_columns, batch, rules, quarantine)
+        stats['rejected'] += rejected
+        if columns[0]:
+            await client.insert("purchases", columns, column_names=PURCHASES_COLUMNS,
+                                column_oriented=True)
+            stats['inserted'] += len(columns[0])
+
+
+async def _normalize(conninfo):
+    async with await AsyncConnection.connect(conninfo) as conn:
+        await conn.execute(query.insert_into_tmp_table)
+
+
+async def run_pipeline(paths, conninfo, client_settings, chunk_size=DEFAULT_CHUNK_SIZE,
+                       batch_size=DEFAULT_BATCH_SIZE, queue_size=DEFAULT_QUEUE_SIZE,
+                       staging_mode='logged', rollup_mode='scan', normalize=True,
+                       stage_workers=DEFAULT_STAGE_WORKERS, load_workers=DEFAULT_LOAD_WORKERS,
+                       rules=TYPE_RULES, quarantine=None, prepare_rules=None, parse_cache=None):
+    """
+    Полный прогон ETL в одном цикле событий asyncio.
+
+    Этапы связаны очередями ограниченного размера:
+    чтение файлов -> COPY в temp_data -> чтение temp_data -> вставка в purchases
+    -> агрегаты. Файлы paths читаются одновременно, порции пишут
+    stage_workers асинхронных соединений PostgreSQL, пачки вставляют
+    load_workers сопрограмм. Заполнение нормализованных таблиц идёт
+    одновременно с переносом в ClickHouse: оба этапа только читают temp_data.
+
+    Таблицы ClickHouse должны быть созданы заранее (create_tables), а
+    temp_data - пустой: в режиме logged она не очищается, и повторный
+    прогон задвоил бы строки. Порции файлов проверяются правилами
+    prepare_rules (как prepare_data) и берутся из parse_cache (ParseCache),
+    если он задан. Строки, отброшенные при подготовке или при переносе по
+    правилам rules, передаются в quarantine (ETL_Stages.quality.Quarantine),
+    если он задан.
+
+    Исключения:
+        AssertionError: Если в temp_data остались строки прошлого прогона
+
+    Возвращает:
+        dict: Количество прочитанных, загруженных в temp_data, извлечённых,
+            вставленных и отброшенных строк
+    """
+    stats = {'read': 0, 'staged': 0, 'extracted': 0, 'inserted': 0, 'rejected': 0}
+
+    async with await AsyncConnection.connect(conninfo) as conn:
+        for statement in staging_statements(staging_mode) + [query.create_query2]:
+            await conn.execute(statement)
+        await conn.commit()
+        cur = await conn.execute("SELECT id FROM temp_data LIMIT 1")
+        assert not await cur.fetchall(), "temp_data не пуста: строки прошлого прогона были бы загружены повторно"
+
+    prepared_queue = asyncio.Queue(maxsize=queue_size)
+
+    async def read_all():
+        await _gather(*(_read(path, chunk_size, prepared_queue, stats, prepare_rules, parse_cache, quarantine)
+                        for path in paths))
+        for _ in range(stage_workers):
+            await prepared_queue.put(_DONE)
+
+    await _gather(read_all(), *(_stage(conninfo, prepared_queue, stats) for _ in range(stage_workers)))
+
+    async with await AsyncConnection.connect(conninfo) as conn:
+        for statement in finishing_statements(staging_mode):
+            await conn.execute(statement)
+        await conn.commit()
+
+    # Без отдельной сессии вставки одного клиента могут идти одновременно
+    client = await clickhouse_connect.get_async_client(**client_settings, autogenerate_session_id=False)
+    try:
+        batch_queue = asyncio.Queue(maxsize=queue_size)
+        transfer = [_extract(conninfo, batch_size, batch_queue, load_workers, stats)]
+        transfer += [_load(client, batch_queue, stats, rules, quarantine) for _ in range(load_workers)]
+        if normalize:
+            transfer.append(_normalize(conninfo))
+        await _gather(*transfer)
+        if quarantine is not None:
+            await asyncio.to_thread(quarantine.flush)
+
+        if rollup_mode == 'scan':
+            await _gather(client.command(ch_query.insert_data_to_date_purchases),
+                          client.command(ch_query.insert_data_to_date_purchases_by_gender))
+    finally:
+        await _maybe_await(client.close())
+    return stats
@@ -0,0 +1,264 @@
+import json
+import os
+import random
+import time
+import uuid
+import numpy as np
+import SQL_Requests.postgresql_query as query
+import SQL_Requests.registry as registry
+import SQL_Requests.clickhouse_query as ch_query
+from ETL_Stages.transfer import convert_columns, PURCHASES_COLUMNS, DEFAULT_BATCH_SIZE, TOUCHED_GRANULARITY
+from ETL_Stages.rollups import table_engine
+from ETL_Stages.quality import TYPE_RULES
+
+DEFAULT_CHECKPOINT_PATH = 'transfer_checkpoint.json'
+
+# Повторы одной пачки и задержка перед первым повтором (удваивается с каждым)
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# Размер пачки подстраивается под время вставки: растёт на шаг, пока вставка
+# быстрее target_seconds, и уменьшается вдвое при медленной вставке или ошибке
+DEFAULT_TARGET_SECONDS = 2.0
+MIN_BATCH_SIZE = 1_000
+MAX_BATCH_SIZE = 500_000
+
+# Сколько последних блоков помнит ClickHouse для дедупликации вставок
+DEDUPLICATION_WINDOW = 10_000
+
+# Таблицы режима агрегатов mv, куда пишут материализованные представления
+_STATE_TABLES = ('date_purchases_state', 'date_purchases_by_gender_state')
+
+
+class TransferCheckpoint:
+    """
+    Контрольная точка переноса temp_data -> purchases в локальном JSON-файле.
+
+    Хранится идентификатор прогона, признаки содержимого temp_data, верхняя
+    граница ID последней зафиксированной пачки, пачка, вставка которой
+    начата, но не подтверждена, и текущий размер пачки. Состояние
+    сохраняется до и после каждой вставки; файл перезаписывается атомарно,
+    как в WatermarkStore.
+    """
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_PATH):
+        self._path = path
+        self._state = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._state = json.load(f)
+
+    def resumable(self, source, table):
+        """Есть незавершённый прогон по тем же данным temp_data и той же таблице."""
+        return (self._state.get('status') == 'running' and self._state.get('source') == source
+                and self._state.get('table') == table)
+
+    def start(self, source, table, batch_size):
+        self._state = {
+            'run': uuid.uuid4().hex, 'status': 'running', 'source': source, 'table': table,
+            'committed': None, 'nulls': False, 'pending': None, 'batch_size': batch_size,
+            'batches': 0, 'inserted': 0, 'rejected': 0,
+        }
+
+    @property
+    def run(self):
+        return self._state['run']
+
+    @property
+    def batch_size(self):
+        return self._state['batch_size']
+
+    def committed(self):
+        return self._state['committed']
+
+    def nulls_done(self):
+        return self._state['nulls']
+
+    def pending(self):
+        return self._state['pending']
+
+    def begin(self, batch, batch_size):
+        self._state['pending'] = batch
+        self._state['batch_size'] = batch_size
+
+    def commit(self, batch, inserted, rejected):
+        if batch['high'] is None:
+            self._state['nulls'] = True
+        else:
+            self._state['committed'] = batch['high']
+        self._state['pending'] = None
+        self._state['batches'] += 1
+        self._state['inserted'] += inserted
+        self._state['rejected'] += rejected
+
+    def finish(self):
+        self._state['status'] = 'done'
+
+    def summary(self):
+        return {name: self._state.get(name, 0) for name in ('batches', 'inserted', 'rejected')}
+
+    def save(self):
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._path)
+
+
+class BatchSizer:
+    """
+    Размер пачки по принципу AIMD: после быстрой вставки он растёт на step,
+    после вставки дольше target_seconds или ошибки сервера - уменьшается вдвое.
+    """
+
+    def __init__(self, size=DEFAULT_BATCH_SIZE, target_seconds=DEFAULT_TARGET_SECONDS,
+                 min_size=MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE):
+        self.min_size = min(min_size, size)
+        self.max_size = max(max_size, size)
+        self.size = size
+        self.step = max(size // 4, self.min_size)
+        self.target_seconds = target_seconds
+
+    def success(self, seconds):
+        if seconds > self.target_seconds:
+            self.failure()
+        else:
+            self.size = min(self.max_size, self.size + self.step)
+
+    def failure(self):
+        self.size = max(self.min_size, self.size // 2)
+
+
+def source_signature(conn, run_key=None):
+    """
+    Количество строк и границы ID в temp_data: по ним прогон узнаёт те же
+    данные. run_key (например, run_id DAG) отличает загрузки с совпадающими
+    признаками.
+    """
+    with conn.cursor() as cur:
+        cur.execute(query.select_temp_data_signature)
+        rows, low, high = cur.fetchone()
+    return {'rows': rows, 'min_id': low, 'max_id': high, 'key': run_key}
+
+
+def enable_deduplication(client, table='purchases', window=DEDUPLICATION_WINDOW):
+    """
+    Дедупликация вставок по токену для table и таблиц агрегатов режима mv:
+    повтор пачки с тем же insert_deduplication_token не добавляет строки.
+    """
+    for name in (table,) + _STATE_TABLES:
+        if name == table or table_engine(client, name) is not None:
+            client.command(ch_query.enable_insert_deduplication.format(table=name, window=window))
+
+
+def _next_batch(cur, checkpoint, source, size):
+    # Следующая пачка: диапазон ID после зафиксированной границы, затем строки без ID
+    low = checkpoint.committed()
+    if source['max_id'] is not None and (low is None or low < source['max_id']):
+        low = source['min_id'] - 1 if low is None else low
+        registry.execute(cur, 'select_batch_bound', {'low': low, 'limit': size})
+        high = cur.fetchone()[0]
+        if high is not None:
+            return {'id': f"{low}-{high}", 'low': low, 'high': high}
+    if not checkpoint.nulls_done():
+        return {'id': 'null', 'low': None, 'high': None}
+    return None
+
+
+def _read_batch(cur, batch):
+    if batch['high'] is None:
+        registry.execute(cur, 'select_purchases_source_null', key='id')
+    else:
+        registry.execute(cur, 'select_purchases_source_batch', {'low': batch['low'], 'high': batch['high']})
+    return cur.fetchall()
+
+
+def load_checkpointed(conn, client, checkpoint, batch_size=DEFAULT_BATCH_SIZE, table='purchases',
+                      rules=TYPE_RULES, quarantine=None, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                      target_seconds=DEFAULT_TARGET_SECONDS, run_key=None, sleep=time.sleep):
+    """
+    Перенос temp_data в purchases пачками по диапазонам ID с контрольной точкой.
+
+    У каждой пачки детерминированный идентификатор - её диапазон ID, а у
+    вставки - токен insert_deduplication_token из идентификатора прогона и
+    пачки. Перед вставкой пачка записывается в checkpoint как начатая,
+    после вставки - как зафиксированная. Повторный запуск по тем же данным
+    temp_data (и тому же run_key) продолжает с начатой пачки с тем же
+    токеном: если она успела записаться, ClickHouse её отбросит, - и
+    переносит только оставшиеся.
+
+    Упавшая вставка повторяется до retries раз с экспоненциальной
+    задержкой; повторяется та же пачка с тем же токеном, а размер
+    следующих пачек подстраивается под время вставки и ошибки (BatchSizer).
+    Строки без ID переносятся последней пачкой.
+
+    Возвращает:
+        dict: Статистика этого запуска (см. transfer_purchases), число пачек,
+            повторов и отброшенных дедупликацией пачек, итоговый размер пачки
+            и признак продолжения прерванного прогона
+
+    Исключения:
+        Exception: Ошибка вставки после всех повторов; checkpoint сохраняет место остановки
+    """
+    source = source_signature(conn, run_key)
+    resumed = checkpoint.resumable(source, table)
+    if not resumed:
+        checkpoint.start(source, table, batch_size)
+        checkpoint.save()
+    with conn.cursor() as cur:
+        cur.execute(query.create_temp_data_id_index)
+    conn.commit()
+    enable_deduplication(client, table)
+
+    sizer = BatchSizer(checkpoint.batch_size, target_seconds)
+    stats = {'read': 0, 'inserted': 0, 'rejected': 0, 'bytes': 0, 'touched': set(), 'batches': 0,
+             'retries': 0, 'deduplicated': 0, 'resumed': resumed}
+    with conn.cursor() as cur:
+        while True:
+            batch = checkpoint.pending() or _next_batch(cur, checkpoint, source, sizer.size)
+            if batch is None:
+                break
+            batch['token'] = f"{checkpoint.run}:{batch['id']}"
+            checkpoint.begin(batch, sizer.size)
+            checkpoint.save()
+
+            rows = _read_batch(cur, batch)
+            conn.rollback()
+            stats['read'] += len(rows)
+            columns, rejected = convert_columns(rows, rules, quarantine) if rows else ([[]] * 5, 0)
+            inserted = len(columns[0])
+            settings = {'insert_deduplicate': 1, 'insert_deduplication_token': batch['token'],
+                        'deduplicate_blocks_in_dependent_materialized_views': 1}
+            for attempt in range(retries + 1):
+                if not inserted:
+                    break
+                start = time.perf_counter()
+                try:
+                    summary = client.insert(table, columns, column_names=PURCHASES_COLUMNS,
+                                            column_oriented=True, settings=settings)
+                except Exception:
+                    sizer.failure()
+                    if attempt == retries:
+                        raise
+                    stats['retries'] += 1
+                    delay = min(MAX_BACKOFF, backoff * 2 ** attempt)
+                    sleep(random.uniform(delay / 2, delay))
+                    continue
+                sizer.success(time.perf_counter() - start)
+                stats['bytes'] += summary.written_bytes()
+                if not summary.written_rows:
+                    stats['deduplicated'] += 1
+                break
+
+            checkpoint.commit(batch, inserted, rejected)
+            checkpoint.save()
+            stats['batches'] += 1
+            stats['inserted'] += inserted
+            stats['rejected'] += rejected
+            marks = np.asarray(columns[4], dtype='int64') // TOUCHED_GRANULARITY
+            stats['touched'].update((np.unique(marks) * TOUCHED_GRANULARITY).tolist())
+
+    checkpoint.finish()
+    checkpoint.save()
+    stats['batch_size'] = sizer.size
+    return stats
@@ -0,0 +1,119 @@
+import SQL_Requests.clickhouse_query as ch_query
+from ETL_Stages.rollups import create_rollups, table_engine, has_column
+
+# scan - агрегаты пересчитываются GROUP BY по purchases после загрузки,
+# mv - материализованные представления обновляют их при вставке
+ROLLUP_MODES = ('scan', 'mv')
+
+# basic - исходная схема purchases, optimized - create_purchases_optimized
+PURCHASES_SCHEMAS = ('basic', 'optimized')
+
+
+def _check_rollup_mode(rollup_mode):
+    if rollup_mode not in ROLLUP_MODES:
+        raise ValueError(f"Неизвестный режим агрегатов: {rollup_mode}, ожидается один из {ROLLUP_MODES}")
+
+
+def _check_purchases_schema(purchases_schema):
+    if purchases_schema not in PURCHASES_SCHEMAS:
+        raise ValueError(
+            f"Неизвестная схема purchases: {purchases_schema}, ожидается одна из {PURCHASES_SCHEMAS}")
+
+
+def create_purchases(client, purchases_schema='basic', projection=False, table='purchases'):
+    """Создание purchases в выбранной схеме, при необходимости с проекцией by_client."""
+    _check_purchases_schema(purchases_schema)
+    if purchases_schema == 'basic':
+        client.command(ch_query.create_purchases)
+        return
+    client.command(ch_query.create_purchases_optimized.format(table=table))
+    if projection:
+        client.command(ch_query.add_purchases_client_projection.format(table=table))
+
+
+def is_optimized(client, table='purchases'):
+    """Признак того, что таблица уже создана по схеме optimized (есть ключ партиционирования)."""
+    result = client.query(
+        "SELECT partition_key FROM system.tables WHERE database = currentDatabase() AND name = %(table)s",
+        parameters={'table': table})
+    return bool(result.result_rows and result.result_rows[0][0])
+
+
+def migrate_purchases(client, projection=False):
+    """
+    Перенос существующих данных purchases в схему optimized.
+
+    Данные копируются в purchases_migration, таблицы меняются местами
+    через EXCHANGE TABLES, старая таблица удаляется. Материализованные
+    представления режима mv пересоздаются, чтобы следить за новой таблицей.
+
+    Возвращает:
+        bool: False, если purchases уже в схеме optimized
+    """
+    if is_optimized(client):
+        return False
+
+    client.command("DROP TABLE IF EXISTS purchases_migration")
+    create_purchases(client, 'optimized', projection, table='purchases_migration')
+    # Старые данные могут занимать больше 100 месяцев-партиций в одном блоке
+    client.command(ch_query.copy_purchases.format(target='purchases_migration', source='purchases'),
+                   settings={'max_partitions_per_insert_block': 0})
+    client.command(ch_query.exchange_purchases.format(table='purchases_migration'))
+    client.command("DROP TABLE purchases_migration")
+
+    if table_engine(client, 'date_purchases_mv') is not None:
+        client.command("DROP TABLE IF EXISTS date_purchases_mv, date_purchases_by_gender_mv")
+        client.command(ch_query.create_date_purchases_mv)
+        client.command(ch_query.create_date_purchases_by_gender_mv)
+    return True
+
+
+def drop_tables(client):
+    """Удаление purchases, агрегатов и объектов режима mv."""
+    client.command(ch_query.drop_rollups)
+    client.command(ch_query.drop_purchases)
+    client.command(ch_query.drop_date_purchases)
+    client.command(ch_query.drop_date_purchases_by_gender)
+
+
+def create_tables(client, rollup_mode='scan', purchases_schema='basic', projection=False):
+    """
+    Создание purchases и агрегатов в выбранном режиме (IF NOT EXISTS).
+
+    Исключения:
+        ValueError: Если режим агрегатов или схема purchases неизвестны
+    """
+    _check_rollup_mode(rollup_mode)
+    # Уже загруженная таблица в исходной схеме переносится, а не пересоздаётся
+    if purchases_schema == 'optimized' and table_engine(client, 'purchases') is not None:
+        migrate_purchases(client, projection)
+    create_purchases(client, purchases_schema, projection)
+    if rollup_mode == 'mv':
+        create_rollups(client)
+        return
+
+    # Представления, оставшиеся от режима mv, заменяются таблицами
+    client.command(ch_query.drop_rollups)
+    for table in ('date_purchases', 'date_purchases_by_gender'):
+        if table_engine(client, table) == 'View':
+            client.command(f"DROP TABLE {table}")
+    # Агрегаты без суммы выручки пересоздаются и сразу заполняются по purchases:
+    # инкрементальная загрузка пересчитывает только затронутые дни
+    refill = table_engine(client, 'date_purchases') is not None and \
+        not has_column(client, 'date_purchases', 'date_revenue')
+    if refill:
+        client.command(ch_query.drop_date_purchases)
+        client.command(ch_query.drop_date_purchases_by_gender)
+    client.command(ch_query.create_date_purchases)
+    client.command(ch_query.create_date_purchases_by_gender)
+    if refill:
+        fill_aggregates(client, rollup_mode)
+
+
+def fill_aggregates(client, rollup_mode='scan'):
+    """Полный пересчёт агрегатов; в режиме mv они уже актуальны."""
+    _check_rollup_mode(rollup_mode)
+    if rollup_mode == 'mv':
+        return
+    client.command(ch_query.insert_data_to_date_purchases)
+    client.command(ch_query.insert_data_to_date_purchases_by_gender)
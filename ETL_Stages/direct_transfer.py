@@ -0,0 +1,104 @@
+from psycopg import sql
+import SQL_Requests.postgresql_query as query
+import SQL_Requests.clickhouse_query as ch_query
+from ETL_Stages.quality import TYPE_RULES
+from ETL_Stages.transfer import local_timezone_name
+
+# python - строки проходят через процесс ETL (transfer_purchases),
+# clickhouse - ClickHouse читает PostgreSQL сам (postgresql()),
+# checkpoint - пачки с контрольной точкой и повторами (ETL_Stages.checkpoint)
+TRANSFER_STRATEGIES = ('python', 'clickhouse', 'checkpoint')
+
+# Источник прямого переноса: temp_data или представление над нормализованными таблицами
+DIRECT_SOURCES = {
+    'temp_data': 'temp_data',
+    'normalized': 'purchases_normalized_source',
+}
+
+
+def check_transfer_strategy(strategy, load_mode='full', settings=None):
+    """
+    Проверка стратегии переноса для режима загрузки load_mode; для
+    clickhouse - и параметров postgresql() settings (table_function_settings()).
+
+    Исключения:
+        ValueError: Если стратегия неизвестна, clickhouse (checkpoint) выбрана не для
+            полной загрузки или для clickhouse не задана именованная коллекция
+    """
+    if strategy not in TRANSFER_STRATEGIES:
+        raise ValueError(f"Неизвестная стратегия переноса: {strategy}, ожидается одна из {TRANSFER_STRATEGIES}")
+    if strategy != 'python' and load_mode != 'full':
+        raise ValueError(f"Стратегия переноса {strategy} поддерживается только при полной загрузке")
+    if strategy == 'clickhouse':
+        postgresql_function('temp_data', settings or {})
+
+
+def _literal(value):
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def postgresql_function(relation, settings):
+    """
+    Вызов табличной функции postgresql() для relation через именованную
+    коллекцию settings['collection'] (table_function_settings()): учётные
+    данные в текст запроса не подставляются. Коллекция создаётся на
+    сервере ClickHouse один раз, в конфигурации (named_collections) или
+    запросом CREATE NAMED COLLECTION с host, port, database, user и password.
+
+    Исключения:
+        ValueError: Если именованная коллекция не задана
+    """
+    if not settings.get('collection'):
+        raise ValueError("Для стратегии переноса clickhouse задайте именованную коллекцию ClickHouse "
+                         "с параметрами PostgreSQL (clickhouse_postgresql_collection)")
+    return f"postgresql({settings['collection']}, table={_literal(relation)})"
+
+
+def direct_relation(conn, source='temp_data'):
+    """
+    Имя отношения PostgreSQL для источника source (DIRECT_SOURCES);
+    для normalized создаётся представление над нормализованными таблицами.
+
+    Исключения:
+        ValueError: Если источник неизвестен
+    """
+    if source not in DIRECT_SOURCES:
+        raise ValueError(f"Неизвестный источник прямого переноса: {source}, ожидается один из {tuple(DIRECT_SOURCES)}")
+    if source == 'normalized':
+        with conn.cursor() as cur:
+            cur.execute(query.create_purchases_normalized_source)
+    # ClickHouse читает отдельным соединением: ему нужны зафиксированные данные
+    conn.commit()
+    return DIRECT_SOURCES[source]
+
+
+def transfer_direct(conn, client, settings, relation='temp_data', table='purchases', rules=TYPE_RULES,
+                    timezone=None):
+    """
+    Перенос relation в purchases одним INSERT ... SELECT на стороне ClickHouse.
+
+    Данные не проходят через Python: ClickHouse читает PostgreSQL табличной
+    функцией postgresql(), приводит типы и отбрасывает строки по правилам
+    rules: из них берутся допустимые значения GENDER и нижняя граница
+    PRICE, остальные колонки только приводятся к типам. Отброшенные строки остаются в relation и
+    только подсчитываются, в карантин они не пишутся. Время без часового
+    пояса трактуется в поясе timezone, по умолчанию - в поясе этого
+    процесса (local_timezone_name), как и при переносе через Python, а не
+    в поясе сервера ClickHouse.
+
+    Возвращает:
+        dict: Количество прочитанных, вставленных и отброшенных строк и записанные байты
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(relation)))
+        read = cur.fetchone()[0]
+
+    before = client.command(ch_query.count_table.format(table=table))
+    summary = client.command(
+        ch_query.insert_purchases_direct.format(table=table, source=postgresql_function(relation, settings)),
+        parameters={'genders': list(rules.get('GENDER', {}).get('domain', ())),
+                    'min_price': rules.get('PRICE', {}).get('min'),
+                    'timezone': timezone or local_timezone_name()})
+    inserted = client.command(ch_query.count_table.format(table=table)) - before
+    written = summary.written_bytes() if hasattr(summary, 'written_bytes') else 0
+    return {'read': read, 'inserted': inserted, 'rejected': read - inserted, 'bytes': written}
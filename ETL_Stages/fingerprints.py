@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+import SQL_Requests.postgresql_query as query
+import SQL_Requests.registry as registry
+from ETL_Stages.prepare import PreparedData
+from ETL_Stages.staging import coerce_columns, copy_into_temp_data
+from ETL_Stages.transfer import (iter_batches, transfer_purchases, touched_marks, DEFAULT_BATCH_SIZE,
+                                 DEFAULT_QUEUE_SIZE)
+from ETL_Stages.incremental import refresh_aggregates
+from ETL_Stages.quality import TYPE_RULES
+
+# off - строки загружаются как есть, fingerprint - только строки с новым отпечатком
+DEDUP_MODES = ('off', 'fingerprint')
+
+# Сколько отпечатков отмечается одним UPDATE
+MARK_CHUNK = 100_000
+
+# Знаков после запятой у чисел с плавающей точкой в отпечатке
+FLOAT_DECIMALS = 8
+
+
+def check_dedup_mode(dedup_mode, staging_mode='logged'):
+    """
+    Исключения:
+        ValueError: Если режим неизвестен или fingerprint выбран со staging_mode='optimized'
+    """
+    if dedup_mode not in DEDUP_MODES:
+        raise ValueError(f"Неизвестный режим повторной загрузки: {dedup_mode}, ожидается один из {DEDUP_MODES}")
+    # optimized очищает temp_data перед загрузкой, а UNLOGGED-таблица пустеет
+    # и после сбоя сервера; row_fingerprints при этом остаются, и строки, ещё
+    # не нормализованные или не перенесённые, повтор счёл бы уже загруженными
+    if dedup_mode == 'fingerprint' and staging_mode == 'optimized':
+        raise ValueError("Режим повторной загрузки fingerprint несовместим со staging_mode='optimized'")
+
+
+def _typed(values, pg_type):
+    # Колонка в типе pandas, соответствующем типу temp_data: хеш типизированных
+    # колонок считается намного быстрее, чем хеш объектов Python
+    if pg_type in ('bigint', 'int4'):
+        return pd.array(values, dtype='Int64')
+    if pg_type == 'float8':
+        # Последние знаки float зависят от формата файла (разбор CSV, Excel),
+        # поэтому в отпечаток идёт значение, округлённое до FLOAT_DECIMALS знаков
+        return pd.Series(values, dtype='float64').round(FLOAT_DECIMALS)
+    if pg_type == 'timestamp':
+        return pd.to_datetime(pd.Series(values, dtype=object))
+    return pd.Series(values, dtype=object)
+
+
+def row_fingerprints(prepared):
+    """
+    Отпечатки строк порции: 64-битный хеш значений всех колонок temp_data.
+
+    Значения сначала приводятся к типам temp_data, поэтому отпечаток одной
+    и той же строки не зависит от формата исходного файла, а ключ хеша
+    pandas фиксирован - и от процесса, в котором он считается.
+
+    Возвращает:
+        numpy.ndarray: Отпечатки (int64, как BIGINT в PostgreSQL) в порядке строк
+    """
+    frame = pd.DataFrame({column: _typed(values, pg_type) for column, values, pg_type
+                          in zip(query.temp_data_columns, coerce_columns(prepared), query.temp_data_types)})
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy().view(np.int64)
+
+
+def create_fingerprint_tables(cur):
+    """row_fingerprints, колонка FINGERPRINT и её индекс в temp_data."""
+    cur.execute(query.create_row_fingerprints)
+
+
+def _occurrence_fingerprints(fingerprints, ids, source, occurrences):
+    # Строки без ID, совпадающие во всех колонках, - разные строки файла
+    # (например, одинаковые позиции одного чека): k-я такая строка файла
+    # получает отпечаток с номером k, первая сохраняет обычный
+    missing = np.flatnonzero(pd.isna(pd.Series(ids, dtype=object)).to_numpy())
+    if not len(missing):
+        return fingerprints
+    base = pd.Series(fingerprints[missing])
+    seen = np.fromiter((occurrences.get((source, value), 0) for value in base), dtype=np.int64, count=len(base))
+    number = seen + base.groupby(base).cumcount().to_numpy()
+    for value, count in base.value_counts().items():
+        occurrences[(source, value)] = occurrences.get((source, value), 0) + int(count)
+    repeated = number > 0
+    fingerprints = fingerprints.copy()
+    fingerprints[missing[repeated]] = pd.util.hash_pandas_object(
+        pd.DataFrame({'fingerprint': base[repeated].to_numpy(), 'number': number[repeated]}),
+        index=False).to_numpy().view(np.int64)
+    return fingerprints
+
+
+def load_unseen(cur, prepared, source=None, occurrences=None):
+    """
+    Загрузка в temp_data только строк, отпечатков которых ещё нет в row_fingerprints.
+
+    Отпечатки регистрируются в той же транзакции, что и COPY: если загрузка
+    откатывается, повторный прогон снова увидит эти строки новыми. Строки
+    различаются по ID, который входит в отпечаток, поэтому повтор строки с
+    тем же ID внутри порции или между порциями одного прогона отсекается.
+    Одинаковые строки без ID не отсекаются: они нумеруются по порядку в
+    файле source, счётчики ведутся в occurrences (словарь на весь прогон),
+    и повторная загрузка того же файла даёт те же отпечатки.
+
+    Возвращает:
+        PreparedData: Загруженные (новые) строки порции
+    """
+    if not len(prepared):
+        return prepared
+    fingerprints = row_fingerprints(prepared)
+    fingerprints = _occurrence_fingerprints(
+        fingerprints, prepared.data[prepared.columns.index('ID')], source,
+        {} if occurrences is None else occurrences)
+    _, first = np.unique(fingerprints, return_index=True)
+    first.sort()
+    registry.execute(cur, 'register_fingerprints', (fingerprints[first].tolist(), source))
+    new = np.fromiter((row[0] for row in cur.fetchall()), dtype=np.int64)
+    keep = first[np.isin(fingerprints[first], new)]
+
+    unseen = PreparedData(prepared.columns, [np.asarray(values, dtype=object)[keep].tolist()
+                                             for values in prepared.data])
+    copy_into_temp_data(cur, unseen, fingerprints[keep])
+    return unseen
+
+
+def _pending_marks(conn):
+    # Дни строк, перенесённых прошлым прогоном, который упал до пересчёта агрегатов
+    with conn.cursor() as cur:
+        cur.execute(query.select_fingerprints_pending_dates)
+        return touched_marks([row[0] for row in cur.fetchall()])
+
+
+def load_unseen_purchases(conn, client, batch_size=DEFAULT_BATCH_SIZE, queue_size=DEFAULT_QUEUE_SIZE,
+                          rollup_mode='scan', rules=TYPE_RULES, quarantine=None, connect=None, release=None):
+    """
+    Перенос в purchases только строк temp_data, ещё не перенесённых в ClickHouse.
+
+    purchases не пересоздаётся, агрегаты пересчитываются за затронутые дни
+    (в режиме mv их обновляет сам ClickHouse). Строки пачки отмечаются
+    перенесёнными сразу после того, как ClickHouse подтвердил её вставку,
+    и фиксируются отдельным соединением (connect/release, по умолчанию
+    connection_source()): повтор после падения не вставляет их снова. Пока
+    агрегаты за их дни не пересчитаны, строки помечены aggregates_pending,
+    и следующий прогон пересчитает эти дни.
+
+    Возвращает:
+        dict: Статистика переноса (см. transfer_purchases) и пересчитанные дни
+    """
+    if connect is None:
+        from DBMS_Classes.PostgreSQLDatabase import connection_source
+
+        # Соединение отметок и соединение карантина заняты одновременно
+        connect, release = connection_source(2)
+    mark_conn = connect()
+    try:
+        pending = _pending_marks(mark_conn) if rollup_mode == 'scan' else set()
+        mark_conn.commit()
+
+        def committed(batch, touched):
+            # Отброшенные проверками строки тоже отмечаются: они уже в карантине
+            fingerprints = [row[5] for row in batch]
+            with mark_conn.cursor() as cur:
+                for start in range(0, len(fingerprints), MARK_CHUNK):
+                    registry.execute(cur, 'mark_fingerprints_transferred',
+                                     (rollup_mode == 'scan', fingerprints[start:start + MARK_CHUNK]))
+            mark_conn.commit()
+
+        batches = iter_batches(conn, batch_size, query.select_purchases_source_unseen)
+        stats = transfer_purchases(conn, client, batch_size, queue_size, batches=batches,
+                                   rules=rules, quarantine=quarantine, on_insert=committed)
+        conn.commit()
+
+        stats['days'] = ()
+        if rollup_mode == 'scan':
+            stats['days'] = refresh_aggregates(client, pending | stats['touched'])
+            with mark_conn.cursor() as cur:
+                cur.execute(query.clear_fingerprints_aggregates_pending)
+            mark_conn.commit()
+    except Exception:
+        mark_conn.rollback()
+        raise
+    finally:
+        (release or (lambda conn: conn.close()))(mark_conn)
+    return stats
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import pyarrow as pa
+import SQL_Requests.postgresql_query as query
+from ETL_Stages.prepare import PreparedData
+from ETL_Stages.staging import coerce_columns
+
+# Типы Arrow для колонок temp_data (temp_data_types)
+ARROW_TYPES = {
+    'bigint': pa.int64(),
+    'int4': pa.int32(),
+    'float8': pa.float64(),
+    'varchar': pa.string(),
+    'timestamp': pa.timestamp('us'),
+}
+
+STAGING_SCHEMA = pa.schema([(column, ARROW_TYPES[pg_type])
+                            for column, pg_type in zip(query.temp_data_columns, query.temp_data_types)])
+
+_CHECKSUM_BLOCK = 1 << 20
+
+
+def file_checksum(path):
+    """SHA-256 файла, читаемого блоками."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_CHECKSUM_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StagingFileWriter:
+    """
+    Запись подготовленных порций в файл Arrow IPC для передачи между задачами.
+
+    Файл пишется без сжатия, чтобы читатель мог отобразить его в память
+    (memory_map) и читать пачки без копирования. Запись идёт во временный
+    файл, который переименовывается при close(): наполовину записанный файл
+    под итоговым именем не появляется. Исходный файл порции
+    (PreparedData.source) хранится в метаданных её пачки.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.rows = 0
+        self.rejected = 0
+        self._tmp_path = f"{path}.tmp"
+        self._writer = pa.ipc.new_file(self._tmp_path, STAGING_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            return
+        self._writer.close()
+        os.remove(self._tmp_path)
+
+    def write(self, prepared):
+        self.rejected += prepared.rejected
+        if not len(prepared):
+            return
+        arrays = [pa.array(values, type=field.type)
+                  for values, field in zip(coerce_columns(prepared), STAGING_SCHEMA)]
+        metadata = {'source': prepared.source} if prepared.source is not None else None
+        self._writer.write_batch(pa.record_batch(arrays, schema=STAGING_SCHEMA), custom_metadata=metadata)
+        self.rows += len(prepared)
+
+    def close(self):
+        """
+        Завершение записи.
+
+        Возвращает:
+            dict: path, sha256, rows, rejected и bytes - всё, что передаётся через XCom
+        """
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
+        return {
+            'path': self.path,
+            'sha256': file_checksum(self.path),
+            'rows': self.rows,
+            'rejected': self.rejected,
+            'bytes': os.path.getsize(self.path),
+        }
+
+
+def iter_staging_file(path, sha256=None):
+    """
+    Порции PreparedData из файла StagingFileWriter, по одной на записанную
+    пачку; source восстанавливается из метаданных пачки.
+
+    Исключения:
+        ValueError: Если контрольная сумма не совпадает или схема файла не та
+    """
+    if sha256 is not None and file_checksum(path) != sha256:
+        raise ValueError(f"Контрольная сумма {path} не совпадает: файл изменён или записан не полностью")
+    with pa.memory_map(path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        if not reader.schema.equals(STAGING_SCHEMA):
+            raise ValueError(f"Схема {path} не совпадает с temp_data")
+        for index in range(reader.num_record_batches):
+            batch, metadata = reader.get_batch_with_custom_metadata(index)
+            source = metadata.get(b'source') if metadata is not None else None
+            yield PreparedData(query.temp_data_columns, [column.to_pylist() for column in batch.columns],
+                               source=source.decode() if source is not None else None)
@@ -0,0 +1,145 @@
+import json
+import os
+from datetime import datetime
+from psycopg import sql
+import SQL_Requests.postgresql_query as query
+import SQL_Requests.clickhouse_query as ch_query
+from ETL_Stages.transfer import iter_batches, transfer_purchases, DEFAULT_BATCH_SIZE, DEFAULT_QUEUE_SIZE
+from ETL_Stages.quality import TYPE_RULES
+
+DEFAULT_WATERMARK_PATH = 'watermarks.json'
+
+# Колонки temp_data, по которым может вестись водяной знак
+WATERMARK_KEYS = ('ID', 'DATE_')
+
+
+class WatermarkStore:
+    """
+    Водяные знаки инкрементальной загрузки в локальном JSON-файле.
+
+    Для каждой целевой таблицы хранится ключ (ID или DATE_) и последнее
+    загруженное значение. Отдельно хранится список моментов времени, для
+    которых ещё не пересчитаны агрегаты: если прогон упал после вставки в
+    purchases, следующий прогон пересчитает эти дни.
+    Файл перезаписывается атомарно, поэтому падение не оставляет его пустым.
+    """
+
+    def __init__(self, path=DEFAULT_WATERMARK_PATH):
+        self._path = path
+        self._state = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._state = json.load(f)
+
+    def get(self, table, key):
+        """
+        Последнее загруженное значение ключа key для таблицы table или None.
+
+        Исключения:
+            ValueError: Если водяной знак таблицы ведётся по другому ключу
+        """
+        mark = self._state.get(table)
+        if mark is None:
+            return None
+        if mark['key'] != key:
+            raise ValueError(
+                f"Водяной знак {table} ведётся по {mark['key']}, а не по {key}; удалите {self._path}")
+        if key == 'DATE_':
+            return datetime.fromisoformat(mark['value'])
+        return mark['value']
+
+    def set(self, table, key, value):
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        self._state[table] = {'key': key, 'value': value}
+
+    def pending(self):
+        return set(self._state.get('pending_aggregates', []))
+
+    def set_pending(self, marks):
+        self._state['pending_aggregates'] = sorted(marks)
+
+    def save(self):
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._path)
+
+
+def refresh_aggregates(client, marks):
+    """
+    Пересчёт date_purchases и date_purchases_by_gender только за дни,
+    в которые попадают моменты времени marks (секунды от эпохи).
+    """
+    if not marks:
+        return ()
+    result = client.query(ch_query.select_touched_days, parameters={'marks': sorted(marks)})
+    days = tuple(row[0] for row in result.result_rows)
+    parameters = {'days': days}
+    settings = {'mutations_sync': 1}
+    client.command(ch_query.delete_date_purchases_days, parameters=parameters, settings=settings)
+    client.command(ch_query.delete_date_purchases_by_gender_days, parameters=parameters, settings=settings)
+    client.command(ch_query.insert_data_to_date_purchases_days, parameters=parameters)
+    client.command(ch_query.insert_data_to_date_purchases_by_gender_days, parameters=parameters)
+    return days
+
+
+def load_incremental(conn, client, store, key='ID', batch_size=DEFAULT_BATCH_SIZE,
+                     queue_size=DEFAULT_QUEUE_SIZE, rollup_mode='scan', rules=TYPE_RULES, quarantine=None):
+    """
+    Перенос в purchases только строк temp_data с key больше водяного знака.
+
+    Водяной знак сохраняется после подтверждённой вставки каждой пачки,
+    поэтому прогон, упавший на середине, продолжается со следующей пачки
+    без повторной вставки. Агрегаты пересчитываются только за затронутые
+    дни (в режиме mv их обновляет сам ClickHouse). Строки с тем же
+    значением DATE_, что и водяной знак, при key='DATE_' повторно не загружаются.
+
+    Возвращает:
+        dict: Статистика переноса (см. transfer_purchases) и пересчитанные дни
+
+    Исключения:
+        ValueError: Если key не входит в WATERMARK_KEYS
+    """
+    if key not in WATERMARK_KEYS:
+        raise ValueError(f"Неизвестный ключ водяного знака: {key}, ожидается один из {WATERMARK_KEYS}")
+
+    mark = store.get('purchases', key)
+    if mark is None:
+        template, params = query.select_purchases_source_all, None
+    else:
+        template, params = query.select_purchases_source_after, {'mark': mark}
+    statement = sql.SQL(template).format(key=sql.Identifier(key.lower()))
+    pending = store.pending()
+
+    def batches():
+        # Пачка не разрывает строки с одним значением ключа: иначе после
+        # падения водяной знак на этом значении отрезал бы его остаток
+        carry = []
+        for batch in iter_batches(conn, batch_size, statement, params):
+            rows = carry + batch
+            cut = len(rows)
+            while cut and rows[cut - 1][5] == rows[-1][5]:
+                cut -= 1
+            carry = rows[cut:]
+            if cut:
+                yield rows[:cut]
+        if carry:
+            yield carry
+
+    def committed(batch, touched):
+        # Водяной знак двигается только после подтверждённой вставки пачки
+        if rollup_mode == 'scan':
+            pending.update(touched)
+        store.set('purchases', key, batch[-1][5])
+        store.set_pending(pending)
+        store.save()
+
+    stats = transfer_purchases(conn, client, batch_size, queue_size, batches=batches(),
+                               rules=rules, quarantine=quarantine, on_insert=committed)
+
+    # Сначала фиксируется вставка в purchases, затем пересчитываются агрегаты
+    stats['days'] = refresh_aggregates(client, pending)
+    store.set_pending(())
+    store.save()
+    return stats
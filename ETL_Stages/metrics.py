@@ -0,0 +1,198 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# Сколько самых дорогих функций попадает в отчёт при профилировании этапа
+PROFILE_TOP = 20
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в МиБ (ru_maxrss в Linux - КиБ, в macOS - байты)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+class StageMetrics:
+    """
+    Метрики одного этапа: время (настенное и процессорное), строки на
+    входе, выходе и отброшенные, переданные байты и время запросов.
+
+    Этап может выполняться частями (например, по порциям файла):
+    значения всех частей складываются.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.rows_rejected = 0
+        self.bytes = 0
+        self.calls = 0
+        self.peak_rss_mb = 0.0
+        self.traced_peak_mb = None
+        self.statements = {}
+        self.profile = None
+
+    def add(self, rows_in=0, rows_out=0, rejected=0, nbytes=0):
+        self.rows_in += rows_in
+        self.rows_out += rows_out
+        self.rows_rejected += rejected
+        self.bytes += nbytes
+
+    def record_statement(self, name, seconds, rows=None):
+        statement = self.statements.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0})
+        statement['calls'] += 1
+        statement['seconds'] += seconds
+        if rows is not None and rows >= 0:
+            statement['rows'] += rows
+
+    @contextmanager
+    def statement(self, name):
+        """Замер запроса name; строки можно указать через возвращаемый dict."""
+        result = {'rows': None}
+        start = time.perf_counter()
+        try:
+            yield result
+        finally:
+            self.record_statement(name, time.perf_counter() - start, result['rows'])
+
+    def execute(self, cur, name, sql, params=None):
+        """cur.execute с записью времени и числа строк под именем name."""
+        with self.statement(name) as result:
+            cur.execute(sql, params)
+            result['rows'] = cur.rowcount
+        return cur
+
+    def as_dict(self):
+        result = {
+            'stage': self.name,
+            'calls': self.calls,
+            'wall_seconds': round(self.wall_seconds, 6),
+            'cpu_seconds': round(self.cpu_seconds, 6),
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'rows_rejected': self.rows_rejected,
+            'bytes': self.bytes,
+            'rows_per_second': self.rows_out / self.wall_seconds if self.wall_seconds else None,
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'statements': self.statements,
+        }
+        if self.traced_peak_mb is not None:
+            result['traced_peak_mb'] = round(self.traced_peak_mb, 1)
+        if self.profile is not None:
+            result['profile'] = self.profile
+        return result
+
+
+class RunMetrics:
+    """
+    Метрики прогона ETL по этапам.
+
+    profile_stages - этапы, выполняемые под cProfile (в отчёт попадают
+    PROFILE_TOP функций по накопленному времени, при заданном profile_dir
+    сохраняется и файл .prof), trace_memory_stages - этапы, для которых
+    tracemalloc считает пик памяти Python. Процессорное время - время всего
+    процесса, включая потоки этапа, но не дочерние процессы.
+    """
+
+    def __init__(self, profile_stages=(), trace_memory_stages=(), profile_dir=None):
+        self.started = datetime.now()
+        self.stages = {}
+        self._profile_stages = set(profile_stages)
+        self._trace_memory_stages = set(trace_memory_stages)
+        self._profile_dir = profile_dir
+        self._profilers = {}
+
+    def get(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageMetrics(name)
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """Замер части этапа name; возвращает его StageMetrics."""
+        metrics = self.get(name)
+        profiler = None
+        if name in self._profile_stages:
+            profiler = self._profilers.setdefault(name, cProfile.Profile())
+            profiler.enable()
+        trace = name in self._trace_memory_stages and not tracemalloc.is_tracing()
+        if trace:
+            tracemalloc.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield metrics
+        finally:
+            metrics.wall_seconds += time.perf_counter() - wall
+            metrics.cpu_seconds += time.process_time() - cpu
+            metrics.calls += 1
+            metrics.peak_rss_mb = peak_rss_mb()
+            if trace:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                metrics.traced_peak_mb = max(metrics.traced_peak_mb or 0.0, peak / 2 ** 20)
+            if profiler is not None:
+                profiler.disable()
+
+    def _profile_summary(self, name, profiler):
+        if self._profile_dir:
+            os.makedirs(self._profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self._profile_dir, f"{name}.prof"))
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        stats.sort_stats('cumulative')
+        summary = []
+        for function in stats.fcn_list[:PROFILE_TOP]:
+            calls, _, own, cumulative, _ = stats.stats[function]
+            summary.append({'function': pstats.func_std_string(function), 'calls': calls,
+                            'own_seconds': round(own, 6), 'cumulative_seconds': round(cumulative, 6)})
+        return summary
+
+    def report(self):
+        """
+        Отчёт прогона для JSON, XCom и журналов.
+
+        Возвращает:
+            dict: Время начала, общее время и метрики этапов в порядке их первого запуска
+        """
+        for name, profiler in self._profilers.items():
+            self.stages[name].profile = self._profile_summary(name, profiler)
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'wall_seconds': round((datetime.now() - self.started).total_seconds(), 6),
+            'stages': [stage.as_dict() for stage in self.stages.values()],
+        }
+
+    def save(self, path):
+        """Запись отчёта в JSON (атомарно, как у WatermarkStore)."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def lines(self):
+        """Краткая сводка по этапам для print или logging."""
+        result = []
+        for stage in self.stages.values():
+            line = (f"{stage.name}: {stage.wall_seconds:.2f} с (CPU {stage.cpu_seconds:.2f} с), "
+                    f"строк {stage.rows_in} -> {stage.rows_out}")
+            if stage.rows_rejected:
+                line += f", отброшено {stage.rows_rejected}"
+            if stage.bytes:
+                line += f", {stage.bytes / 2 ** 20:.1f} МиБ"
+            result.append(line)
+            for name, statement in stage.statements.items():
+                result.append(f"    {name}: {statement['seconds']:.2f} с, строк {statement['rows']}")
+        return result
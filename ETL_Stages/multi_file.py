@@ -0,0 +1,170 @@
+import glob
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ETL_Stages.prepare import prepare_frame, REQUIRED_COLUMNS, COLUMN_CASTS
+from ETL_Stages.readers import iter_chunks, DEFAULT_CHUNK_SIZE, SOURCE_SUFFIXES
+from ETL_Stages.handoff import StagingFileWriter, iter_staging_file
+from ETL_Stages.quality import Quarantine
+
+DEFAULT_LEDGER_PATH = 'ingest_files.json'
+# Разбор Excel упирается в процессор: по процессу на ядро
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+def source_files(pattern):
+    """
+    Исходные файлы по каталогу или шаблону glob.
+
+    Из каталога берутся файлы поддерживаемых форматов (SOURCE_SUFFIXES),
+    временные файлы Excel (~$...) пропускаются.
+
+    Возвращает:
+        list: Пути файлов в алфавитном порядке
+
+    Исключения:
+        ValueError: Если по pattern не найдено ни одного файла
+    """
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)
+                 if os.path.splitext(name)[1].lower() in SOURCE_SUFFIXES]
+    else:
+        paths = glob.glob(pattern)
+    paths = sorted(path for path in paths if os.path.isfile(path) and not os.path.basename(path).startswith('~$'))
+    if not paths:
+        raise ValueError(f"Не найдено исходных файлов: {pattern}")
+    return paths
+
+
+class FileLedger:
+    """
+    Состояние файлов прогона в локальном JSON-файле.
+
+    Для каждого файла хранятся статус (pending, parsed, loaded, failed),
+    число подготовленных и отброшенных строк, время разбора и ошибка.
+    Файл перезаписывается атомарно, как в PartitionLedger; без path
+    состояние хранится только в памяти.
+    """
+
+    def __init__(self, path=DEFAULT_LEDGER_PATH):
+        self._path = path
+        self._files = {}
+
+    def start(self, paths):
+        self._files = {path: {'status': 'pending', 'rows': 0, 'rejected': 0, 'seconds': None, 'error': None}
+                       for path in paths}
+
+    def mark(self, path, status, **fields):
+        self._files[path]['status'] = status
+        self._files[path].update(fields)
+
+    def failed(self):
+        """Пары (файл, ошибка) для файлов, которые не удалось разобрать."""
+        return [(path, state['error']) for path, state in self._files.items() if state['status'] == 'failed']
+
+    def summary(self):
+        files = self._files.values()
+        return {
+            'files': len(self._files),
+            'loaded': sum(state['status'] == 'loaded' for state in files),
+            'failed': sum(state['status'] == 'failed' for state in files),
+            'rows': sum(state['rows'] for state in files if state['status'] == 'loaded'),
+            'rejected': sum(state['rejected'] for state in files),
+        }
+
+    def files(self):
+        return {path: dict(state) for path, state in self._files.items()}
+
+    def save(self):
+        if not self._path:
+            return
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'files': self._files, 'summary': self.summary()}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._path)
+
+
+def parse_file(path, staging_path, chunk_size=DEFAULT_CHUNK_SIZE, required_columns=REQUIRED_COLUMNS,
+               casts=COLUMN_CASTS, rules=None):
+    """
+    Разбор и подготовка одного файла в отдельном процессе.
+
+    Подготовленные порции пишутся в файл Arrow IPC staging_path (формат
+    handoff), а не возвращаются через канал процесса: родитель читает их
+    без копирования. Отклонённые строки процесс пишет в quarantine сам.
+
+    Возвращает:
+        dict: Результат StagingFileWriter.close(), счётчики карантина и время разбора
+    """
+    # Импорт внутри процесса: соединения родительского процесса не наследуются
+    from DBMS_Classes.PostgreSQLDatabase import new_connection
+
+    start = time.perf_counter()
+    quarantine = Quarantine(new_connection, source=path)
+    with StagingFileWriter(staging_path) as writer:
+        for df in iter_chunks(path, chunk_size):
+            prepared = prepare_frame(df, required_columns, casts, rules)
+            quarantine.add('prepare', prepared.quarantine)
+            writer.write(prepared)
+        staged = writer.close()
+    quarantine.flush()
+    staged['quarantine'] = dict(quarantine.counts)
+    staged['seconds'] = time.perf_counter() - start
+    return staged
+
+
+def ingest_files(paths, ledger, workers=DEFAULT_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 required_columns=REQUIRED_COLUMNS, casts=COLUMN_CASTS, rules=None,
+                 staging_dir=None, quarantine=None):
+    """
+    Подготовленные порции нескольких файлов, разбираемых параллельно процессами.
+
+    Файлы разбираются в workers процессах (parse_file), порции файла
+    отдаются, как только он разобран, поэтому загрузка в temp_data идёт
+    одновременно с разбором остальных файлов. Порции помечены исходным
+    файлом (PreparedData.source). Файл, который не удалось прочитать или
+    подготовить, отмечается в ledger как failed и пропускается, остальные
+    загружаются. Файл отмечается loaded, когда потребитель взял его
+    последнюю порцию.
+
+    Счётчики отклонённых строк процессов добавляются в quarantine
+    (Quarantine.merge), если он задан.
+    """
+    ledger.start(paths)
+    ledger.save()
+    # spawn: дочерние процессы не получают копий открытых соединений
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='ingest_', dir=staging_dir) as directory:
+        executor = ProcessPoolExecutor(max_workers=max(1, min(workers, len(paths))), mp_context=context)
+        try:
+            futures = {executor.submit(parse_file, path, os.path.join(directory, f"{index:05d}.arrow"),
+                                       chunk_size, required_columns, casts, rules): path
+                       for index, path in enumerate(paths)}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    staged = future.result()
+                except Exception as e:
+                    ledger.mark(path, 'failed', error=f"{type(e).__name__}: {e}")
+                    ledger.save()
+                    continue
+                if quarantine is not None:
+                    quarantine.merge(staged['quarantine'])
+                ledger.mark(path, 'parsed', rows=staged['rows'], rejected=staged['rejected'],
+                            seconds=round(staged['seconds'], 3))
+
+                # Отброшенные при подготовке строки учитываются в первой порции, как в ParseCache.load
+                rejected = staged['rejected']
+                for prepared in iter_staging_file(staged['path'], staged['sha256']):
+                    prepared.rejected, rejected = rejected, 0
+                    prepared.source = path
+                    yield prepared
+                os.remove(staged['path'])
+                ledger.mark(path, 'loaded')
+                ledger.save()
+        finally:
+            # Если загрузка прервана, ещё не начатые файлы не разбираются
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,255 @@
+from collections import OrderedDict
+from datetime import datetime
+import pandas as pd
+import SQL_Requests.postgresql_query as query
+import SQL_Requests.registry as registry
+from ETL_Stages.prepare import PreparedData
+from ETL_Stages.staging import coerce_columns
+
+DEFAULT_CACHE_SIZE = 1_000_000
+
+# Нулевые даты, которые insert_into_tmp_table заменяет на NULL
+_EPOCH = datetime(1970, 1, 1)
+
+
+class KeyCache:
+    """Натуральный ключ -> суррогатный id с вытеснением давно не использованных ключей."""
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, key):
+        surrogate_id = self._ids.get(key)
+        if surrogate_id is not None:
+            self._ids.move_to_end(key)
+        return surrogate_id
+
+    def put(self, key, surrogate_id):
+        self._ids[key] = surrogate_id
+        self._ids.move_to_end(key)
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+
+
+class Dimension:
+    """
+    Таблица измерения с кэшем ключей.
+
+    Ключи, которых нет в кэше, ищутся в базе одним запросом на пачку,
+    отсутствующие в базе добавляются одним INSERT ... RETURNING. Запросы
+    задаются именами в реестре SQL_Requests.registry.
+    """
+
+    def __init__(self, name, load_sql, select_sql, insert_sql, maxsize=DEFAULT_CACHE_SIZE):
+        self.name = name
+        self.cache = KeyCache(maxsize)
+        self._load_sql = load_sql
+        self._select_sql = select_sql
+        self._insert_sql = insert_sql
+
+    @staticmethod
+    def _ids(rows):
+        return {tuple(row[:-1]): row[-1] for row in rows}
+
+    def load(self, cur):
+        registry.execute(cur, self._load_sql, (self.cache.maxsize,))
+        for key, surrogate_id in self._ids(cur.fetchall()).items():
+            self.cache.put(key, surrogate_id)
+
+    def _select(self, cur, keys):
+        registry.execute(cur, self._select_sql, [list(column) for column in zip(*keys)])
+        return self._ids(cur.fetchall())
+
+    def _insert(self, cur, records):
+        registry.execute(cur, self._insert_sql, [list(column) for column in zip(*records)])
+        return self._ids(cur.fetchall())
+
+    def resolve(self, cur, keys, records=None):
+        """
+        id для ключей keys; ключи из records, которых нет в базе, добавляются.
+
+        keys - кортежи натуральных ключей, records - {ключ: значения колонок INSERT}.
+
+        Возвращает:
+            dict: {ключ: id} для найденных и добавленных ключей
+        """
+        records = records or {}
+        ids = {}
+        missing = []
+        for key in keys:
+            surrogate_id = self.cache.get(key)
+            if surrogate_id is None:
+                missing.append(key)
+            else:
+                ids[key] = surrogate_id
+        if not missing:
+            return ids
+
+        found = self._select(cur, missing)
+        new_keys = [key for key in missing if key not in found and key in records]
+        if new_keys:
+            found.update(self._insert(cur, [records[key] for key in new_keys]))
+            # Ключи, добавленные параллельно другим загрузчиком, ищутся повторно
+            lost = [key for key in new_keys if key not in found]
+            if lost:
+                found.update(self._select(cur, lost))
+
+        for key, surrogate_id in found.items():
+            self.cache.put(key, surrogate_id)
+        ids.update(found)
+        return ids
+
+
+def _nullif(series, value):
+    return series.where(series.isna() | (series != value), None)
+
+
+def _keys(df, columns):
+    return list(df[columns].itertuples(index=False, name=None))
+
+
+def _records(df, key_columns, value_columns):
+    df = df.drop_duplicates(key_columns)
+    return dict(zip(_keys(df, key_columns), _keys(df, value_columns)))
+
+
+def _attach(df, ids, key_columns, id_column):
+    # Колонка id по натуральному ключу; строки без id получают None
+    if not ids:
+        df[id_column] = None
+        return df
+    ids_df = pd.DataFrame([key + (surrogate_id,) for key, surrogate_id in ids.items()],
+                          columns=key_columns + [id_column])
+    # object, чтобы id не превращались в float из-за строк без пары
+    ids_df = ids_df.astype(object)
+    merged = df.merge(ids_df, how='left', on=key_columns)
+    merged[id_column] = merged[id_column].astype(object).where(merged[id_column].notna(), None)
+    return merged
+
+
+class Normalizer:
+    """
+    Заполнение нормализованных таблиц во время потоковой загрузки.
+
+    Вместо соединений temp_data со справочниками (insert_into_tmp_table)
+    внешние ключи разрешаются по кэшам натуральных ключей, а строки
+    sale_items записываются бинарным COPY. Правила отбора строк те же,
+    что и в insert_into_tmp_table; продавец ищется по имени и филиалу.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.branches = Dimension('branches', 'load_branch_ids', 'select_branch_ids',
+                                  'insert_branches_returning', maxsize)
+        self.salesmen = Dimension('salesmen', 'load_salesman_ids', 'select_salesman_ids',
+                                  'insert_salesmen_returning', maxsize)
+        self.clients = Dimension('clients', 'load_client_ids', 'select_client_ids',
+                                 'insert_clients_returning', maxsize)
+        self.brands = Dimension('brands', 'load_brand_ids', 'select_brand_ids',
+                                'insert_brands_returning', maxsize)
+        self.categories = Dimension('categories', 'load_category_ids', 'select_category_ids',
+                                    'insert_categories_returning', maxsize)
+        self.items = Dimension('items', 'load_item_ids', 'select_item_ids',
+                               'insert_items_returning', maxsize)
+        self.sales = Dimension('sales', 'load_sale_ids', 'select_sale_ids',
+                               'insert_sales_returning', maxsize)
+
+    def dimensions(self):
+        return [self.branches, self.salesmen, self.clients, self.brands,
+                self.categories, self.items, self.sales]
+
+    def load(self, cur):
+        """Начальное заполнение кэшей ключами, уже записанными в базу."""
+        for dimension in self.dimensions():
+            dimension.load(cur)
+
+    def process(self, cur, prepared):
+        """
+        Нормализация одной порции: справочники, sales и sale_items.
+
+        Возвращает:
+            int: Количество строк, записанных в sale_items
+        """
+        if not isinstance(prepared, PreparedData):
+            rows = list(prepared)
+            prepared = PreparedData(query.temp_data_columns, [list(c) for c in zip(*rows)] if rows else [])
+        if not len(prepared):
+            return 0
+        df = pd.DataFrame(dict(zip(query.temp_data_columns, coerce_columns(prepared))), dtype=object)
+
+        # branches
+        rows = df[df['BRANCHNR'].notna()]
+        insertable = rows[rows[['BRANCH', 'CITY', 'REGION']].notna().all(axis=1)].copy()
+        insertable['LATITUDE'] = _nullif(insertable['LATITUDE'], 0)
+        insertable['LONGITUDE'] = _nullif(insertable['LONGITUDE'], 0)
+        ids = self.branches.resolve(
+            cur, set(_keys(rows, ['BRANCHNR'])),
+            _records(insertable, ['BRANCHNR'],
+                     ['BRANCHNR', 'BRANCH', 'CITY', 'REGION', 'LATITUDE', 'LONGITUDE']))
+        df = _attach(df, ids, ['BRANCHNR'], 'branch_id')
+
+        # salesmen
+        rows = df[df['SALESMAN'].notna() & df['branch_id'].notna()]
+        keys = set(_keys(rows, ['SALESMAN', 'branch_id']))
+        ids = self.salesmen.resolve(cur, keys, {key: key for key in keys})
+        df = _attach(df, ids, ['SALESMAN', 'branch_id'], 'salesman_id')
+
+        # clients
+        rows = df[df['CLIENTCODE'].notna()]
+        insertable = rows[rows['CLIENTNAME'].notna()].copy()
+        insertable['GENDER'] = _nullif(insertable['GENDER'], '')
+        ids = self.clients.resolve(
+            cur, set(_keys(rows, ['CLIENTCODE'])),
+            _records(insertable, ['CLIENTCODE'], ['CLIENTCODE', 'CLIENTNAME', 'GENDER']))
+        df = _attach(df, ids, ['CLIENTCODE'], 'client_id')
+
+        # brands: пустой код в brands записывается как NULL и не связывается с товарами
+        rows = df[df['BRANDCODE'].notna() & (df['BRANDCODE'] != '')]
+        insertable = rows[rows['BRAND'].notna()].copy()
+        insertable['BRAND'] = _nullif(insertable['BRAND'], '')
+        ids = self.brands.resolve(
+            cur, set(_keys(rows, ['BRANDCODE'])),
+            _records(insertable, ['BRANDCODE'], ['BRANDCODE', 'BRAND']))
+        df = _attach(df, ids, ['BRANDCODE'], 'brand_id')
+
+        # categories: ключ - имена после тех же NULLIF, что в insert_into_tmp_table
+        df['category1'] = _nullif(df['CATEGORY_NAME1'], '')
+        df['category2'] = _nullif(_nullif(df['CATEGORY_NAME2'], ''), 'N/A')
+        df['category3'] = _nullif(_nullif(df['CATEGORY_NAME3'], ''), 'N/A')
+        category_columns = ['category1', 'category2', 'category3']
+        rows = df[df['CATEGORY_NAME1'].notna()]
+        keys = set(_keys(rows, category_columns))
+        ids = self.categories.resolve(cur, keys, {key: key for key in keys})
+        df = _attach(df, ids, category_columns, 'category_id')
+
+        # items
+        rows = df[df['ITEMCODE'].notna()]
+        insertable = rows[rows[['ITEMNAME', 'PRICE', 'brand_id', 'category_id']].notna().all(axis=1)]
+        ids = self.items.resolve(
+            cur, set(_keys(rows, ['ITEMCODE'])),
+            _records(insertable, ['ITEMCODE'], ['ITEMCODE', 'ITEMNAME', 'brand_id', 'category_id', 'PRICE']))
+        df = _attach(df, ids, ['ITEMCODE'], 'item_id')
+
+        # sales
+        rows = df[df[['FICHENO', 'DATE_']].notna().all(axis=1)]
+        insertable = rows[rows[['client_id', 'salesman_id']].notna().all(axis=1)].copy()
+        insertable['STARTDATE'] = _nullif(insertable['STARTDATE'], _EPOCH)
+        insertable['ENDDATE'] = _nullif(insertable['ENDDATE'], _EPOCH)
+        ids = self.sales.resolve(
+            cur, set(_keys(rows, ['FICHENO', 'DATE_'])),
+            _records(insertable, ['FICHENO', 'DATE_'],
+                     ['FICHENO', 'DATE_', 'client_id', 'salesman_id', 'STARTDATE', 'ENDDATE']))
+        df = _attach(df, ids, ['FICHENO', 'DATE_'], 'sale_id')
+
+        # sale_items: строки фактов без соединений, сразу через COPY
+        rows = df[df[['sale_id', 'item_id', 'AMOUNT', 'LINENETTOTAL', 'LINENET']].notna().all(axis=1)]
+        facts = [rows['sale_id'], rows['item_id'], _nullif(rows['AMOUNT'], 0),
+                 _nullif(rows['LINENETTOTAL'], 0), _nullif(rows['LINENET'], 0)]
+        with cur.copy(query.copy_sale_items) as copy:
+            copy.set_types(query.sale_items_types)
+            for row in zip(*(column.tolist() for column in facts)):
+                copy.write_row(row)
+        return len(rows)
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+import SQL_Requests.postgresql_query as query
+from ETL_Stages.prepare import prepare_frame, REQUIRED_COLUMNS, COLUMN_CASTS, RULES_VERSION
+from ETL_Stages.readers import iter_chunks, DEFAULT_CHUNK_SIZE
+from ETL_Stages.handoff import StagingFileWriter, iter_staging_file, file_checksum, STAGING_SCHEMA
+
+DEFAULT_CACHE_DIR = '.parse_cache'
+DEFAULT_MAX_BYTES = 5 * 2 ** 30
+
+_INDEX = 'index.json'
+
+
+def rules_key(required_columns=REQUIRED_COLUMNS, casts=COLUMN_CASTS, rules=None):
+    """
+    Отпечаток правил подготовки: версия логики, обязательные колонки,
+    приведения типов, правила качества и схема temp_data. Изменение любого из них делает
+    старые записи кэша недоступными.
+    """
+    fingerprint = [RULES_VERSION, sorted(required_columns), sorted(casts.items()), rules or {},
+                   query.temp_data_columns, query.temp_data_types, str(STAGING_SCHEMA)]
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class ParseCache:
+    """
+    Кэш результатов разбора и подготовки исходных файлов.
+
+    Ключ записи - SHA-256 содержимого файла и отпечаток правил подготовки
+    (rules_key), поэтому переименованный или скопированный файл тоже
+    находится в кэше. Хеш файла пересчитывается, только если изменились
+    его размер или время изменения. Записи - файлы Arrow IPC того же
+    формата, что и для передачи между задачами DAG (handoff), с уже
+    приведёнными к temp_data типами. При превышении max_bytes удаляются
+    давно не использованные записи. Разные файлы можно разбирать через
+    один кэш из нескольких потоков: индекс меняется под блокировкой.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, _INDEX)
+        self._index = {'files': {}, 'entries': {}}
+        self._lock = threading.RLock()
+        if os.path.exists(self._index_path):
+            with open(self._index_path, encoding='utf-8') as f:
+                self._index = json.load(f)
+
+    def _save(self):
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._index_path)
+
+    def content_hash(self, path):
+        """SHA-256 файла; при неизменных размере и mtime берётся из индекса."""
+        stat = os.stat(path)
+        with self._lock:
+            known = self._index['files'].get(os.path.abspath(path))
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        sha256 = file_checksum(path)
+        with self._lock:
+            self._index['files'][os.path.abspath(path)] = {
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+            self._save()
+        return sha256
+
+    def _key(self, path, required_columns, casts, rules):
+        return f"{self.content_hash(path)}-{rules_key(required_columns, casts, rules)}"
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, f"{key}.arrow")
+
+    def lookup(self, path, required_columns=REQUIRED_COLUMNS, casts=COLUMN_CASTS, rules=None):
+        """Ключ записи для файла path или None, если её нет."""
+        key = self._key(path, required_columns, casts, rules)
+        with self._lock:
+            entry = self._index['entries'].get(key)
+            if entry is None or not os.path.exists(self._entry_path(key)):
+                return None
+            entry['last_used'] = time.time()
+            self._save()
+        return key
+
+    def load(self, key):
+        """
+        Порции PreparedData из записи key; количество отброшенных при
+        разборе строк переносится в первую порцию.
+        """
+        with self._lock:
+            entry = dict(self._index['entries'][key])
+        rejected = entry['rejected']
+        for prepared in iter_staging_file(self._entry_path(key), entry['sha256']):
+            prepared.rejected, rejected = rejected, 0
+            yield prepared
+
+    def export(self, key, target):
+        """
+        Копия записи key в файл target без повторного чтения: формат записи
+        совпадает с файлом передачи между задачами (handoff).
+
+        Возвращает:
+            dict: path, sha256, rows, rejected и bytes, как StagingFileWriter.close()
+        """
+        entry = self._index['entries'][key]
+        directory = os.path.dirname(target)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        shutil.copyfile(self._entry_path(key), f"{target}.tmp")
+        os.replace(f"{target}.tmp", target)
+        return {'path': target, 'sha256': entry['sha256'], 'rows': entry['rows'],
+                'rejected': entry['rejected'], 'bytes': entry['bytes']}
+
+    @contextmanager
+    def store(self, path, required_columns=REQUIRED_COLUMNS, casts=COLUMN_CASTS, rules=None):
+        """
+        Запись нового результата разбора path: порции передаются в write()
+        возвращаемого объекта. Запись появляется в кэше, только если блок
+        завершился без ошибок. Отклонённые строки (PreparedData.quarantine)
+        не кэшируются: в карантин они попадают при первом разборе.
+        """
+        key = self._key(path, required_columns, casts, rules)
+        writer = StagingFileWriter(self._entry_path(key))
+        with writer:
+            yield writer
+            staged = writer.close()
+        with self._lock:
+            self._index['entries'][key] = {
+                'source': os.path.abspath(path), 'rows': staged['rows'], 'rejected': staged['rejected'],
+                'bytes': staged['bytes'], 'sha256': staged['sha256'], 'last_used': time.time()}
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        entries = self._index['entries']
+        total = sum(entry['bytes'] for entry in entries.values())
+        for key in sorted(entries, key=lambda name: entries[name]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key]['bytes']
+            del entries[key]
+            if os.path.exists(self._entry_path(key)):
+                os.remove(self._entry_path(key))
+
+    def chunks(self, path, chunk_size=DEFAULT_CHUNK_SIZE, required_columns=REQUIRED_COLUMNS,
+               casts=COLUMN_CASTS, rules=None):
+        """
+        Подготовленные порции файла: из кэша, если он не менялся, иначе
+        разбор iter_chunks + prepare_frame с сохранением результата в кэш.
+        """
+        key = self.lookup(path, required_columns, casts, rules)
+        if key is not None:
+            yield from self.load(key)
+            return
+        with self.store(path, required_columns, casts, rules) as writer:
+            for df in iter_chunks(path, chunk_size):
+                prepared = prepare_frame(df, required_columns, casts, rules)
+                writer.write(prepared)
+                yield prepared
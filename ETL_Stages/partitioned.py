@@ -0,0 +1,241 @@
+import json
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from psycopg import sql
+import SQL_Requests.postgresql_query as query
+import SQL_Requests.clickhouse_query as ch_query
+from ETL_Stages.transfer import iter_batches, transfer_purchases, DEFAULT_BATCH_SIZE, DEFAULT_QUEUE_SIZE
+from ETL_Stages.quality import Quarantine, TYPE_RULES
+from ETL_Stages.checkpoint import enable_deduplication
+
+DEFAULT_LEDGER_PATH = 'transfer_partitions.json'
+DEFAULT_WORKERS = 4
+# Диапазонов больше, чем процессов: освободившийся процесс берёт следующий
+PARTITIONS_PER_WORKER = 4
+
+# Колонки temp_data, по которым делятся диапазоны
+PARTITION_KEYS = ('ID', 'DATE_')
+
+
+class PartitionLedger:
+    """
+    Состояние диапазонов параллельного переноса в локальном JSON-файле.
+
+    Для каждого диапазона хранятся границы, статус (pending, done, failed),
+    число попыток и вставленных строк. Пока в журнале есть незавершённые
+    диапазоны, следующий прогон продолжает их, а не делит temp_data заново.
+    Файл перезаписывается атомарно, как в WatermarkStore.
+    """
+
+    def __init__(self, path=DEFAULT_LEDGER_PATH):
+        self._path = path
+        self._state = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._state = json.load(f)
+
+    def key(self):
+        return self._state.get('key')
+
+    def token(self, name):
+        """Токен дедупликации вставки диапазона; у журналов без идентификатора прогона - None."""
+        run = self._state.get('run')
+        return f"{run}:{name}" if run else None
+
+    def _decode(self, value):
+        if value is not None and self._state.get('key') == 'DATE_':
+            return datetime.fromisoformat(value)
+        return value
+
+    @staticmethod
+    def _encode(value):
+        return value.isoformat() if isinstance(value, datetime) else value
+
+    def start(self, key, partitions):
+        """Новый прогон: partitions - список (имя, нижняя граница, верхняя граница, только NULL)."""
+        self._state = {
+            'key': key,
+            'run': uuid.uuid4().hex,
+            'partitions': {
+                name: {'low': self._encode(low), 'high': self._encode(high), 'null': null,
+                       'status': 'pending', 'attempts': 0, 'inserted': 0, 'rejected': 0, 'error': None}
+                for name, low, high, null in partitions
+            },
+        }
+
+    def unfinished(self):
+        """Имена диапазонов, которые ещё не перенесены."""
+        return [name for name, partition in self._state.get('partitions', {}).items()
+                if partition['status'] != 'done']
+
+    def bounds(self, name):
+        partition = self._state['partitions'][name]
+        return self._decode(partition['low']), self._decode(partition['high']), partition['null']
+
+    def mark(self, name, status, inserted=0, rejected=0, error=None):
+        partition = self._state['partitions'][name]
+        partition['status'] = status
+        partition['attempts'] += 1
+        partition['inserted'] = inserted
+        partition['rejected'] = rejected
+        partition['error'] = error
+
+    def summary(self):
+        partitions = self._state.get('partitions', {}).values()
+        return {
+            'done': sum(partition['status'] == 'done' for partition in partitions),
+            'failed': sum(partition['status'] == 'failed' for partition in partitions),
+            'inserted': sum(partition['inserted'] for partition in partitions),
+            'rejected': sum(partition['rejected'] for partition in partitions),
+        }
+
+    def save(self):
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._path)
+
+
+def _check_partition_key(key):
+    if key not in PARTITION_KEYS:
+        raise ValueError(f"Неизвестный ключ диапазонов: {key}, ожидается один из {PARTITION_KEYS}")
+
+
+def plan_partitions(conn, key='DATE_', count=DEFAULT_WORKERS * PARTITIONS_PER_WORKER):
+    """
+    Деление temp_data на непересекающиеся диапазоны key по квантилям,
+    чтобы в диапазонах было примерно поровну строк.
+
+    Возвращает:
+        list: (имя, нижняя граница, верхняя граница или None, только NULL);
+            последний диапазон открыт сверху, отдельный диапазон - строки с NULL в key
+    """
+    _check_partition_key(key)
+    statement = sql.SQL(query.select_partition_bounds).format(key=sql.Identifier(key.lower()))
+    with conn.cursor() as cur:
+        cur.execute(statement, {'fractions': [i / count for i in range(count)]})
+        bounds = [row[0] for row in cur.fetchall()]
+    # Процессы читают temp_data своими соединениями: она должна быть зафиксирована
+    conn.commit()
+
+    partitions = [(f"p{i:04d}", low, high, False)
+                  for i, (low, high) in enumerate(zip(bounds, bounds[1:] + [None]))]
+    partitions.append(('null', None, None, True))
+    return partitions
+
+
+def _partition_source(key, low, high, null):
+    if null:
+        template, params = query.select_purchases_source_null, None
+    elif high is None:
+        template, params = query.select_purchases_source_from, {'low': low}
+    else:
+        template, params = query.select_purchases_source_range, {'low': low, 'high': high}
+    return sql.SQL(template).format(key=sql.Identifier(key.lower())), params
+
+
+def transfer_partition(name, key, low, high, null, batch_size=DEFAULT_BATCH_SIZE,
+                       queue_size=DEFAULT_QUEUE_SIZE, rules=TYPE_RULES, token=None):
+    """
+    Перенос одного диапазона в отдельном процессе со своими соединениями.
+
+    Строки пишутся в промежуточную таблицу purchases_part_<имя> и переносятся
+    в purchases одним INSERT ... SELECT, поэтому упавший диапазон не оставляет
+    в purchases части строк и может быть повторён. У этой вставки токен
+    дедупликации token (прогон и диапазон): если процесс упал после неё,
+    но до отметки в журнале, повтор диапазона не задвоит строки.
+    Отклонённые по rules строки процесс пишет в quarantine сам.
+
+    Возвращает:
+        dict: Статистика переноса диапазона (см. transfer_purchases) и
+            сводка отклонённых строк (quarantine, Quarantine.counts)
+    """
+    # Импорт внутри процесса: соединения родительского процесса не наследуются
+    import clickhouse_connect
+    from DBMS_Classes.PostgreSQLDatabase import new_connection
+    from DBMS_Classes.ClickHouseClientPool import client_settings
+
+    table = f"purchases_part_{name}"
+    statement, params = _partition_source(key, low, high, null)
+    conn = new_connection()
+    client = clickhouse_connect.get_client(**client_settings())
+    quarantine = Quarantine(new_connection, source=f"partition {name}")
+    try:
+        client.command(f"DROP TABLE IF EXISTS {table}")
+        client.command(ch_query.create_purchases_part.format(table=table))
+        batches = iter_batches(conn, batch_size, statement, params)
+        stats = transfer_purchases(conn, client, batch_size, queue_size, batches=batches, table=table,
+                                   rules=rules, quarantine=quarantine)
+        quarantine.flush()
+        if stats['inserted']:
+            settings = {'max_partitions_per_insert_block': 0}
+            if token is not None:
+                enable_deduplication(client)
+                settings.update({'insert_deduplicate': 1, 'insert_deduplication_token': token,
+                                 'deduplicate_blocks_in_dependent_materialized_views': 1})
+            client.command(ch_query.copy_purchases_part.format(source=table), settings=settings)
+        client.command(f"DROP TABLE {table}")
+        stats['touched'] = len(stats['touched'])
+        stats['quarantine'] = dict(quarantine.counts)
+        return stats
+    finally:
+        conn.close()
+        client.close()
+
+
+def transfer_partitioned(conn, ledger, key='DATE_', workers=DEFAULT_WORKERS, partitions=None,
+                         batch_size=DEFAULT_BATCH_SIZE, retries=1, rules=TYPE_RULES, quarantine=None):
+    """
+    Параллельный перенос temp_data в purchases по диапазонам key.
+
+    Каждый диапазон читается, преобразуется и вставляется отдельным
+    процессом. Результат каждого диапазона записывается в журнал ledger:
+    упавшие диапазоны повторяются до retries раз, а если журнал остался
+    с незавершёнными диапазонами, следующий вызов переносит только их.
+    Отклонённые строки процессы пишут в quarantine сами, их сводка
+    добавляется в quarantine (Quarantine.merge), если он задан.
+
+    Возвращает:
+        dict: Количество перенесённых и упавших диапазонов, вставленных и отброшенных строк
+
+    Исключения:
+        ValueError: Если key не входит в PARTITION_KEYS или журнал ведётся по другому ключу
+        RuntimeError: Если после всех попыток остались упавшие диапазоны
+    """
+    _check_partition_key(key)
+    if ledger.unfinished():
+        if ledger.key() != key:
+            raise ValueError(f"Журнал диапазонов ведётся по {ledger.key()}, а не по {key}")
+    else:
+        ledger.start(key, plan_partitions(conn, key, partitions or workers * PARTITIONS_PER_WORKER))
+        ledger.save()
+
+    # spawn: дочерние процессы не получают копий открытых соединений и пулов
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        for _ in range(retries + 1):
+            pending = ledger.unfinished()
+            if not pending:
+                break
+            futures = {executor.submit(transfer_partition, name, key, *ledger.bounds(name), batch_size,
+                                       DEFAULT_QUEUE_SIZE, rules, ledger.token(name)): name
+                       for name in pending}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    stats = future.result()
+                    ledger.mark(name, 'done', stats['inserted'], stats['rejected'])
+                    if quarantine is not None:
+                        quarantine.merge(stats['quarantine'])
+                except Exception as e:
+                    ledger.mark(name, 'failed', error=str(e))
+                ledger.save()
+
+    summary = ledger.summary()
+    failed = ledger.unfinished()
+    if failed:
+        raise RuntimeError(f"Не перенесены диапазоны {failed}; повторный запуск продолжит с них")
+    return summary
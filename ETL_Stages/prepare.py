@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import SQL_Requests.postgresql_query as query
+from ETL_Stages.quality import check_frame, quarantine_frame
+
+# Колонки, без которых файл не может быть загружен
+REQUIRED_COLUMNS = ['CLIENTCODE', 'GENDER', 'PRICE', 'AMOUNT', 'DATE_']
+
+# Приведение типов, которое раньше выполнялось построчно через int()/float()
+COLUMN_CASTS = {
+    'CLIENTCODE': 'int',
+    'PRICE': 'float',
+    'AMOUNT': 'float',
+}
+
+# Версия правил подготовки: увеличивается при любом изменении логики
+# prepare_frame, чтобы кэш разбора (parse_cache) не отдавал старый результат
+RULES_VERSION = 2
+
+
+class PreparedData:
+    """
+    Результат подготовки: данные по колонкам в порядке temp_data.
+
+    data[i] - список значений колонки columns[i], пропуски заменены на None.
+    rejected - количество строк, отброшенных из-за ошибок приведения типов
+    или проверок качества, quarantine - сами эти строки с кодами причин
+    (ETL_Stages.quality.quarantine_frame) или None. source - исходный файл
+    порции, если порции идут из нескольких файлов.
+    """
+
+    def __init__(self, columns, data, rejected=0, quarantine=None, source=None):
+        self.columns = columns
+        self.data = data
+        self.rejected = rejected
+        self.quarantine = quarantine
+        self.source = source
+
+    def __len__(self):
+        return len(self.data[0]) if self.data else 0
+
+    def rows(self):
+        """Кортежи строк в формате параметров insert_query1."""
+        return list(zip(*self.data))
+
+
+def _to_python(series):
+    # NaN/NaT -> None, значения приводятся к объектам Python целой колонкой
+    if series.dtype.kind == 'M':
+        # to_pydatetime заметно быстрее, чем astype(object) в Timestamp
+        values = pd.Series(np.asarray(series.dt.to_pydatetime(), dtype=object), index=series.index)
+    else:
+        values = series.astype(object)
+    return values.where(series.notna(), None)
+
+
+def prepare_frame(df, required_columns=REQUIRED_COLUMNS, casts=COLUMN_CASTS, rules=None):
+    """
+    Подготовка DataFrame к загрузке в temp_data без построчного цикла.
+
+    Проверяет обязательные колонки, приводит типы колонок из casts,
+    проверяет колонки по правилам rules (см. ETL_Stages.quality.quality_rules),
+    заменяет пропуски на None и отбрасывает строки, не прошедшие приведение
+    типов или проверки. Их количество сохраняется в PreparedData.rejected,
+    а сами строки с кодами причин - в PreparedData.quarantine.
+
+    Исключения:
+        ValueError: Если в DataFrame нет обязательных колонок
+    """
+    missing = set(required_columns) - set(df.columns)
+    if missing:
+        raise ValueError(f"В файле отсутствуют обязательные колонки: {missing}")
+
+    columns = query.temp_data_columns
+    df = df.reindex(columns=columns)
+
+    checks = {column: {'cast': cast} for column, cast in casts.items()}
+    for column, rule in (rules or {}).items():
+        checks[column] = {**checks.get(column, {}), **rule}
+    values, failed_columns, reasons = check_frame(df, checks)
+
+    prepared = {}
+    for column in columns:
+        if checks.get(column, {}).get('cast') in ('int', 'float'):
+            # Числовые приведения уже дают объекты Python и None
+            prepared[column] = values[column]
+        else:
+            prepared[column] = _to_python(values.get(column, df[column]))
+
+    keep = pd.isna(reasons)
+    data = [prepared[column].to_numpy()[keep].tolist() for column in columns]
+    return PreparedData(columns, data, int((~keep).sum()), quarantine_frame(df, failed_columns, reasons))
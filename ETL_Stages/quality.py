@@ -0,0 +1,307 @@
+import threading
+from collections import Counter
+import numpy as np
+import pandas as pd
+import SQL_Requests.postgresql_query as query
+
+# Коды причин в порядке проверки: для строки записывается первая сработавшая
+# null - пропуск в обязательной колонке, type - значение не приводится к числу,
+# timestamp - значение не разбирается как дата и время, range - вне min/max,
+# domain - значение не из списка допустимых
+REASONS = ('null', 'type', 'timestamp', 'range', 'domain')
+
+GENDER_VALUES = ('M', 'F')
+
+# Сколько отклонённых строк копится перед записью в quarantine
+DEFAULT_FLUSH_ROWS = 10_000
+
+# Строки, которые int() принимает без ошибки
+_INT_STRING = r'\s*[+-]?\d+\s*'
+
+
+def quality_rules(gender_values=GENDER_VALUES):
+    """
+    Правила проверки колонок, из которых строится purchases.
+
+    Правило колонки - dict: cast ('int', 'float' или 'timestamp'),
+    nullable (по умолчанию True), min и max, domain - допустимые значения.
+    """
+    return {
+        'CLIENTCODE': {'cast': 'int', 'nullable': False},
+        'GENDER': {'nullable': False, 'domain': tuple(gender_values)},
+        'PRICE': {'cast': 'float', 'nullable': False, 'min': 0},
+        'AMOUNT': {'cast': 'float', 'nullable': False},
+        'DATE_': {'cast': 'timestamp', 'nullable': False},
+    }
+
+
+QUALITY_RULES = quality_rules()
+
+# Правила переноса без проверок качества: строка отбрасывается в карантин,
+# если clientcode, price, amount или date_ пусты или не приводятся к типам
+# purchases; gender и знак цены не проверяются. В отличие от прежнего
+# построчного переноса, строка с пустой или неразборчивой датой теперь
+# попадает в карантин, а не получает дату now()
+TYPE_RULES = {
+    'CLIENTCODE': {'cast': 'int', 'nullable': False},
+    'PRICE': {'cast': 'float', 'nullable': False},
+    'AMOUNT': {'cast': 'float', 'nullable': False},
+    'DATE_': {'cast': 'timestamp', 'nullable': False},
+}
+
+
+def _numeric(series):
+    # Числа, которые удалось получить из значения колонки, и маска
+    # значений, на которых int()/float() выбросили бы исключение
+    numeric = pd.to_numeric(series, errors='coerce')
+    if series.dtype == bool:
+        numeric = numeric.astype('float64')
+    bad = numeric.isna() | ~np.isfinite(numeric.astype('float64'))
+    return numeric, bad
+
+
+def _is_text(series):
+    # Строки из CSV в pandas 3 читаются в dtype str, а не object
+    return pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
+
+
+def _cast_int(series, notnull):
+    numeric, bad = _numeric(series)
+    if _is_text(series):
+        # int('1.5') - ошибка, хотя int(1.5) == 1
+        try:
+            matches = series.str.fullmatch(_INT_STRING)
+        except AttributeError:
+            pass
+        else:
+            bad |= matches.eq(False)
+    bad &= notnull
+    valid = notnull & ~bad
+    if series.dtype.kind in 'iub':
+        ints = numeric.where(valid, 0).astype('int64')
+    else:
+        ints = np.trunc(numeric.where(valid, 0).astype('float64')).astype('int64')
+    return ints.astype(object).where(valid, None), bad
+
+
+def _cast_float(series, notnull):
+    numeric, bad = _numeric(series)
+    bad &= notnull
+    valid = notnull & ~bad
+    return numeric.astype('float64').astype(object).where(valid, None), bad
+
+
+def _cast_timestamp(series, notnull):
+    if series.dtype.kind == 'M':
+        return series, pd.Series(False, index=series.index)
+    values = pd.to_datetime(series, errors='coerce')
+    return values, values.isna() & notnull
+
+
+_CASTS = {
+    'int': _cast_int,
+    'float': _cast_float,
+    'timestamp': _cast_timestamp,
+}
+
+_CAST_REASONS = {
+    'int': 'type',
+    'float': 'type',
+    'timestamp': 'timestamp',
+}
+
+
+def cast_column(series, cast):
+    """
+    Приведение колонки к 'int' или 'float' так, как это сделали бы int()/float(),
+    или к 'timestamp' через pd.to_datetime.
+
+    Возвращает:
+        tuple: (значения с None (NaT) на месте пропусков, маска значений с ошибкой приведения)
+    """
+    return _CASTS[cast](series, series.notna())
+
+
+def _present(series):
+    # Пустая строка в обязательной колонке - такой же пропуск, как NULL
+    present = series.notna()
+    if _is_text(series):
+        present &= series.astype(str).str.strip().ne('')
+    return present
+
+
+def check_column(series, rule):
+    """
+    Проверка колонки по правилу целиком, без цикла по строкам.
+
+    Возвращает:
+        tuple: (значения после приведения типа, список пар (код причины, маска строк))
+    """
+    failures = []
+    if not rule.get('nullable', True):
+        failures.append(('null', ~_present(series)))
+    values = series
+    cast = rule.get('cast')
+    if cast is not None:
+        values, bad = cast_column(series, cast)
+        failures.append((_CAST_REASONS[cast], bad))
+    if 'min' in rule or 'max' in rule:
+        numeric = pd.to_numeric(values, errors='coerce')
+        out = pd.Series(False, index=series.index)
+        if 'min' in rule:
+            out |= numeric < rule['min']
+        if 'max' in rule:
+            out |= numeric > rule['max']
+        failures.append(('range', out))
+    if 'domain' in rule:
+        failures.append(('domain', series.notna() & ~series.isin(rule['domain'])))
+    return values, failures
+
+
+def check_frame(df, rules):
+    """
+    Проверка колонок DataFrame по правилам rules ({колонка: правило}).
+
+    Для каждой строки запоминается первая нарушенная проверка: колонка и
+    код причины (REASONS). Колонки без правила не проверяются.
+
+    Возвращает:
+        tuple: (dict значений проверенных колонок после приведения типа,
+            массив колонок первой ошибки и массив кодов причин; None - строка прошла)
+    """
+    values = {}
+    column = np.full(len(df), None, dtype=object)
+    reason = np.full(len(df), None, dtype=object)
+    for name, rule in rules.items():
+        values[name], failures = check_column(df[name], rule)
+        for code, mask in failures:
+            fill = mask.to_numpy(dtype=bool) & pd.isna(reason)
+            column[fill] = name
+            reason[fill] = code
+    return values, column, reason
+
+
+def quarantine_frame(df, column, reason):
+    """
+    Отклонённые строки df в формате таблицы quarantine: номер строки в
+    порции, колонка и причина первой ошибки, её значение и вся строка в JSON.
+
+    Возвращает:
+        pandas.DataFrame или None, если отклонённых строк нет
+    """
+    rejected = pd.notna(reason)
+    if not rejected.any():
+        return None
+    bad = df[rejected]
+    column = column[rejected]
+    value = np.full(len(bad), None, dtype=object)
+    for name in pd.unique(column):
+        selected = column == name
+        raw = bad[name].to_numpy()[selected]
+        value[selected] = [None if pd.isna(item) else str(item) for item in raw]
+    records = bad.to_json(orient='records', lines=True, date_format='iso',
+                          default_handler=str, force_ascii=False).splitlines()
+    return pd.DataFrame({
+        'row_number': bad.index.to_numpy(),
+        'column_name': column,
+        'reason': reason[rejected],
+        'value': value,
+        'record': records,
+    })
+
+
+def write_quarantine(cur, stage, source, frame):
+    """Запись строк quarantine_frame одним COPY."""
+    with cur.copy(query.copy_quarantine) as copy:
+        for row_number, column, reason, value, record in frame.itertuples(index=False, name=None):
+            copy.write_row((stage, source, int(row_number), column, reason, value, record))
+
+
+class Quarantine:
+    """
+    Отклонённые проверками качества строки и сводка по причинам.
+
+    Строки копятся и пишутся в quarantine пачками по flush_rows через COPY
+    в отдельном соединении (connect/release, например connection_source()),
+    поэтому карантин сохраняется, даже если загрузка откатывается. Без
+    connect ведётся только сводка. add() можно вызывать из нескольких потоков.
+    """
+
+    def __init__(self, connect=None, release=None, source=None, flush_rows=DEFAULT_FLUSH_ROWS):
+        self.source = source
+        self.counts = Counter()
+        self._connect = connect
+        self._release = release or (lambda conn: conn.close())
+        self._flush_rows = flush_rows
+        self._pending = []
+        self._pending_rows = 0
+        self._created = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    @property
+    def rejected(self):
+        return sum(self.counts.values())
+
+    def add(self, stage, frame):
+        """Учёт строк quarantine_frame, отклонённых на этапе stage."""
+        if frame is None or not len(frame):
+            return
+        counts = frame.groupby(['column_name', 'reason']).size()
+        with self._lock:
+            for (column, reason), count in counts.items():
+                self.counts[(stage, column, reason)] += int(count)
+            if self._connect is None:
+                return
+            self._pending.append((stage, frame))
+            self._pending_rows += len(frame)
+            if self._pending_rows >= self._flush_rows:
+                self._flush()
+
+    def merge(self, counts):
+        """Учёт строк, которые записал в quarantine другой процесс (его Quarantine.counts)."""
+        with self._lock:
+            self.counts.update(counts)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                if not self._created:
+                    cur.execute(query.create_quarantine)
+                    self._created = True
+                for stage, frame in self._pending:
+                    write_quarantine(cur, stage, self.source, frame)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+        self._pending = []
+        self._pending_rows = 0
+
+    def summary(self):
+        """
+        Сводка отклонённых строк.
+
+        Возвращает:
+            dict: {'этап.колонка.причина': количество строк}
+        """
+        return {f"{stage}.{column}.{reason}": count
+                for (stage, column, reason), count in sorted(self.counts.items())}
+
+    def lines(self):
+        """Одна строка на этап, колонку и причину вместо строки на каждую запись."""
+        return [f"Отклонено {name}: {count}" for name, count in self.summary().items()]
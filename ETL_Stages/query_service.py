@@ -0,0 +1,205 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import date, datetime
+import SQL_Requests.clickhouse_query as ch_query
+from ETL_Stages.rollups import table_engine, has_column
+
+# Сколько секунд результат живёт в кэше и сколько результатов хранится
+DEFAULT_TTL = 300
+DEFAULT_MAXSIZE = 1024
+
+# Как часто (в секундах) проверяется версия данных в system.parts
+DEFAULT_PROBE_INTERVAL = 5.0
+
+# Таблицы, изменение которых сбрасывает кэш
+DATA_TABLES = ('purchases', 'date_purchases', 'date_purchases_by_gender',
+               'date_purchases_state', 'date_purchases_by_gender_state')
+
+# Кэши всех сервисов процесса: invalidate_all() сбрасывает их после загрузки
+_caches = weakref.WeakSet()
+
+
+class QueryCache:
+    """
+    Результаты запросов с ограничением по времени жизни (ttl) и числу
+    записей (maxsize): при переполнении вытесняются давно не
+    использованные. Безопасен для нескольких потоков.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, maxsize=DEFAULT_MAXSIZE, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        """
+        Возвращает:
+            tuple: (найден ли живой результат, результат или None)
+        """
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    del self._values[key]
+                self.misses += 1
+                return False, None
+            self._values.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._values[key] = (self._clock() + self.ttl, value)
+            self._values.move_to_end(key)
+            if len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+def invalidate_all():
+    """Сброс кэшей запросов всех сервисов процесса; вызывается после загрузки."""
+    for cache in list(_caches):
+        cache.clear()
+
+
+def _day_aligned(value):
+    # Дневные агрегаты отвечают только на диапазоны из целых дней
+    if value is None:
+        return True
+    if isinstance(value, datetime):
+        return value == datetime.combine(value.date(), datetime.min.time(), value.tzinfo)
+    return isinstance(value, date)
+
+
+def _where(conditions):
+    return f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+
+class PurchasesQueries:
+    """
+    Запросы итогов по purchases, date_purchases и date_purchases_by_gender.
+
+    Диапазон дат полуоткрытый: start включается, end - нет; даты
+    трактуются в часовом поясе сервера ClickHouse, как и day в агрегатах.
+    Если запрос не зависит от клиента и диапазон состоит из целых дней,
+    он читает дневные агрегаты (по полу - date_purchases_by_gender), иначе
+    сканирует purchases. Результаты кэшируются (QueryCache) по запросу и
+    параметрам. Кэш сбрасывается, когда меняется версия данных в
+    system.parts (проверяется не чаще раза в probe_interval секунд), и
+    при вызове invalidate_all() после загрузки в этом процессе.
+    """
+
+    def __init__(self, client, ttl=DEFAULT_TTL, maxsize=DEFAULT_MAXSIZE,
+                 probe_interval=DEFAULT_PROBE_INTERVAL, use_rollups=True, clock=time.monotonic):
+        self.client = client
+        self.cache = QueryCache(ttl, maxsize, clock)
+        self.use_rollups = use_rollups
+        self._probe_interval = probe_interval
+        self._clock = clock
+        self._version = None
+        self._probed_at = None
+        self._rollups = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.cache.clear()
+            self._rollups = None
+
+    def _check_version(self):
+        # Версия данных - число частей, строк и время последнего изменения по таблицам
+        with self._lock:
+            now = self._clock()
+            if self._probed_at is not None and now - self._probed_at < self._probe_interval:
+                return
+            self._probed_at = now
+        version = tuple(self.client.query(ch_query.select_data_version,
+                                          parameters={'tables': DATA_TABLES}).result_rows)
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self.cache.clear()
+                self._rollups = None
+
+    def _rollups_ready(self):
+        # Агрегаты без суммы выручки (созданные до её появления) не используются
+        if self._rollups is None:
+            self._rollups = all(table_engine(self.client, table) is not None and
+                                has_column(self.client, table, 'date_revenue')
+                                for table in ('date_purchases', 'date_purchases_by_gender'))
+        return self._rollups
+
+    def _source(self, start, end, clientcode):
+        if (self.use_rollups and clientcode is None and _day_aligned(start) and _day_aligned(end)
+                and self._rollups_ready()):
+            return 'rollup'
+        return 'purchases'
+
+    def _statement(self, kind, start, end, gender, clientcode):
+        source = self._source(start, end, clientcode)
+        column = 'day' if source == 'rollup' else 'timestamp'
+        conditions = []
+        if start is not None:
+            conditions.append(f"{column} >= %(start)s")
+        if end is not None:
+            conditions.append(f"{column} < %(end)s")
+        if gender is not None:
+            conditions.append("gender = %(gender)s")
+        if clientcode is not None:
+            conditions.append("clientcode = %(clientcode)s")
+        if source == 'rollup':
+            table = 'date_purchases_by_gender' if gender is not None else 'date_purchases'
+            template = ch_query.select_rollup_totals if kind == 'totals' else ch_query.select_rollup_daily
+            return template.format(table=table, where=_where(conditions))
+        template = ch_query.select_purchases_totals if kind == 'totals' else ch_query.select_purchases_daily
+        return template.format(where=_where(conditions))
+
+    def _cached(self, kind, start, end, gender, clientcode):
+        self._check_version()
+        key = (kind, self.use_rollups, start, end, gender, clientcode)
+        hit, value = self.cache.get(key)
+        if hit:
+            return value
+        parameters = {'start': start, 'end': end, 'gender': gender, 'clientcode': clientcode}
+        rows = self.client.query(self._statement(kind, start, end, gender, clientcode),
+                                 parameters={name: value for name, value in parameters.items()
+                                             if value is not None}).result_rows
+        value = tuple(tuple(row) for row in rows)
+        self.cache.put(key, value)
+        return value
+
+    def totals(self, start=None, end=None, gender=None, clientcode=None):
+        """
+        Итоги за диапазон [start, end), при необходимости по полу и клиенту.
+
+        Возвращает:
+            dict: amount - сумма количества, price - сумма цен, revenue - сумма amount * price
+        """
+        amount, price, revenue = self._cached('totals', start, end, gender, clientcode)[0]
+        return {'amount': amount or 0.0, 'price': price or 0.0, 'revenue': revenue or 0.0}
+
+    def revenue(self, start=None, end=None, gender=None, clientcode=None):
+        """Сумма amount * price; без параметров - то же, что get_sum_all_time."""
+        return self.totals(start, end, gender, clientcode)['revenue']
+
+    def daily(self, start=None, end=None, gender=None, clientcode=None):
+        """
+        Итоги по дням за диапазон [start, end).
+
+        Возвращает:
+            tuple: Кортежи (day, amount, price, revenue), упорядоченные по day
+        """
+        return self._cached('daily', start, end, gender, clientcode)
@@ -0,0 +1,78 @@
+import os
+import pandas as pd
+
+# Размер порции по умолчанию: память зависит от него, а не от размера файла
+DEFAULT_CHUNK_SIZE = 50_000
+
+# В CSV нет типов, поэтому даты разбираются явно, как это делает read_excel
+TIMESTAMP_COLUMNS = ['DATE_', 'STARTDATE', 'ENDDATE']
+
+
+def _iter_excel(path, chunk_size):
+    from openpyxl import load_workbook
+
+    # read_only не держит весь лист в памяти, строки читаются потоком
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        chunk = []
+        for row in rows:
+            # Пустые строки в конце листа read_excel тоже пропускает
+            if all(value is None for value in row):
+                continue
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield pd.DataFrame.from_records(chunk, columns=header)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame.from_records(chunk, columns=header)
+    finally:
+        workbook.close()
+
+
+def _iter_csv(path, chunk_size):
+    with pd.read_csv(path, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            for column in TIMESTAMP_COLUMNS:
+                if column in chunk.columns:
+                    chunk[column] = pd.to_datetime(chunk[column], errors='coerce')
+            yield chunk
+
+
+def _iter_parquet(path, chunk_size):
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        yield batch.to_pandas()
+
+
+_READERS = {
+    '.xlsx': _iter_excel,
+    '.xlsm': _iter_excel,
+    '.csv': _iter_csv,
+    '.parquet': _iter_parquet,
+}
+
+# Расширения исходных файлов, которые читает iter_chunks
+SOURCE_SUFFIXES = tuple(_READERS)
+
+
+def iter_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Потоковое чтение исходного файла порциями по chunk_size строк.
+
+    Формат определяется по расширению: Excel (.xlsx, .xlsm), CSV, Parquet.
+    Каждая порция - DataFrame с колонками из заголовка файла.
+
+    Исключения:
+        ValueError: Если формат файла не поддерживается
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    reader = _READERS.get(suffix)
+    if reader is None:
+        raise ValueError(f"Неподдерживаемый формат файла: {path}")
+    return reader(path, chunk_size)
@@ -0,0 +1,73 @@
+import SQL_Requests.clickhouse_query as ch_query
+
+
+def table_engine(client, table):
+    """Движок таблицы в текущей базе или None, если таблицы нет."""
+    result = client.query(
+        "SELECT engine FROM system.tables WHERE database = currentDatabase() AND name = %(table)s",
+        parameters={'table': table})
+    return result.result_rows[0][0] if result.result_rows else None
+
+
+def has_column(client, table, column):
+    """Признак того, что у таблицы table в текущей базе есть колонка column."""
+    result = client.query(
+        "SELECT count() FROM system.columns WHERE database = currentDatabase() "
+        "AND table = %(table)s AND name = %(column)s",
+        parameters={'table': table, 'column': column})
+    return bool(result.result_rows[0][0])
+
+
+def create_rollups(client):
+    """
+    Схема агрегатов, обновляемых при вставке в purchases.
+
+    Материализованные представления пишут частичные суммы в
+    date_purchases_state и date_purchases_by_gender_state, а
+    date_purchases и date_purchases_by_gender становятся обычными
+    представлениями с итоговыми значениями. Если purchases уже содержит
+    данные, состояния заполняются по ним один раз при создании.
+    """
+    # Состояния без суммы выручки пересоздаются и заполняются заново вместе с представлениями
+    if table_engine(client, 'date_purchases_state') is not None and \
+            not has_column(client, 'date_purchases_state', 'revenue_sum'):
+        client.command(ch_query.drop_rollups)
+        client.command("DROP TABLE IF EXISTS date_purchases, date_purchases_by_gender")
+
+    # Агрегаты, оставшиеся от режима scan, заменяются представлениями
+    for table in ('date_purchases', 'date_purchases_by_gender'):
+        if table_engine(client, table) not in (None, 'View'):
+            client.command(f"DROP TABLE {table}")
+
+    backfill = table_engine(client, 'date_purchases_state') is None
+    client.command(ch_query.create_date_purchases_state)
+    client.command(ch_query.create_date_purchases_by_gender_state)
+    client.command(ch_query.create_date_purchases_mv)
+    client.command(ch_query.create_date_purchases_by_gender_mv)
+    if backfill:
+        client.command(ch_query.backfill_date_purchases_state)
+        client.command(ch_query.backfill_date_purchases_by_gender_state)
+    client.command(ch_query.create_date_purchases_view)
+    client.command(ch_query.create_date_purchases_by_gender_view)
+
+
+def daily_purchases(client):
+    """
+    Итоги по дням из date_purchases_state.
+
+    Возвращает:
+        list: Кортежи (day, date_amount, date_price, average_price, date_revenue), упорядоченные по day
+    """
+    return client.query(ch_query.select_date_purchases_rollup + " ORDER BY day").result_rows
+
+
+def daily_purchases_by_gender(client):
+    """
+    Итоги по дням и полу из date_purchases_by_gender_state.
+
+    Возвращает:
+        list: Кортежи (day, gender, date_amount, date_price, average_price, date_revenue),
+            упорядоченные по day и gender
+    """
+    return client.query(
+        ch_query.select_date_purchases_by_gender_rollup + " ORDER BY day, gender").result_rows
@@ -0,0 +1,190 @@
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+import SQL_Requests.postgresql_query as query
+from ETL_Stages.fingerprints import check_dedup_mode
+
+DEFAULT_WORKERS = 4
+
+# statement - каждый шаг фиксируется сразу после выполнения,
+# level - шаги уровня фиксируются вместе, когда все они выполнились без ошибок;
+# уровни фиксируются по очереди, поэтому ошибка на следующем уровне не
+# откатывает уже зафиксированные справочники: параллельные шаги идут в разных
+# соединениях, а общей транзакции у нескольких соединений нет,
+# transaction - все шаги по очереди в одном соединении с одной фиксацией в конце
+COMMIT_MODES = ('statement', 'level', 'transaction')
+
+# Шаг заполнения нормализованных таблиц: (SQL, шаги, от которых он зависит)
+NORMALIZATION_STEPS = {
+    'branches': (query.insert_branches, ()),
+    'clients': (query.insert_clients, ()),
+    'brands': (query.insert_brands, ()),
+    'categories': (query.insert_categories, ()),
+    'salesmen': (query.insert_salesmen, ('branches',)),
+    'items': (query.insert_items, ('brands', 'categories')),
+    'sales': (query.insert_sales, ('clients', 'salesmen')),
+    'sale_items': (query.insert_sale_items, ('sales', 'items')),
+}
+
+# Режим fingerprint: sale_items заполняется только по строкам temp_data,
+# ещё не прошедшим нормализацию (ETL_Stages.fingerprints)
+FINGERPRINT_STEPS = {
+    **NORMALIZATION_STEPS,
+    'sale_items': (query.insert_sale_items_unseen, NORMALIZATION_STEPS['sale_items'][1]),
+}
+
+
+def normalization_steps(dedup_mode='off'):
+    """Шаги нормализации для режима повторной загрузки (ETL_Stages.fingerprints.DEDUP_MODES)."""
+    check_dedup_mode(dedup_mode)
+    return FINGERPRINT_STEPS if dedup_mode == 'fingerprint' else NORMALIZATION_STEPS
+
+
+def _check_commit_mode(commit_mode):
+    if commit_mode not in COMMIT_MODES:
+        raise ValueError(f"Неизвестный режим фиксации: {commit_mode}, ожидается один из {COMMIT_MODES}")
+
+
+def levels(steps=NORMALIZATION_STEPS):
+    """
+    Разбиение шагов на уровни: шаги уровня зависят только от предыдущих уровней.
+
+    Возвращает:
+        list: Списки имён шагов в порядке выполнения уровней
+
+    Исключения:
+        ValueError: Если шаг зависит от неизвестного шага или зависимости образуют цикл
+    """
+    for name, (_, depends) in steps.items():
+        unknown = [dependency for dependency in depends if dependency not in steps]
+        if unknown:
+            raise ValueError(f"Шаг {name} зависит от неизвестных шагов: {unknown}")
+
+    done = set()
+    result = []
+    while len(done) < len(steps):
+        level = [name for name, (_, depends) in steps.items()
+                 if name not in done and all(dependency in done for dependency in depends)]
+        if not level:
+            raise ValueError(f"Циклическая зависимость шагов: {sorted(set(steps) - done)}")
+        result.append(level)
+        done.update(level)
+    return result
+
+
+def connections_needed(workers=DEFAULT_WORKERS, commit_mode='statement', steps=NORMALIZATION_STEPS):
+    """Сколько соединений run_normalization держит одновременно."""
+    _check_commit_mode(commit_mode)
+    if commit_mode == 'transaction':
+        return 1
+    width = max(len(level) for level in levels(steps))
+    # В режиме level соединение занято до конца уровня, поэтому их не меньше ширины уровня
+    return width if commit_mode == 'level' else max(1, min(workers, width))
+
+
+def _run_transaction(connect, plan, steps, release):
+    conn = connect()
+    timings = {}
+    try:
+        with conn.cursor() as cur:
+            for level in plan:
+                for name in level:
+                    start = time.perf_counter()
+                    cur.execute(steps[name][0])
+                    timings[name] = {'seconds': time.perf_counter() - start, 'rows': cur.rowcount}
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if release is None:
+            conn.close()
+        else:
+            release(conn)
+    return timings
+
+
+def run_normalization(connect, workers=DEFAULT_WORKERS, commit_mode='statement',
+                      steps=NORMALIZATION_STEPS, release=None):
+    """
+    Заполнение нормализованных таблиц по уровням графа зависимостей.
+
+    Независимые шаги уровня выполняются параллельно, каждый на своём
+    соединении; следующий уровень начинается после фиксации предыдущего.
+    В режиме transaction шаги выполняются последовательно в одном
+    соединении и фиксируются вместе: ошибка любого шага откатывает все
+    таблицы. temp_data должна быть зафиксирована до вызова, иначе другие
+    соединения её не увидят.
+
+    connect - функция без аргументов, возвращающая соединение psycopg,
+    release - функция освобождения соединения (по умолчанию conn.close(),
+    для пула - возврат в пул). Пул должен вмещать connections_needed()
+    соединений сверх занятых вызывающим, см. connection_source(reserve).
+
+    Возвращает:
+        dict: {шаг: {'seconds': время выполнения, 'rows': добавлено строк}}
+
+    Исключения:
+        ValueError: Если режим фиксации неизвестен
+    """
+    plan = levels(steps)
+    width = max(len(level) for level in plan)
+    size = connections_needed(workers, commit_mode, steps)
+    if commit_mode == 'transaction':
+        return _run_transaction(connect, plan, steps, release)
+
+    connections = []
+    idle = queue.Queue()
+    timings = {}
+
+    def execute(name):
+        conn = idle.get()
+        start = time.perf_counter()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(steps[name][0])
+                rows = cur.rowcount
+            if commit_mode == 'statement':
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            idle.put(conn)
+            raise
+        timings[name] = {'seconds': time.perf_counter() - start, 'rows': rows}
+        if commit_mode == 'statement':
+            idle.put(conn)
+        return conn
+
+    try:
+        # Соединения берутся внутри try: при ошибке на середине finally
+        # вернёт уже полученные
+        for _ in range(size):
+            connections.append(connect())
+            idle.put(connections[-1])
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, width))) as executor:
+            for level in plan:
+                futures = [executor.submit(execute, name) for name in level]
+                errors = []
+                finished = []
+                for future in futures:
+                    try:
+                        finished.append(future.result())
+                    except Exception as e:
+                        errors.append(e)
+
+                if commit_mode == 'level':
+                    for conn in finished:
+                        if errors:
+                            conn.rollback()
+                        else:
+                            conn.commit()
+                        idle.put(conn)
+                if errors:
+                    raise errors[0]
+    finally:
+        for conn in connections:
+            if release is None:
+                conn.close()
+            else:
+                release(conn)
+    return timings
@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+import SQL_Requests.postgresql_query as query
+from ETL_Stages.prepare import PreparedData
+
+# Режимы загрузки temp_data: бинарный COPY и прежний executemany(insert_query1)
+LOAD_MODES = ('copy', 'executemany')
+
+# logged - обычная таблица temp_data, данные накапливаются между запусками;
+# optimized - UNLOGGED, очистка перед загрузкой, индексы и ANALYZE после неё
+STAGING_MODES = ('logged', 'optimized')
+
+
+def _as_text(value):
+    # Повторяет текстовое представление, которое PostgreSQL дал бы числу
+    # или логическому значению при записи в VARCHAR через INSERT
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return str(value)
+
+
+# Колонки, значения которых уже имеют нужный для COPY тип
+_READY = {
+    'varchar': ('string',),
+    'timestamp': ('datetime',),
+    'float8': ('floating',),
+    'bigint': ('integer',),
+    'int4': ('integer',),
+}
+
+
+def _coerce(series, pg_type):
+    # В бинарном COPY нет неявных приведений сервера, поэтому значения
+    # приводятся к типу колонки заранее, целой колонкой
+    notnull = series.notna()
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred == 'empty' or inferred in _READY.get(pg_type, ()):
+        return series
+    if pg_type == 'varchar':
+        return series.map(_as_text).where(notnull, None)
+    if pg_type == 'timestamp':
+        values = pd.to_datetime(series, errors='coerce')
+    else:
+        values = pd.to_numeric(series, errors='coerce')
+    invalid = values.isna() & notnull
+    if invalid.any():
+        raise ValueError(
+            f"Значение {series[invalid].iloc[0]!r} нельзя записать в колонку типа {pg_type}")
+    if pg_type == 'timestamp':
+        values = pd.Series(np.asarray(values.dt.to_pydatetime(), dtype=object), index=series.index)
+    elif pg_type in ('bigint', 'int4'):
+        values = values.where(notnull, 0).astype('int64').astype(object)
+    else:
+        values = values.astype('float64').astype(object)
+    return values.where(notnull, None)
+
+
+def coerce_columns(prepared):
+    """
+    Приведение колонок PreparedData к типам temp_data (temp_data_types).
+
+    Возвращает:
+        list: Списки значений колонок в порядке temp_data_columns
+
+    Исключения:
+        ValueError: Если значение нельзя привести к типу колонки
+    """
+    columns = []
+    for values, pg_type in zip(prepared.data, query.temp_data_types):
+        series = pd.Series(values, dtype=object)
+        columns.append(_coerce(series, pg_type).tolist())
+    return columns
+
+
+def _copy_rows(prepared):
+    return zip(*coerce_columns(prepared))
+
+
+def copy_into_temp_data(cur, prepared, fingerprints=None):
+    """
+    Загрузка порции в temp_data через бинарный COPY.
+
+    prepared - PreparedData из этапа подготовки или список кортежей
+    в порядке колонок insert_query1. fingerprints - отпечатки строк
+    (ETL_Stages.fingerprints) для колонки FINGERPRINT.
+    """
+    if not isinstance(prepared, PreparedData):
+        rows = list(prepared)
+        data = [list(column) for column in zip(*rows)] if rows else []
+        prepared = PreparedData(query.temp_data_columns, data)
+    if not len(prepared):
+        return 0
+
+    statement, types, rows = query.copy_temp_data, query.temp_data_types, _copy_rows(prepared)
+    if fingerprints is not None:
+        statement, types = query.copy_temp_data_fingerprint, query.temp_data_types + ['bigint']
+        rows = (row + (fingerprint,) for row, fingerprint in zip(rows, fingerprints.tolist()))
+    with cur.copy(statement) as copy:
+        copy.set_types(types)
+        for row in rows:
+            copy.write_row(row)
+    return len(prepared)
+
+
+def executemany_into_temp_data(cur, prepared):
+    """Загрузка порции в temp_data построчными INSERT (резервный режим)."""
+    rows = prepared.rows() if isinstance(prepared, PreparedData) else list(prepared)
+    cur.executemany(query.insert_query1, rows)
+    return len(rows)
+
+
+def load_temp_data(cur, prepared, mode='copy'):
+    """
+    Загрузка порции в temp_data выбранным способом.
+
+    Возвращает:
+        int: Количество загруженных строк
+
+    Исключения:
+        ValueError: Если режим загрузки неизвестен
+    """
+    if mode == 'copy':
+        return copy_into_temp_data(cur, prepared)
+    if mode == 'executemany':
+        return executemany_into_temp_data(cur, prepared)
+    raise ValueError(f"Неизвестный режим загрузки temp_data: {mode}, ожидается один из {LOAD_MODES}")
+
+
+def _check_staging_mode(staging_mode):
+    if staging_mode not in STAGING_MODES:
+        raise ValueError(f"Неизвестный режим staging: {staging_mode}, ожидается один из {STAGING_MODES}")
+
+
+def staging_statements(staging_mode='logged'):
+    """
+    SQL подготовки temp_data к загрузке.
+
+    В режиме optimized таблица создаётся (или переводится) в UNLOGGED,
+    очищается от данных прошлого запуска, а индексы по ключам соединений
+    удаляются, чтобы не обновлять их на каждой вставке.
+    """
+    _check_staging_mode(staging_mode)
+    if staging_mode == 'logged':
+        return [query.create_query]
+    return [query.create_query_unlogged, query.set_temp_data_unlogged,
+            query.truncate_temp_data, query.drop_temp_data_indexes]
+
+
+def finishing_statements(staging_mode='logged'):
+    """SQL после загрузки: индексы по ключам соединений и ANALYZE temp_data (optimized)."""
+    _check_staging_mode(staging_mode)
+    if staging_mode == 'logged':
+        return []
+    return [query.create_temp_data_indexes, query.analyze_temp_data]
+
+
+def begin_staging(cur, staging_mode='logged'):
+    """Подготовка temp_data к загрузке (см. staging_statements)."""
+    for statement in staging_statements(staging_mode):
+        cur.execute(statement)
+
+
+def finish_staging(cur, staging_mode='logged'):
+    """Построение индексов и ANALYZE temp_data после загрузки (см. finishing_statements)."""
+    for statement in finishing_statements(staging_mode):
+        cur.execute(statement)
@@ -0,0 +1,179 @@
+import os
+import queue
+import threading
+import numpy as np
+import pandas as pd
+from dateutil.tz import tzlocal
+import SQL_Requests.postgresql_query as query
+from ETL_Stages.quality import check_frame, quarantine_frame, TYPE_RULES
+
+PURCHASES_COLUMNS = ['clientcode', 'gender', 'price', 'amount', 'timestamp']
+# Колонки temp_data, из которых строятся колонки purchases
+SOURCE_COLUMNS = ['CLIENTCODE', 'GENDER', 'PRICE', 'AMOUNT', 'DATE_']
+
+DEFAULT_BATCH_SIZE = 10_000
+# Сколько пачек может ждать вставки: ограничивает память конвейера
+DEFAULT_QUEUE_SIZE = 4
+
+# Шаг, с которым запоминаются затронутые моменты времени: 15 минут кратны
+# смещению любого часового пояса, поэтому по ним сервер однозначно определит дни
+TOUCHED_GRANULARITY = 900
+
+_DONE = object()
+
+
+def local_timezone_name():
+    """
+    Имя (IANA) часового пояса этого процесса, в котором convert_columns
+    трактует время без пояса: из TZ, /etc/localtime или /etc/timezone.
+
+    Исключения:
+        ValueError: Если имя часового пояса определить не удалось
+    """
+    name = os.environ.get('TZ', '').lstrip(':')
+    if name:
+        return name
+    if os.path.islink('/etc/localtime'):
+        target = os.path.realpath('/etc/localtime')
+        if 'zoneinfo/' in target:
+            return target.split('zoneinfo/', 1)[1]
+    if os.path.exists('/etc/timezone'):
+        with open('/etc/timezone', encoding='utf-8') as f:
+            name = f.read().strip()
+        if name:
+            return name
+    raise ValueError("Не удалось определить часовой пояс процесса, задайте его переменной TZ")
+
+
+def _epoch_seconds(timestamps):
+    # Наивное время трактуется как локальное, как это делал datetime.timestamp()
+    local = timestamps.dt.tz_localize(
+        tzlocal(), ambiguous=np.ones(len(timestamps), dtype=bool), nonexistent='shift_forward')
+    return (local - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+
+
+def touched_marks(timestamps):
+    """Моменты времени с шагом TOUCHED_GRANULARITY (секунды), в которые попадают наивные datetime."""
+    if not len(timestamps):
+        return set()
+    marks = _epoch_seconds(pd.to_datetime(pd.Series(timestamps))) // TOUCHED_GRANULARITY
+    return set((marks.unique() * TOUCHED_GRANULARITY).tolist())
+
+
+def convert_columns(batch, rules=TYPE_RULES, quarantine=None):
+    """
+    Приведение пачки строк temp_data к колонкам purchases.
+
+    Колонки проверяются целиком по правилам rules (ETL_Stages.quality):
+    строки с некорректными или пустыми значениями, в том числе с пустым
+    или неразборчивым timestamp, отбрасываются маской и передаются в
+    quarantine (Quarantine), если он задан.
+
+    Возвращает:
+        tuple: (список колонок для вставки с column_oriented=True, количество отброшенных строк)
+    """
+    # Колонки после пятой (например, ключ водяного знака) в purchases не попадают
+    frame = pd.DataFrame({name: pd.Series(column, dtype=object)
+                          for name, column in zip(SOURCE_COLUMNS, list(zip(*batch))[:5])})
+    values, failed_columns, reasons = check_frame(frame, rules)
+    valid = pd.isna(reasons)
+    if quarantine is not None:
+        quarantine.add('transfer', quarantine_frame(frame, failed_columns, reasons))
+
+    columns = [
+        values['CLIENTCODE'][valid].astype('int64').tolist(),
+        frame['GENDER'][valid].to_numpy().astype(str).tolist(),
+        values['PRICE'][valid].astype('float64').tolist(),
+        values['AMOUNT'][valid].astype('float64').tolist(),
+        _epoch_seconds(pd.to_datetime(values['DATE_'][valid])).tolist(),
+    ]
+    return columns, int((~valid).sum())
+
+
+def iter_batches(conn, batch_size=DEFAULT_BATCH_SIZE, sql=query.select_purchases_source, params=None):
+    """
+    Чтение temp_data именованным (серверным) курсором пачками по batch_size.
+
+    Сервер отдаёт строки по мере чтения, поэтому в памяти клиента
+    одновременно находится не больше одной пачки.
+    """
+    with conn.cursor(name='temp_data_transfer') as cur:
+        cur.itersize = batch_size
+        cur.execute(sql, params)
+        while True:
+            batch = cur.fetchmany(batch_size)
+            if not batch:
+                break
+            yield batch
+
+
+def transfer_purchases(conn, client, batch_size=DEFAULT_BATCH_SIZE, queue_size=DEFAULT_QUEUE_SIZE,
+                       batches=None, table='purchases', rules=TYPE_RULES, quarantine=None, on_insert=None):
+    """
+    Потоковый перенос temp_data в purchases (или в таблицу table той же структуры).
+
+    Чтение из PostgreSQL и вставка в ClickHouse идут параллельно: пачки
+    передаются отдельному потоку-вставщику через очередь ограниченного
+    размера, поэтому память не зависит от объёма temp_data. Отброшенные
+    по правилам rules строки передаются в quarantine (см. convert_columns).
+    on_insert(batch, touched) вызывается потоком-вставщиком после того, как
+    ClickHouse подтвердил вставку пачки, в порядке пачек: по нему
+    сохраняется прогресс, чтобы повтор после падения не вставлял пачку снова.
+
+    Возвращает:
+        dict: Количество прочитанных, вставленных и отброшенных строк, записанные
+            в ClickHouse байты и затронутые моменты времени (touched, секунды с шагом
+            TOUCHED_GRANULARITY)
+    """
+    if batches is None:
+        batches = iter_batches(conn, batch_size)
+
+    batch_queue = queue.Queue(maxsize=queue_size)
+    stats = {'read': 0, 'inserted': 0, 'rejected': 0, 'bytes': 0, 'touched': set()}
+    errors = []
+
+    def insert_worker():
+        while True:
+            batch = batch_queue.get()
+            if batch is _DONE:
+                return
+            try:
+                columns, rejected = convert_columns(batch, rules, quarantine)
+                inserted = len(columns[0])
+                if inserted:
+                    summary = client.insert(table, columns, column_names=PURCHASES_COLUMNS,
+                                            column_oriented=True)
+                    stats['bytes'] += summary.written_bytes()
+                stats['inserted'] += inserted
+                stats['rejected'] += rejected
+                marks = np.asarray(columns[4], dtype='int64') // TOUCHED_GRANULARITY
+                touched = set((np.unique(marks) * TOUCHED_GRANULARITY).tolist())
+                stats['touched'].update(touched)
+                if on_insert is not None:
+                    on_insert(batch, touched)
+            except Exception as e:
+                errors.append(e)
+                return
+
+    worker = threading.Thread(target=insert_worker, name='clickhouse-insert', daemon=True)
+    worker.start()
+    try:
+        for batch in batches:
+            stats['read'] += len(batch)
+            # Ожидание места в очереди прерывается, если вставщик упал
+            while worker.is_alive():
+                try:
+                    batch_queue.put(batch, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            if errors:
+                break
+    finally:
+        if worker.is_alive():
+            batch_queue.put(_DONE)
+        worker.join()
+
+    if errors:
+        raise errors[0]
+    return stats
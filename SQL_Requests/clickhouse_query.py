@@ -1,5 +1,5 @@
 create_purchases = """
-CREATE TABLE purchases (
+CREATE TABLE IF NOT EXISTS purchases (
     id UUID DEFAULT generateUUIDv4(),
     clientcode Int64,
     gender String,
@@ -11,25 +11,104 @@ CREATE TABLE purchases (
 ORDER BY (id, timestamp);
 """
 
+# Схема purchases для сжатия и быстрых сканов: помесячные партиции, ключ сортировки
+# по времени, полу и клиенту, LowCardinality для gender и кодеки для числовых колонок
+create_purchases_optimized = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id UUID DEFAULT generateUUIDv4() CODEC(ZSTD(1)),
+    clientcode Int64 CODEC(T64, ZSTD(1)),
+    gender LowCardinality(String),
+    price Float64 CODEC(Gorilla, ZSTD(1)),
+    amount Float64 CODEC(Gorilla, ZSTD(1)),
+    timestamp DateTime CODEC(DoubleDelta, ZSTD(1))
+) ENGINE = MergeTree()
+PARTITION BY toYYYYMM(timestamp)
+ORDER BY (toDate(timestamp), gender, clientcode);
+"""
+
+# Проекция для запросов по клиенту (необязательная)
+add_purchases_client_projection = """
+ALTER TABLE {table} ADD PROJECTION IF NOT EXISTS by_client (
+    SELECT * ORDER BY (clientcode, timestamp)
+);
+"""
+
+copy_purchases = """
+INSERT INTO {target} (id, clientcode, gender, price, amount, timestamp)
+SELECT id, clientcode, gender, price, amount, timestamp FROM {source};
+"""
+
+# Перенос диапазона параллельного переноса из его промежуточной таблицы:
+# строки упорядочены, поэтому повтор даёт те же блоки, и ClickHouse
+# отбрасывает их по insert_deduplication_token
+copy_purchases_part = """
+INSERT INTO purchases (id, clientcode, gender, price, amount, timestamp)
+SELECT id, clientcode, gender, price, amount, timestamp FROM {source}
+ORDER BY timestamp, clientcode, gender, price, amount
+"""
+
+exchange_purchases = """
+EXCHANGE TABLES purchases AND {table};
+"""
+
+# Промежуточная таблица диапазона параллельного переноса, та же структура, что у purchases
+create_purchases_part = """
+CREATE TABLE {table} AS purchases;
+"""
+
+# Прямой перенос: ClickHouse сам читает источник из PostgreSQL табличной
+# функцией {source} = postgresql(...). Условия WHERE повторяют правила
+# переноса (ETL_Stages.quality): пустой %(genders)s и NULL в %(min_price)s -
+# без проверки gender и цены (TYPE_RULES). Пустой gender без проверки
+# записывается как 'None', а время без пояса читается в поясе %(timezone)s
+# (поясе процесса ETL), как при переносе через Python
+insert_purchases_direct = """
+INSERT INTO {table} (clientcode, gender, price, amount, timestamp)
+SELECT
+    assumeNotNull(toInt64OrNull(trimBoth(clientcode))),
+    ifNull(gender, 'None'),
+    assumeNotNull(price),
+    assumeNotNull(amount),
+    parseDateTimeBestEffort(toString(assumeNotNull(date_)), %(timezone)s)
+FROM {source}
+WHERE toInt64OrNull(trimBoth(clientcode)) IS NOT NULL
+  AND (empty(%(genders)s) OR has(%(genders)s, gender))
+  AND isFinite(price) AND (isNull(%(min_price)s) OR price >= %(min_price)s)
+  AND isFinite(amount)
+  AND date_ IS NOT NULL
+"""
+
+count_table = """
+SELECT count() FROM {table}
+"""
+
+# Дедупликация вставок по insert_deduplication_token в нереплицированной MergeTree:
+# ClickHouse помнит токены последних {window} вставленных блоков
+enable_insert_deduplication = """
+ALTER TABLE {table} MODIFY SETTING non_replicated_deduplication_window = {window}
+"""
+
 create_date_purchases = """
-CREATE TABLE date_purchases (
+CREATE TABLE IF NOT EXISTS date_purchases (
     id UUID DEFAULT generateUUIDv4(),
     day DateTime,
     date_amount Float64,
     date_price Float64,
-    average_price Float64
+    average_price Float64,
+    date_revenue Float64
 ) ENGINE = MergeTree()
 ORDER BY (day);   
 """
 
 create_date_purchases_by_gender = """
-CREATE TABLE date_purchases_by_gender (
+CREATE TABLE IF NOT EXISTS date_purchases_by_gender (
     id UUID DEFAULT generateUUIDv4(),
     gender String,
     day DateTime,
     date_amount Float64,
     date_price Float64,
-    average_price Float64
+    average_price Float64,
+    date_revenue Float64
 ) ENGINE = MergeTree()
 ORDER BY (day, gender);   
 """
@@ -45,18 +124,124 @@ VALUES (
 )
 """
 insert_data_to_date_purchases = """
-INSERT INTO date_purchases (day, date_amount, date_price, average_price)
-SELECT toStartOfDay(timestamp) AS day, SUM(amount) as date_amount, SUM(price) AS date_price, date_price / date_amount 
+INSERT INTO date_purchases (day, date_amount, date_price, average_price, date_revenue)
+SELECT toStartOfDay(timestamp) AS day, SUM(amount) as date_amount, SUM(price) AS date_price, date_price / date_amount,
+SUM(amount * price)
 FROM purchases GROUP BY day;
 """
 
 insert_data_to_date_purchases_by_gender = """
-INSERT INTO date_purchases_by_gender (day, gender, date_amount, date_price, average_price)
+INSERT INTO date_purchases_by_gender (day, gender, date_amount, date_price, average_price, date_revenue)
 SELECT toStartOfDay(timestamp) AS day, gender, SUM(amount) as date_amount, SUM(price) AS date_price, 
-date_price / date_amount 
+date_price / date_amount, SUM(amount * price)
 FROM purchases GROUP BY (day, gender);
 """
 
+# Инкрементальная загрузка: пересчёт агрегатов только за затронутые дни.
+# Дни передаются как toUInt32(toStartOfDay(...)), чтобы не зависеть от часового пояса клиента
+select_touched_days = """
+SELECT DISTINCT toUInt32(toStartOfDay(toDateTime(arrayJoin(%(marks)s))))
+"""
+
+delete_date_purchases_days = """
+ALTER TABLE date_purchases DELETE WHERE toUInt32(day) IN %(days)s
+"""
+
+delete_date_purchases_by_gender_days = """
+ALTER TABLE date_purchases_by_gender DELETE WHERE toUInt32(day) IN %(days)s
+"""
+
+insert_data_to_date_purchases_days = """
+INSERT INTO date_purchases (day, date_amount, date_price, average_price, date_revenue)
+SELECT toStartOfDay(timestamp) AS day, SUM(amount) as date_amount, SUM(price) AS date_price, date_price / date_amount,
+SUM(amount * price)
+FROM purchases WHERE toUInt32(toStartOfDay(timestamp)) IN %(days)s GROUP BY day;
+"""
+
+insert_data_to_date_purchases_by_gender_days = """
+INSERT INTO date_purchases_by_gender (day, gender, date_amount, date_price, average_price, date_revenue)
+SELECT toStartOfDay(timestamp) AS day, gender, SUM(amount) as date_amount, SUM(price) AS date_price, 
+date_price / date_amount, SUM(amount * price)
+FROM purchases WHERE toUInt32(toStartOfDay(timestamp)) IN %(days)s GROUP BY (day, gender);
+"""
+
+# Режим материализованных представлений: агрегаты обновляются при вставке в purchases.
+# В *_state лежат частичные суммы, SummingMergeTree складывает их при слияниях
+create_date_purchases_state = """
+CREATE TABLE IF NOT EXISTS date_purchases_state (
+    day DateTime,
+    amount_sum Float64,
+    price_sum Float64,
+    revenue_sum Float64
+) ENGINE = SummingMergeTree()
+ORDER BY (day);
+"""
+
+create_date_purchases_by_gender_state = """
+CREATE TABLE IF NOT EXISTS date_purchases_by_gender_state (
+    day DateTime,
+    gender String,
+    amount_sum Float64,
+    price_sum Float64,
+    revenue_sum Float64
+) ENGINE = SummingMergeTree()
+ORDER BY (day, gender);
+"""
+
+create_date_purchases_mv = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS date_purchases_mv TO date_purchases_state AS
+SELECT toStartOfDay(timestamp) AS day, SUM(amount) AS amount_sum, SUM(price) AS price_sum,
+SUM(amount * price) AS revenue_sum
+FROM purchases GROUP BY day;
+"""
+
+create_date_purchases_by_gender_mv = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS date_purchases_by_gender_mv TO date_purchases_by_gender_state AS
+SELECT toStartOfDay(timestamp) AS day, gender, SUM(amount) AS amount_sum, SUM(price) AS price_sum,
+SUM(amount * price) AS revenue_sum
+FROM purchases GROUP BY (day, gender);
+"""
+
+# Заполнение *_state по уже загруженным данным при первом создании
+backfill_date_purchases_state = """
+INSERT INTO date_purchases_state (day, amount_sum, price_sum, revenue_sum)
+SELECT toStartOfDay(timestamp) AS day, SUM(amount), SUM(price), SUM(amount * price)
+FROM purchases GROUP BY day;
+"""
+
+backfill_date_purchases_by_gender_state = """
+INSERT INTO date_purchases_by_gender_state (day, gender, amount_sum, price_sum, revenue_sum)
+SELECT toStartOfDay(timestamp) AS day, gender, SUM(amount), SUM(price), SUM(amount * price)
+FROM purchases GROUP BY (day, gender);
+"""
+
+# Итоговые значения: суммы состояний доагрегируются, average_price считается при чтении
+select_date_purchases_rollup = """
+SELECT day, SUM(amount_sum) AS date_amount, SUM(price_sum) AS date_price, date_price / date_amount AS average_price,
+SUM(revenue_sum) AS date_revenue
+FROM date_purchases_state GROUP BY day
+"""
+
+select_date_purchases_by_gender_rollup = """
+SELECT day, gender, SUM(amount_sum) AS date_amount, SUM(price_sum) AS date_price,
+date_price / date_amount AS average_price, SUM(revenue_sum) AS date_revenue
+FROM date_purchases_by_gender_state GROUP BY (day, gender)
+"""
+
+# Прежние имена агрегатов остаются доступны как представления над *_state
+create_date_purchases_view = """
+CREATE VIEW IF NOT EXISTS date_purchases AS
+""" + select_date_purchases_rollup
+
+create_date_purchases_by_gender_view = """
+CREATE VIEW IF NOT EXISTS date_purchases_by_gender AS
+""" + select_date_purchases_by_gender_rollup
+
+drop_rollups = """
+DROP TABLE IF EXISTS date_purchases_mv, date_purchases_by_gender_mv,
+date_purchases_state, date_purchases_by_gender_state;
+"""
+
 
 get_sum_all_time = """
 SELECT SUM(amount * price) FROM purchases
@@ -66,6 +251,38 @@ get_sum_all_time_by_gender = """
 SELECT SUM(amount * price) FROM purchases WHERE gender = %(gender)s
 """
 
+# Сервис запросов (ETL_Stages.query_service): {where} собирается из условий
+# по заданным параметрам, {table} - date_purchases или date_purchases_by_gender
+select_purchases_totals = """
+SELECT SUM(amount), SUM(price), SUM(amount * price) FROM purchases {where}
+"""
+
+select_rollup_totals = """
+SELECT SUM(date_amount), SUM(date_price), SUM(date_revenue) FROM {table} {where}
+"""
+
+select_purchases_daily = """
+SELECT toStartOfDay(timestamp) AS day, SUM(amount), SUM(price), SUM(amount * price)
+FROM purchases {where}
+GROUP BY day ORDER BY day
+"""
+
+select_rollup_daily = """
+SELECT day, SUM(date_amount), SUM(date_price), SUM(date_revenue)
+FROM {table} {where}
+GROUP BY day ORDER BY day
+"""
+
+# Версия данных для сброса кэша запросов: меняется при любой вставке,
+# удалении, слиянии частей или пересоздании таблиц
+select_data_version = """
+SELECT table, count(), sum(rows), max(modification_time)
+FROM system.parts
+WHERE database = currentDatabase() AND active AND table IN %(tables)s
+GROUP BY table
+ORDER BY table
+"""
+
 drop_purchases = """
 DROP TABLE IF EXISTS purchases;
 """
@@ -28,6 +28,70 @@ ENDDATE TIMESTAMP DEFAULT NULL,
 GENDER VARCHAR
 )
 '''
+
+# Режим staging optimized: temp_data без журнала WAL, индексы строятся после загрузки
+create_query_unlogged = create_query.replace('CREATE TABLE', 'CREATE UNLOGGED TABLE', 1)
+
+set_temp_data_unlogged = """
+ALTER TABLE temp_data SET UNLOGGED
+"""
+
+truncate_temp_data = """
+TRUNCATE temp_data
+"""
+
+# Индексы по ключам соединений insert_into_tmp_table
+create_temp_data_indexes = """
+CREATE INDEX if not exists temp_data_branchnr_idx ON temp_data (BRANCHNR);
+CREATE INDEX if not exists temp_data_clientcode_idx ON temp_data (CLIENTCODE);
+CREATE INDEX if not exists temp_data_salesman_idx ON temp_data (SALESMAN);
+CREATE INDEX if not exists temp_data_brandcode_idx ON temp_data (BRANDCODE);
+CREATE INDEX if not exists temp_data_itemcode_idx ON temp_data (ITEMCODE);
+CREATE INDEX if not exists temp_data_categories_idx ON temp_data (CATEGORY_NAME1, CATEGORY_NAME2, CATEGORY_NAME3);
+CREATE INDEX if not exists temp_data_ficheno_date_idx ON temp_data (FICHENO, DATE_);
+"""
+
+drop_temp_data_indexes = """
+DROP INDEX if exists temp_data_branchnr_idx, temp_data_clientcode_idx, temp_data_salesman_idx,
+    temp_data_brandcode_idx, temp_data_itemcode_idx, temp_data_categories_idx, temp_data_ficheno_date_idx,
+    temp_data_id_idx;
+"""
+
+analyze_temp_data = """
+ANALYZE temp_data
+"""
+
+# Порядок колонок temp_data, в котором этап подготовки отдаёт данные для insert_query1
+temp_data_columns = [
+    'ID', 'ITEMCODE', 'ITEMNAME', 'FICHENO', 'DATE_',
+    'AMOUNT', 'PRICE', 'LINENETTOTAL', 'LINENET',
+    'BRANCHNR', 'BRANCH', 'SALESMAN', 'CITY', 'REGION',
+    'LATITUDE', 'LONGITUDE', 'CLIENTCODE', 'CLIENTNAME',
+    'BRANDCODE', 'BRAND', 'CATEGORY_NAME1', 'CATEGORY_NAME2',
+    'CATEGORY_NAME3', 'STARTDATE', 'ENDDATE', 'GENDER',
+]
+
+# Типы колонок temp_data для бинарного COPY, должны совпадать с create_query
+temp_data_types = [
+    'bigint', 'varchar', 'varchar', 'varchar', 'timestamp',
+    'float8', 'float8', 'float8', 'float8',
+    'int4', 'varchar', 'varchar', 'varchar', 'varchar',
+    'float8', 'float8', 'varchar', 'varchar',
+    'varchar', 'varchar', 'varchar', 'varchar',
+    'varchar', 'timestamp', 'timestamp', 'varchar',
+]
+
+copy_temp_data = '''
+COPY temp_data (
+    ID, ITEMCODE, ITEMNAME, FICHENO, DATE_,
+    AMOUNT, PRICE, LINENETTOTAL, LINENET,
+    BRANCHNR, BRANCH, SALESMAN, CITY, REGION,
+    LATITUDE, LONGITUDE, CLIENTCODE, CLIENTNAME,
+    BRANDCODE, BRAND, CATEGORY_NAME1, CATEGORY_NAME2,
+    CATEGORY_NAME3, STARTDATE, ENDDATE, GENDER
+) FROM STDIN (FORMAT BINARY)
+'''
+
 # Используем позиционные параметры (%s)
 insert_query1 = r'''
 INSERT INTO temp_data (
@@ -113,8 +177,21 @@ CREATE TABLE if not exists sale_items (
   line_net_total FLOAT ,
   line_net FLOAT 
 );
+
+-- Ограничение создаётся один раз вместе со схемой, а не при каждом заполнении
+DO $$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'sales_fisheno_date_unique') THEN
+    ALTER TABLE sales ADD CONSTRAINT sales_fisheno_date_unique UNIQUE (fisheno, date);
+  END IF;
+END $$;
+
+-- Ключи соединений, по которым нет уникальных ограничений
+CREATE INDEX if not exists salesmen_salesman_name_idx ON salesmen (salesman_name);
+CREATE INDEX if not exists categories_names_idx ON categories (category_name1, category_name2, category_name3);
 '''
-insert_into_tmp_table = '''
+# Шаги заполнения нормализованных таблиц; зависимости между ними описаны в ETL_Stages.scheduler
+insert_branches = '''
 INSERT INTO branches (branch_nr, branch_name, city, region, latitude, longitude)
 SELECT DISTINCT 
     BRANCHNR, 
@@ -125,7 +202,9 @@ SELECT DISTINCT
     NULLIF(LONGITUDE, 0)
 FROM temp_data
 WHERE BRANCHNR IS NOT NULL AND BRANCH IS NOT NULL AND CITY IS NOT NULL AND REGION IS NOT NULL;
+'''
 
+insert_salesmen = '''
 INSERT INTO salesmen (salesman_name, branch_id)
 SELECT DISTINCT 
     t.SALESMAN, 
@@ -133,7 +212,9 @@ SELECT DISTINCT
 FROM temp_data t
 JOIN branches b ON t.BRANCHNR = b.branch_nr
 WHERE t.SALESMAN IS NOT NULL AND b.branch_id IS NOT NULL;
+'''
 
+insert_clients = '''
 INSERT INTO clients (client_code, client_name, gender)
 SELECT DISTINCT 
     CLIENTCODE, 
@@ -142,7 +223,9 @@ SELECT DISTINCT
 FROM temp_data
 WHERE CLIENTCODE IS NOT NULL AND CLIENTNAME IS NOT NULL
 ON CONFLICT (client_code) DO NOTHING;
+'''
 
+insert_brands = '''
 INSERT INTO brands (brand_code, brand_name)
 SELECT DISTINCT 
     NULLIF(BRANDCODE, ''), 
@@ -150,7 +233,9 @@ SELECT DISTINCT
 FROM temp_data
 WHERE BRANDCODE IS NOT NULL AND BRAND IS NOT NULL
 ON CONFLICT (brand_code) DO NOTHING;
+'''
 
+insert_categories = '''
 INSERT INTO categories (category_name1, category_name2, category_name3)
 SELECT DISTINCT 
     NULLIF(CATEGORY_NAME1, ''), 
@@ -158,7 +243,9 @@ SELECT DISTINCT
     NULLIF(NULLIF(CATEGORY_NAME3, ''), 'N/A')
 FROM temp_data
 WHERE CATEGORY_NAME1 IS NOT NULL;
+'''
 
+insert_items = '''
 INSERT INTO items (item_code, item_name, brand_id, category_id, price)
 SELECT DISTINCT 
     t.ITEMCODE, 
@@ -174,10 +261,9 @@ JOIN categories c ON t.CATEGORY_NAME1 = c.category_name1
 WHERE t.ITEMCODE IS NOT NULL AND t.ITEMNAME IS NOT NULL AND t.PRICE IS NOT NULL
 AND b.brand_id IS NOT NULL AND c.category_id IS NOT NULL
 ON CONFLICT (item_code) DO NOTHING;
+'''
 
-
-ALTER TABLE sales ADD CONSTRAINT sales_fisheno_date_unique UNIQUE (fisheno, date);
-
+insert_sales = '''
 INSERT INTO sales (fisheno, date, client_id, salesman_id, start_date, end_date)
 SELECT DISTINCT 
     t.FICHENO, 
@@ -192,7 +278,9 @@ JOIN salesmen s ON t.SALESMAN = s.salesman_name
 WHERE t.FICHENO IS NOT NULL AND t.DATE_ IS NOT NULL
 AND cl.client_id IS NOT NULL AND s.salesman_id IS NOT NULL
 ON CONFLICT (fisheno, date) DO NOTHING;
+'''
 
+insert_sale_items = '''
 INSERT INTO sale_items (sale_id, item_id, amount, line_net_total, line_net)
 SELECT 
     s.sale_id, 
@@ -207,7 +295,343 @@ WHERE s.sale_id IS NOT NULL AND i.item_id IS NOT NULL
 AND t.AMOUNT IS NOT NULL AND t.LINENETTOTAL IS NOT NULL AND t.LINENET IS NOT NULL;
 '''
 
+insert_into_tmp_table = ''.join([
+    insert_branches, insert_salesmen, insert_clients, insert_brands,
+    insert_categories, insert_items, insert_sales, insert_sale_items,
+])
+
 select_query = """
 SELECT AMOUNT, PRICE, GENDER
 FROM temp_data
-"""
\ No newline at end of file
+"""
+
+# Источник для таблицы purchases в ClickHouse
+select_purchases_source = """
+SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_
+FROM temp_data
+"""
+
+
+# Инкрементальный источник purchases: строки после водяного знака по ключу {key}
+select_purchases_source_after = """
+SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_, {key}
+FROM temp_data
+WHERE {key} > %(mark)s
+ORDER BY {key}
+"""
+
+select_purchases_source_all = """
+SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_, {key}
+FROM temp_data
+WHERE {key} IS NOT NULL
+ORDER BY {key}
+"""
+
+# Параллельный перенос: границы диапазонов по квантилям ключа {key}
+select_partition_bounds = """
+SELECT DISTINCT bound FROM unnest((
+    SELECT percentile_disc(%(fractions)s::float8[]) WITHIN GROUP (ORDER BY {key})
+    FROM temp_data
+    WHERE {key} IS NOT NULL
+)) AS bound
+ORDER BY bound
+"""
+
+select_purchases_source_range = """
+SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_
+FROM temp_data
+WHERE {key} >= %(low)s AND {key} < %(high)s
+"""
+
+select_purchases_source_from = """
+SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_
+FROM temp_data
+WHERE {key} >= %(low)s
+"""
+
+select_purchases_source_null = """
+SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_
+FROM temp_data
+WHERE {key} IS NULL
+"""
+
+# Перенос с контрольными точками (ETL_Stages.checkpoint): пачки - диапазоны ID
+create_temp_data_id_index = """
+CREATE INDEX if not exists temp_data_id_idx ON temp_data (ID)
+"""
+
+# Признаки содержимого temp_data: по ним проверяется, что продолжается перенос тех же данных
+select_temp_data_signature = """
+SELECT count(*), min(ID), max(ID) FROM temp_data
+"""
+
+# Верхняя граница пачки: ID limit-й строки после low; строки с одинаковым ID попадают в одну пачку
+select_batch_bound = """
+SELECT max(ID) FROM (
+    SELECT ID FROM temp_data
+    WHERE ID > %(low)s
+    ORDER BY ID
+    LIMIT %(limit)s
+) AS batch
+"""
+
+select_purchases_source_batch = """
+SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_
+FROM temp_data
+WHERE ID > %(low)s AND ID <= %(high)s
+"""
+
+# Повторные прогоны по отпечаткам строк (ETL_Stages.fingerprints): отпечаток
+# хранится в temp_data рядом со строкой, состояние строки - в row_fingerprints
+create_row_fingerprints = """
+CREATE TABLE if not exists row_fingerprints (
+    fingerprint BIGINT PRIMARY KEY,
+    source VARCHAR,
+    loaded_at TIMESTAMP NOT NULL DEFAULT now(),
+    normalized_at TIMESTAMP,
+    transferred_at TIMESTAMP
+);
+ALTER TABLE row_fingerprints ADD COLUMN if not exists aggregates_pending BOOLEAN NOT NULL DEFAULT false;
+CREATE INDEX if not exists row_fingerprints_normalized_idx ON row_fingerprints (fingerprint)
+    WHERE normalized_at IS NULL;
+CREATE INDEX if not exists row_fingerprints_transferred_idx ON row_fingerprints (fingerprint)
+    WHERE transferred_at IS NULL;
+CREATE INDEX if not exists row_fingerprints_aggregates_idx ON row_fingerprints (fingerprint)
+    WHERE aggregates_pending;
+ALTER TABLE temp_data ADD COLUMN if not exists FINGERPRINT BIGINT;
+CREATE INDEX if not exists temp_data_fingerprint_idx ON temp_data (FINGERPRINT);
+"""
+
+# Новые отпечатки регистрируются, уже известные отсекаются ON CONFLICT
+register_fingerprints = """
+INSERT INTO row_fingerprints (fingerprint, source)
+SELECT unnest(%s::bigint[]), %s
+ON CONFLICT DO NOTHING
+RETURNING fingerprint
+"""
+
+copy_temp_data_fingerprint = copy_temp_data.replace('GENDER\n)', 'GENDER, FINGERPRINT\n)')
+
+# sale_items только по строкам, ещё не прошедшим нормализацию: отметка и
+# вставка выполняются одним запросом, поэтому повтор не дублирует строки
+insert_sale_items_unseen = '''
+WITH pending AS (
+    UPDATE row_fingerprints SET normalized_at = now()
+    WHERE normalized_at IS NULL
+    RETURNING fingerprint
+)
+INSERT INTO sale_items (sale_id, item_id, amount, line_net_total, line_net)
+SELECT 
+    s.sale_id, 
+    i.item_id, 
+    NULLIF(t.AMOUNT, 0),
+    NULLIF(t.LINENETTOTAL, 0),
+    NULLIF(t.LINENET, 0)
+FROM temp_data t
+JOIN pending p ON t.FINGERPRINT = p.fingerprint
+JOIN sales s ON t.FICHENO = s.fisheno AND t.DATE_ = s.date
+JOIN items i ON t.ITEMCODE = i.item_code
+WHERE s.sale_id IS NOT NULL AND i.item_id IS NOT NULL
+AND t.AMOUNT IS NOT NULL AND t.LINENETTOTAL IS NOT NULL AND t.LINENET IS NOT NULL;
+'''
+
+# Источник purchases: строки, ещё не перенесённые в ClickHouse, с отпечатком шестой колонкой
+select_purchases_source_unseen = """
+SELECT t.CLIENTCODE, t.GENDER, t.PRICE, t.AMOUNT, t.DATE_, t.FINGERPRINT
+FROM temp_data t
+JOIN row_fingerprints f ON f.fingerprint = t.FINGERPRINT
+WHERE f.transferred_at IS NULL
+"""
+
+# Пачка отмечается сразу после вставки в ClickHouse; aggregates_pending -
+# агрегаты за её дни ещё не пересчитаны
+mark_fingerprints_transferred = """
+UPDATE row_fingerprints SET transferred_at = now(), aggregates_pending = %s
+WHERE fingerprint = ANY(%s::bigint[])
+"""
+
+# Моменты времени перенесённых строк, агрегаты за которые не пересчитаны
+# (прогон упал между вставкой и пересчётом); с точностью до минуты
+select_fingerprints_pending_dates = """
+SELECT DISTINCT date_trunc('minute', t.DATE_)
+FROM temp_data t
+JOIN row_fingerprints f ON f.fingerprint = t.FINGERPRINT
+WHERE f.aggregates_pending AND t.DATE_ IS NOT NULL
+"""
+
+clear_fingerprints_aggregates_pending = """
+UPDATE row_fingerprints SET aggregates_pending = false
+WHERE aggregates_pending
+"""
+
+# Источник прямого переноса из нормализованных таблиц (колонки как у temp_data);
+# price - цена товара из items, а не цена строки чека
+create_purchases_normalized_source = """
+CREATE OR REPLACE VIEW purchases_normalized_source AS
+SELECT
+    c.client_code AS clientcode,
+    c.gender,
+    i.price,
+    si.amount,
+    s.date AS date_
+FROM sale_items si
+JOIN sales s ON s.sale_id = si.sale_id
+JOIN clients c ON c.client_id = s.client_id
+JOIN items i ON i.item_id = si.item_id
+"""
+
+# Нормализация с кэшем ключей: поиск и добавление измерений пачками по unnest.
+# load_* - начальная загрузка кэша, select_* - поиск id по натуральным ключам,
+# insert_* - добавление новых ключей (ON CONFLICT без цели работает и без уникальных ограничений)
+load_branch_ids = """
+SELECT branch_nr, branch_id FROM branches LIMIT %s
+"""
+
+select_branch_ids = """
+SELECT b.branch_nr, b.branch_id
+FROM branches b
+JOIN unnest(%s::int[]) AS k(branch_nr) ON b.branch_nr = k.branch_nr
+"""
+
+insert_branches_returning = """
+INSERT INTO branches (branch_nr, branch_name, city, region, latitude, longitude)
+SELECT * FROM unnest(%s::int[], %s::varchar[], %s::varchar[], %s::varchar[], %s::float8[], %s::float8[])
+ON CONFLICT DO NOTHING
+RETURNING branch_nr, branch_id
+"""
+
+load_salesman_ids = """
+SELECT salesman_name, branch_id, MIN(salesman_id) FROM salesmen GROUP BY salesman_name, branch_id LIMIT %s
+"""
+
+select_salesman_ids = """
+SELECT s.salesman_name, s.branch_id, MIN(s.salesman_id)
+FROM salesmen s
+JOIN unnest(%s::varchar[], %s::int[]) AS k(salesman_name, branch_id)
+    ON s.salesman_name = k.salesman_name AND s.branch_id = k.branch_id
+GROUP BY s.salesman_name, s.branch_id
+"""
+
+insert_salesmen_returning = """
+INSERT INTO salesmen (salesman_name, branch_id)
+SELECT * FROM unnest(%s::varchar[], %s::int[])
+ON CONFLICT DO NOTHING
+RETURNING salesman_name, branch_id, salesman_id
+"""
+
+load_client_ids = """
+SELECT client_code, client_id FROM clients LIMIT %s
+"""
+
+select_client_ids = """
+SELECT c.client_code, c.client_id
+FROM clients c
+JOIN unnest(%s::varchar[]) AS k(client_code) ON c.client_code = k.client_code
+"""
+
+insert_clients_returning = """
+INSERT INTO clients (client_code, client_name, gender)
+SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[])
+ON CONFLICT DO NOTHING
+RETURNING client_code, client_id
+"""
+
+load_brand_ids = """
+SELECT brand_code, brand_id FROM brands LIMIT %s
+"""
+
+select_brand_ids = """
+SELECT b.brand_code, b.brand_id
+FROM brands b
+JOIN unnest(%s::varchar[]) AS k(brand_code) ON b.brand_code = k.brand_code
+"""
+
+insert_brands_returning = """
+INSERT INTO brands (brand_code, brand_name)
+SELECT * FROM unnest(%s::varchar[], %s::varchar[])
+ON CONFLICT DO NOTHING
+RETURNING brand_code, brand_id
+"""
+
+load_category_ids = """
+SELECT category_name1, category_name2, category_name3, MIN(category_id)
+FROM categories GROUP BY category_name1, category_name2, category_name3 LIMIT %s
+"""
+
+select_category_ids = """
+SELECT c.category_name1, c.category_name2, c.category_name3, MIN(c.category_id)
+FROM categories c
+JOIN unnest(%s::varchar[], %s::varchar[], %s::varchar[]) AS k(name1, name2, name3)
+    ON c.category_name1 IS NOT DISTINCT FROM k.name1
+    AND c.category_name2 IS NOT DISTINCT FROM k.name2
+    AND c.category_name3 IS NOT DISTINCT FROM k.name3
+GROUP BY c.category_name1, c.category_name2, c.category_name3
+"""
+
+insert_categories_returning = """
+INSERT INTO categories (category_name1, category_name2, category_name3)
+SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[])
+ON CONFLICT DO NOTHING
+RETURNING category_name1, category_name2, category_name3, category_id
+"""
+
+load_item_ids = """
+SELECT item_code, item_id FROM items LIMIT %s
+"""
+
+select_item_ids = """
+SELECT i.item_code, i.item_id
+FROM items i
+JOIN unnest(%s::varchar[]) AS k(item_code) ON i.item_code = k.item_code
+"""
+
+insert_items_returning = """
+INSERT INTO items (item_code, item_name, brand_id, category_id, price)
+SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::int[], %s::int[], %s::float8[])
+ON CONFLICT DO NOTHING
+RETURNING item_code, item_id
+"""
+
+load_sale_ids = """
+SELECT fisheno, date, MIN(sale_id) FROM sales GROUP BY fisheno, date LIMIT %s
+"""
+
+select_sale_ids = """
+SELECT s.fisheno, s.date, MIN(s.sale_id)
+FROM sales s
+JOIN unnest(%s::varchar[], %s::timestamp[]) AS k(fisheno, date)
+    ON s.fisheno = k.fisheno AND s.date = k.date
+GROUP BY s.fisheno, s.date
+"""
+
+insert_sales_returning = """
+INSERT INTO sales (fisheno, date, client_id, salesman_id, start_date, end_date)
+SELECT * FROM unnest(%s::varchar[], %s::timestamp[], %s::int[], %s::int[], %s::timestamp[], %s::timestamp[])
+ON CONFLICT DO NOTHING
+RETURNING fisheno, date, sale_id
+"""
+
+sale_items_types = ['int4', 'int4', 'float8', 'float8', 'float8']
+
+copy_sale_items = """
+COPY sale_items (sale_id, item_id, amount, line_net_total, line_net) FROM STDIN (FORMAT BINARY)
+"""
+
+# Карантин: строки, не прошедшие проверки качества (ETL_Stages.quality), с кодом причины
+create_quarantine = """
+CREATE TABLE if not exists quarantine (
+    quarantine_id BIGSERIAL PRIMARY KEY,
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    stage VARCHAR NOT NULL,
+    source VARCHAR,
+    row_number BIGINT,
+    column_name VARCHAR NOT NULL,
+    reason VARCHAR NOT NULL,
+    value VARCHAR,
+    record JSONB
+)
+"""
+
+copy_quarantine = """
+COPY quarantine (stage, source, row_number, column_name, reason, value, record) FROM STDIN
+"""
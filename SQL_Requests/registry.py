@@ -0,0 +1,75 @@
+# Единый реестр SQL проекта: запросы берутся по имени из postgresql_query
+# и clickhouse_query, модуль запросов загружается один раз при первом
+# обращении. psycopg и clickhouse_connect здесь не импортируются, поэтому
+# реестр можно импортировать при разборе DAG
+import importlib
+from functools import lru_cache
+
+_MODULES = {
+    'postgresql': 'SQL_Requests.postgresql_query',
+    'clickhouse': 'SQL_Requests.clickhouse_query',
+}
+
+# Запросы PostgreSQL, которые выполняются много раз за прогон (на каждую
+# порцию или пачку): сервер разбирает и планирует их один раз
+PREPARED = frozenset({
+    'register_fingerprints',
+    'mark_fingerprints_transferred',
+    'select_batch_bound',
+    'select_purchases_source_batch',
+    # Справочники режима нормализации cache (ETL_Stages.normalizer)
+    'select_branch_ids', 'insert_branches_returning',
+    'select_salesman_ids', 'insert_salesmen_returning',
+    'select_client_ids', 'insert_clients_returning',
+    'select_brand_ids', 'insert_brands_returning',
+    'select_category_ids', 'insert_categories_returning',
+    'select_item_ids', 'insert_items_returning',
+    'select_sale_ids', 'insert_sales_returning',
+})
+
+
+@lru_cache(maxsize=None)
+def _module(dialect):
+    if dialect not in _MODULES:
+        raise ValueError(f"Неизвестный диалект SQL: {dialect}, ожидается один из {tuple(_MODULES)}")
+    return importlib.import_module(_MODULES[dialect])
+
+
+@lru_cache(maxsize=None)
+def statement(name, dialect='postgresql'):
+    """
+    Текст запроса name.
+
+    Исключения:
+        KeyError: Если запроса с таким именем нет
+    """
+    value = getattr(_module(dialect), name, None)
+    if not isinstance(value, str):
+        raise KeyError(f"Нет запроса {dialect} с именем {name}")
+    return value
+
+
+@lru_cache(maxsize=None)
+def template(name, **identifiers):
+    """
+    Запрос PostgreSQL с подставленными идентификаторами ({key} и т.п.) как
+    psycopg.sql.Composed; собирается один раз для каждого набора имён.
+    """
+    from psycopg import sql
+
+    return sql.SQL(statement(name)).format(**{field: sql.Identifier(value) for field, value in identifiers.items()})
+
+
+def execute(cur, name, params=None, **identifiers):
+    """
+    Выполнение запроса PostgreSQL name курсором cur.
+
+    Запросы из PREPARED выполняются как подготовленные на сервере
+    (prepare=True), если автоматическая подготовка не отключена у
+    соединения (prepare_threshold=None, например за PgBouncer).
+    """
+    query = template(name, **identifiers) if identifiers else statement(name)
+    prepare = None
+    if name in PREPARED and cur.connection.prepare_threshold is not None:
+        prepare = True
+    return cur.execute(query, params, prepare=prepare)
@@ -1,11 +1,11 @@
 from datetime import datetime, timedelta
 from airflow import DAG
-from airflow.providers.standard.operators.python import PythonOperator
-from airflow.providers.common.sql.operators.sql import SQLExecuteQueryOperator
 from airflow.models import Variable
-import pandas as pd
 from airflow.decorators import task
 import logging
+import os
+import re
+from contextlib import nullcontext
 from airflow.exceptions import AirflowException
 
 default_args = {
@@ -17,12 +17,119 @@ default_args = {
     'retry_exponential_backoff': True,
 }
 
+def run_metrics():
+    """
+    Метрики этапов задачи; этапы под cProfile и tracemalloc задаются
+    через METRICS_PROFILE_STAGES и METRICS_TRACE_MEMORY_STAGES (через запятую).
+    """
+    from ETL_Stages.metrics import RunMetrics
+
+    def stages(name):
+        return [stage.strip() for stage in Variable.get(name, default_var="").split(",") if stage.strip()]
+
+    return RunMetrics(stages("METRICS_PROFILE_STAGES"), stages("METRICS_TRACE_MEMORY_STAGES"))
+
+
+def publish_metrics(metrics):
+    """Отчёт этапов в журнал задачи, XCom (ключ metrics) и метрики Airflow (etl.<этап>.*)."""
+    from airflow.providers.standard.operators.python import get_current_context
+    from airflow.stats import Stats
+
+    for line in metrics.lines():
+        logging.info(line)
+    report = metrics.report()
+    get_current_context()['ti'].xcom_push(key='metrics', value=report)
+    for stage in report['stages']:
+        Stats.timing(f"etl.{stage['stage']}.wall_seconds", stage['wall_seconds'] * 1000)
+        Stats.timing(f"etl.{stage['stage']}.cpu_seconds", stage['cpu_seconds'] * 1000)
+        Stats.gauge(f"etl.{stage['stage']}.rows_out", stage['rows_out'])
+        Stats.gauge(f"etl.{stage['stage']}.rows_rejected", stage['rows_rejected'])
+        Stats.gauge(f"etl.{stage['stage']}.bytes", stage['bytes'])
+
+
+def run_quality_rules():
+    """Правила качества; допустимые значения GENDER задаются через GENDER_VALUES (через запятую)."""
+    from ETL_Stages.quality import quality_rules, GENDER_VALUES
+
+    values = Variable.get("GENDER_VALUES", default_var=",".join(GENDER_VALUES))
+    return quality_rules([value.strip() for value in values.split(",") if value.strip()])
+
+
+def run_quarantine(source):
+    """Карантин отклонённых строк задачи: запись в таблицу quarantine отдельным соединением."""
+    from DBMS_Classes.PostgreSQLDatabase import connection_source
+    from ETL_Stages.quality import Quarantine
+
+    connect, release = connection_source()
+    return Quarantine(connect, release, source=source)
+
+
+def publish_quality(quarantine):
+    """Сводка отклонённых строк одной записью журнала и в XCom (ключ quality)."""
+    from airflow.providers.standard.operators.python import get_current_context
+
+    quarantine.flush()
+    summary = quarantine.summary()
+    if summary:
+        logging.warning(f"Отклонено строк: {quarantine.rejected}, по причинам: {summary}")
+    get_current_context()['ti'].xcom_push(key='quality', value=summary)
+
+
+def prepare_files(pattern, chunk_size, staging_path, rules, metrics):
+    """
+    Подготовка всех файлов по каталогу или шаблону glob в один файл передачи.
+
+    Файл с ошибкой пропускается; состояние каждого файла (статус, строки,
+    ошибка) публикуется в XCom (ключ files). Число процессов задаётся
+    через INGEST_WORKERS.
+
+    Исключения:
+        AirflowException: Если файлы не найдены или ни один не загружен
+    """
+    from airflow.providers.standard.operators.python import get_current_context
+    from ETL_Stages.handoff import StagingFileWriter
+    from ETL_Stages.multi_file import FileLedger, ingest_files, source_files, DEFAULT_WORKERS
+
+    try:
+        paths = source_files(pattern)
+    except ValueError as e:
+        raise AirflowException(str(e))
+    ledger = FileLedger(None)
+    quarantine = run_quarantine(pattern)
+    workers = int(Variable.get("INGEST_WORKERS", default_var=DEFAULT_WORKERS))
+    chunks = ingest_files(paths, ledger, workers, chunk_size, rules=rules,
+                          staging_dir=os.path.dirname(staging_path), quarantine=quarantine)
+    with StagingFileWriter(staging_path) as writer:
+        while True:
+            with metrics.stage('read') as stage:
+                prepared = next(chunks, None)
+                if prepared is not None:
+                    stage.add(rows_out=len(prepared), rejected=prepared.rejected)
+            if prepared is None:
+                break
+            with metrics.stage('handoff') as stage:
+                writer.write(prepared)
+                stage.add(rows_in=len(prepared), rows_out=len(prepared))
+        staged = writer.close()
+
+    publish_quality(quarantine)
+    metrics.get('handoff').add(nbytes=staged['bytes'])
+    publish_metrics(metrics)
+    get_current_context()['ti'].xcom_push(key='files', value=ledger.files())
+    for path, error in ledger.failed():
+        logging.warning(f"Файл не загружен: {path}: {error}")
+
+    if not staged['rows']:
+        os.remove(staged['path'])
+        raise AirflowException(f"Не найдено валидных данных в файлах {pattern}")
+    return staged
+
+
 with DAG(
     'etl_retail_data_v3_improved',
     default_args=default_args,
     schedule_interval='@daily',
     catchup=False,
-    template_searchpath=['/opt/airflow/SQL_Requests'],
     tags=['retail', 'etl'],
     max_active_tasks=3,
     doc_md=__doc__,
@@ -31,81 +138,238 @@ with DAG(
     @task(task_id="prepare_excel_data")
     def prepare_data():
         """
-        Подготовка данных из Excel файла.
+        Подготовка данных из исходного файла (Excel, CSV или Parquet).
+
+        Подготовленные порции пишутся в файл Arrow IPC в STAGING_DIR;
+        через XCom передаются только путь, контрольная сумма и счётчики.
         
         Возвращает:
-            list: Список кортежей с очищенными данными
+            dict: path, sha256, rows, rejected и bytes файла для загрузки
         
         Исключения:
             AirflowException: Если файл не может быть прочитан или данные невалидны
         """
         try:
             file_path = Variable.get("EXCEL_FILE_PATH")
-            
-            # Чтение Excel с обработкой ошибок
+            chunk_size = int(Variable.get("SOURCE_CHUNK_SIZE", default_var=50000))
+
+            from airflow.providers.standard.operators.python import get_current_context
+            from ETL_Stages.prepare import prepare_frame
+            from ETL_Stages.readers import iter_chunks
+            from ETL_Stages.handoff import StagingFileWriter
+
+            # Общий для задач каталог; имя файла - по run_id, чтобы запуски не мешали друг другу
+            run_id = re.sub(r'[^A-Za-z0-9_.-]', '_', get_current_context()['run_id'])
+            staging_path = os.path.join(
+                Variable.get("STAGING_DIR", default_var="/opt/airflow/staging"), f"temp_data_{run_id}.arrow")
+
+            metrics = run_metrics()
+            # Проверки качества при подготовке (QUALITY_CHECKS); без них строки
+            # отбрасываются только при ошибке приведения типов и при переносе
+            rules = run_quality_rules() if Variable.get("QUALITY_CHECKS", default_var="false") == "true" else None
+
+            # SOURCE_PATTERN - каталог или шаблон glob: файлы филиалов разбираются
+            # параллельно процессами и пишутся в один файл передачи
+            pattern = Variable.get("SOURCE_PATTERN", default_var="")
+            if pattern:
+                return prepare_files(pattern, chunk_size, staging_path, rules, metrics)
+
+            # Кэш разбора: результат для неизменного файла копируется без чтения Excel
+            cache = None
+            cache_dir = Variable.get("PARSE_CACHE_DIR", default_var="")
+            if cache_dir:
+                from ETL_Stages.parse_cache import ParseCache, DEFAULT_MAX_BYTES
+                cache = ParseCache(cache_dir, int(Variable.get(
+                    "PARSE_CACHE_MAX_BYTES", default_var=DEFAULT_MAX_BYTES)))
+                with metrics.stage('read'):
+                    key = cache.lookup(file_path, rules=rules)
+                if key is not None:
+                    with metrics.stage('handoff'):
+                        staged = cache.export(key, staging_path)
+                    logging.info(f"Результат разбора {file_path} взят из кэша")
+                    publish_metrics(metrics)
+                    return staged
+
+            # Карантин нужен только при разборе: для нескольких файлов его
+            # ведёт prepare_files, строки из кэша уже проверены
+            quarantine = run_quarantine(file_path)
+
+            # Файл читается порциями: в памяти одновременно только одна порция
             try:
-                df = pd.read_excel(file_path)
-            except Exception as e:
-                raise AirflowException(f"Ошибка чтения Excel файла: {str(e)}")
-            
-            # Проверка обязательных колонок
-            required_columns = ['CLIENTCODE', 'GENDER', 'PRICE', 'AMOUNT', 'DATE_']
-            if not all(col in df.columns for col in required_columns):
-                missing = set(required_columns) - set(df.columns)
-                raise AirflowException(f"В файле отсутствуют обязательные колонки: {missing}")
-            
-            # Обработка данных
-            valid_rows = []
-            for _, row in df.iterrows():
-                try:
-                    row = row.where(pd.notnull(row), None)
-                    # Валидация типов данных
-                    row['CLIENTCODE'] = int(row['CLIENTCODE']) if pd.notnull(row['CLIENTCODE']) else None
-                    row['PRICE'] = float(row['PRICE']) if pd.notnull(row['PRICE']) else None
-                    row['AMOUNT'] = float(row['AMOUNT']) if pd.notnull(row['AMOUNT']) else None
-                    valid_rows.append(tuple(row))
-                except (ValueError, TypeError) as e:
-                    logging.warning(f"Пропуск строки с ошибкой: {row}. Ошибка: {str(e)}")
-                    continue
-            
-            if not valid_rows:
-                raise AirflowException("Не найдено валидных данных в Excel файле")
+                chunks = iter_chunks(file_path, chunk_size)
+            except ValueError as e:
+                raise AirflowException(str(e))
+            with StagingFileWriter(staging_path) as writer, \
+                    cache.store(file_path, rules=rules) if cache else nullcontext() as cache_writer:
+                while True:
+                    # Чтение файла с обработкой ошибок
+                    try:
+                        with metrics.stage('read') as stage:
+                            df = next(chunks, None)
+                            if df is not None:
+                                stage.add(rows_out=len(df))
+                    except Exception as e:
+                        raise AirflowException(f"Ошибка чтения файла: {str(e)}")
+                    if df is None:
+                        break
+
+                    # Проверка обязательных колонок, приведение типов и замена пропусков
+                    try:
+                        with metrics.stage('prepare') as stage:
+                            prepared = prepare_frame(df, rules=rules)
+                            stage.add(rows_in=len(df), rows_out=len(prepared), rejected=prepared.rejected)
+                            quarantine.add('prepare', prepared.quarantine)
+                    except ValueError as e:
+                        raise AirflowException(str(e))
+                    with metrics.stage('handoff') as stage:
+                        writer.write(prepared)
+                        if cache_writer is not None:
+                            cache_writer.write(prepared)
+                        stage.add(rows_in=len(prepared), rows_out=len(prepared))
+                staged = writer.close()
+
+            publish_quality(quarantine)
+            metrics.get('handoff').add(nbytes=staged['bytes'])
+            publish_metrics(metrics)
+
+            if not staged['rows']:
+                os.remove(staged['path'])
+                raise AirflowException("Не найдено валидных данных в файле")
                 
-            return valid_rows
+            return staged
             
         except Exception as e:
             raise AirflowException(f"Ошибка подготовки данных: {str(e)}")
 
+    @task(task_id="create_temp_table")
+    def create_staging_table():
+        """
+        Создание временной таблицы в PostgreSQL.
+
+        В режиме STAGING_MODE=optimized таблица UNLOGGED, очищается перед
+        загрузкой, а индексы по ключам соединений строятся после неё; с
+        DEDUP_MODE=fingerprint этот режим не допускается.
+        """
+        from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase
+        from ETL_Stages.staging import begin_staging
+        from ETL_Stages.fingerprints import check_dedup_mode
+
+        staging_mode = Variable.get("STAGING_MODE", default_var="logged")
+        check_dedup_mode(Variable.get("DEDUP_MODE", default_var="off"), staging_mode)
+        with PostgreSQLDatabase() as cur:
+            begin_staging(cur, staging_mode)
+
+    @task(task_id="index_temp_table")
+    def index_staging_table():
+        """Индексы по ключам соединений и ANALYZE temp_data перед нормализацией."""
+        from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase
+        from ETL_Stages.staging import finish_staging
+
+        with PostgreSQLDatabase() as cur:
+            finish_staging(cur, Variable.get("STAGING_MODE", default_var="logged"))
+
     # Создание временной таблицы в PostgreSQL
-    create_temp_table = SQLExecuteQueryOperator(
-        task_id='create_temp_table',
-        sql='postgresql_query/create_query.sql',
-        postgres_conn_id='postgres_default',
-    )
+    create_temp_table = create_staging_table()
+    index_temp_table = index_staging_table()
 
     prepared_data = prepare_data()
 
+    @task(task_id="insert_to_temp_table")
+    def load_staging_file(staged):
+        """
+        Потоковая загрузка файла из prepare_excel_data в temp_data через COPY.
+
+        Файл отображается в память и читается пачками, контрольная сумма
+        проверяется до загрузки. После успешной загрузки файл удаляется,
+        если STAGING_KEEP_FILES не равно "true".
+
+        Исключения:
+            AirflowException: Если файл повреждён или загрузка не удалась
+        """
+        try:
+            from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase
+            from ETL_Stages.handoff import iter_staging_file
+            from ETL_Stages.staging import load_temp_data
+            from ETL_Stages.fingerprints import create_fingerprint_tables, load_unseen, check_dedup_mode
+
+            # fingerprint - только строки, которых не было в прошлых прогонах:
+            # повтор задачи или пересекающиеся файлы не дублируют данные
+            dedup_mode = Variable.get("DEDUP_MODE", default_var="off")
+            check_dedup_mode(dedup_mode, Variable.get("STAGING_MODE", default_var="logged"))
+            metrics = run_metrics()
+            with PostgreSQLDatabase() as cur:
+                if dedup_mode == 'fingerprint':
+                    create_fingerprint_tables(cur)
+                occurrences = {}
+                for prepared in iter_staging_file(staged['path'], staged['sha256']):
+                    with metrics.stage('staging') as stage:
+                        if dedup_mode == 'fingerprint':
+                            # Порции из SOURCE_PATTERN несут свой файл, иначе файл один
+                            source = prepared.source or Variable.get("EXCEL_FILE_PATH")
+                            loaded = len(load_unseen(cur, prepared, source, occurrences))
+                        else:
+                            loaded = load_temp_data(cur, prepared)
+                        stage.add(rows_in=len(prepared), rows_out=loaded)
+            metrics.get('staging').add(nbytes=staged['bytes'])
+            publish_metrics(metrics)
+
+            if Variable.get("STAGING_KEEP_FILES", default_var="false") != "true":
+                os.remove(staged['path'])
+
+        except Exception as e:
+            raise AirflowException(f"Ошибка загрузки во временную таблицу: {str(e)}")
+
     # Вставка данных во временную таблицу
-    insert_to_temp_table = SQLExecuteQueryOperator(
-        task_id='insert_to_temp_table',
-        sql='postgresql_query/insert_query1.sql',
-        postgres_conn_id='postgres_default',
-        parameters=prepared_data,
-    )
+    insert_to_temp_table = load_staging_file(prepared_data)
+
+    @task(task_id="create_normalized_tables")
+    def create_tables():
+        """Создание нормализованных таблиц запросом create_query2 из реестра SQL."""
+        from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase
+        import SQL_Requests.registry as registry
+
+        with PostgreSQLDatabase() as cur:
+            registry.execute(cur, 'create_query2')
 
     # Создание нормализованных таблиц
-    create_normalized_tables = SQLExecuteQueryOperator(
-        task_id='create_normalized_tables',
-        sql='postgresql_query/create_query2.sql',
-        postgres_conn_id='postgres_default',
-    )
+    create_normalized_tables = create_tables()
+
+    @task(task_id="populate_normalized_tables")
+    def populate_tables():
+        """
+        Заполнение нормализованных таблиц по графу зависимостей.
+
+        Независимые справочники заполняются параллельно на отдельных соединениях.
+
+        Возвращает:
+            dict: Время выполнения и количество строк каждого шага
+
+        Исключения:
+            AirflowException: Если один из шагов завершился ошибкой
+        """
+        try:
+            from DBMS_Classes.PostgreSQLDatabase import connection_source
+            from ETL_Stages.scheduler import run_normalization, normalization_steps, connections_needed
+
+            workers = int(Variable.get("NORMALIZATION_WORKERS", default_var=4))
+            # statement - фиксация каждого шага, level - общая фиксация уровня,
+            # transaction - все шаги последовательно с одной фиксацией
+            commit_mode = Variable.get("NORMALIZATION_COMMIT", default_var="statement")
+            steps = normalization_steps(Variable.get("DEDUP_MODE", default_var="off"))
+            metrics = run_metrics()
+            connect, release = connection_source(connections_needed(workers, commit_mode, steps))
+            with metrics.stage('normalization') as stage:
+                timings = run_normalization(connect, workers, commit_mode, steps, release)
+                for name, timing in timings.items():
+                    stage.record_statement(name, timing['seconds'], timing['rows'])
+            publish_metrics(metrics)
+            return timings
+
+        except Exception as e:
+            raise AirflowException(f"Ошибка заполнения нормализованных таблиц: {str(e)}")
 
     # Заполнение нормализованных таблиц
-    populate_normalized_tables = SQLExecuteQueryOperator(
-        task_id='populate_normalized_tables',
-        sql='postgresql_query/insert_into_tmp_table.sql',
-        postgres_conn_id='postgres_default',
-    )
+    populate_normalized_tables = populate_tables()
 
     @task(task_id="transfer_to_clickhouse")
     def transfer_to_clickhouse():
@@ -116,62 +380,126 @@ with DAG(
             AirflowException: Если перенос данных не удался
         """
         try:
-            from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase
+            from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase, table_function_settings
             from DBMS_Classes.ClickHouseClient import ClickHouseClient
-            
+            from ETL_Stages.transfer import transfer_purchases
+            from ETL_Stages.incremental import WatermarkStore, load_incremental
+            from ETL_Stages.partitioned import PartitionLedger, transfer_partitioned
+            from ETL_Stages.clickhouse_schema import create_tables, drop_tables, fill_aggregates
+            from ETL_Stages.fingerprints import load_unseen_purchases
+            from ETL_Stages.direct_transfer import check_transfer_strategy, direct_relation, transfer_direct
+            from ETL_Stages.checkpoint import TransferCheckpoint, load_checkpointed, source_signature
+            from ETL_Stages.quality import TYPE_RULES
+            from airflow.providers.standard.operators.python import get_current_context
+
+            metrics = run_metrics()
+            # Без QUALITY_CHECKS строки только приводятся к типам purchases
+            rules = run_quality_rules() if Variable.get("QUALITY_CHECKS", default_var="false") == "true" else TYPE_RULES
+            quarantine = run_quarantine('temp_data')
             postgre_db = PostgreSQLDatabase()
             ch_client = ClickHouseClient()
-            
-            # Получение данных из PostgreSQL
-            with postgre_db as cur:
-                data = cur.execute(
-                    """SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_ FROM temp_data""").fetchall()
-            
-            # Работа с ClickHouse
-            with ch_client as client_cur:
-                # Удаление старых таблиц (если нужно)
-                client_cur.command("DROP TABLE IF EXISTS purchases, date_purchases, date_purchases_by_gender")
-                
-                # Создание таблиц
-                with open('/opt/airflow/SQL_Requests/clickhouse_query/create_purchases.sql') as f:
-                    client_cur.command(f.read())
-                with open('/opt/airflow/SQL_Requests/clickhouse_query/create_date_purchases.sql') as f:
-                    client_cur.command(f.read())
-                with open('/opt/airflow/SQL_Requests/clickhouse_query/create_date_purchases_by_gender.sql') as f:
-                    client_cur.command(f.read())
-
-                # Вставка данных пачками
-                if data:
-                    columns = ['clientcode', 'gender', 'price', 'amount', 'timestamp']
-                    rows = []
-                    
-                    for row in data:
-                        try:
-                            clientcode = int(row[0])
-                            gender = str(row[1])
-                            price = float(row[2])
-                            amount = float(row[3])
-                            timestamp = row[4] if isinstance(row[4], datetime) else datetime.now()
-                            rows.append([clientcode, gender, price, amount, timestamp])
-                        except (ValueError, TypeError, IndexError) as e:
-                            logging.warning(f"Пропуск некорректной строки: {row}. Ошибка: {str(e)}")
-                            continue
-                    
-                    if rows:
-                        batch_size = int(Variable.get("CLICKHOUSE_BATCH_SIZE", default_var=1000))
-                        for i in range(0, len(rows), batch_size):
-                            client_cur.insert("purchases", rows[i:i+batch_size], column_names=columns)
+
+            with postgre_db as cur, ch_client as client_cur:
+                # full - пересоздание таблиц, incremental - догрузка после водяного знака,
+                # fingerprint - догрузка ещё не перенесённых строк (DEDUP_MODE=fingerprint)
+                load_mode = Variable.get("CLICKHOUSE_LOAD_MODE", default_var="full")
+                # scan - пересчёт агрегатов после загрузки, mv - при вставке
+                rollup_mode = Variable.get("CLICKHOUSE_ROLLUP_MODE", default_var="scan")
+                # basic - исходная схема purchases, optimized - партиции, кодеки, ключ по времени
+                purchases_schema = Variable.get("CLICKHOUSE_PURCHASES_SCHEMA", default_var="basic")
+                projection = Variable.get("CLICKHOUSE_PURCHASES_PROJECTION", default_var="false") == "true"
+                # Больше одного процесса - перенос по диапазонам параллельно
+                # python - строки проходят через воркер Airflow, clickhouse - ClickHouse
+                # читает temp_data (или нормализованные таблицы) сам через postgresql(),
+                # checkpoint - пачки с контрольной точкой, повторами и дедупликацией вставок
+                strategy = Variable.get("CLICKHOUSE_TRANSFER_STRATEGY", default_var="python")
+                check_transfer_strategy(strategy, load_mode, table_function_settings())
+                workers = int(Variable.get("CLICKHOUSE_TRANSFER_WORKERS", default_var=1))
+                ledger = PartitionLedger(Variable.get(
+                    "CLICKHOUSE_PARTITION_LEDGER", default_var="/opt/airflow/state/transfer_partitions.json"))
+                # checkpoint - пачки с контрольной точкой: повтор задачи того же запуска
+                # DAG переносит только незафиксированные пачки
+                checkpoint = TransferCheckpoint(Variable.get(
+                    "CLICKHOUSE_CHECKPOINT_PATH", default_var="/opt/airflow/state/transfer_checkpoint.json"))
+                run_key = get_current_context()['run_id']
+                resume = strategy == 'checkpoint' and checkpoint.resumable(
+                    source_signature(cur.connection, run_key), 'purchases')
+                # Повтор задачи после падения продолжает незавершённые диапазоны и пачки
+                with metrics.stage('schema'):
+                    if load_mode == 'full' and not (workers > 1 and ledger.unfinished()) and not resume:
+                        drop_tables(client_cur)
+
+                    # Создание таблиц (IF NOT EXISTS: при инкрементальной загрузке они сохраняются)
+                    create_tables(client_cur, rollup_mode, purchases_schema, projection)
+
+                batch_size = int(Variable.get("CLICKHOUSE_BATCH_SIZE", default_var=1000))
+                if load_mode == 'fingerprint':
+                    with metrics.stage('transfer') as stage:
+                        stats = load_unseen_purchases(cur.connection, client_cur, batch_size,
+                                                      rollup_mode=rollup_mode, rules=rules,
+                                                      quarantine=quarantine)
+                        stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+                    publish_quality(quarantine)
+                    publish_metrics(metrics)
+                    return
+
+                if load_mode == 'incremental':
+                    # Водяной знак на общем хранилище: повторный запуск продолжит с места падения
+                    store = WatermarkStore(Variable.get(
+                        "WATERMARK_PATH", default_var="/opt/airflow/state/watermarks.json"))
+                    key = Variable.get("WATERMARK_KEY", default_var="ID")
+                    with metrics.stage('transfer') as stage:
+                        stats = load_incremental(cur.connection, client_cur, store, key, batch_size,
+                                                 rollup_mode=rollup_mode, rules=rules, quarantine=quarantine)
+                        stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+                    publish_quality(quarantine)
+                    publish_metrics(metrics)
+                    return
+
+                if strategy == 'clickhouse':
+                    with metrics.stage('transfer') as stage:
+                        relation = direct_relation(
+                            cur.connection, Variable.get("CLICKHOUSE_DIRECT_SOURCE", default_var="temp_data"))
+                        stats = transfer_direct(cur.connection, client_cur, table_function_settings(), relation,
+                                                rules=rules)
+                        stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+                    if stats['rejected']:
+                        logging.warning(f"Пропущено некорректных строк: {stats['rejected']}")
+                elif strategy == 'checkpoint':
+                    with metrics.stage('transfer') as stage:
+                        stats = load_checkpointed(
+                            cur.connection, client_cur, checkpoint, batch_size, rules=rules, quarantine=quarantine,
+                            retries=int(Variable.get("CLICKHOUSE_BATCH_RETRIES", default_var=5)), run_key=run_key)
+                        stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+                    logging.info(f"Перенесено пачек: {stats['batches']}, повторов: {stats['retries']}, "
+                                 f"продолжение прерванного переноса: {stats['resumed']}")
+                    publish_quality(quarantine)
+                elif workers > 1:
+                    key = Variable.get("CLICKHOUSE_PARTITION_KEY", default_var="DATE_")
+                    with metrics.stage('transfer') as stage:
+                        # Процессы диапазонов пишут отклонённые строки в quarantine сами
+                        summary = transfer_partitioned(cur.connection, ledger, key, workers,
+                                                       batch_size=batch_size, rules=rules, quarantine=quarantine)
+                        stage.add(rows_out=summary['inserted'], rejected=summary['rejected'])
+                    logging.info(f"Перенесено диапазонов: {summary['done']}, строк: {summary['inserted']}")
+                    publish_quality(quarantine)
+                else:
+                    # Потоковый перенос пачками: чтение из PostgreSQL и вставка идут параллельно
+                    with metrics.stage('transfer') as stage:
+                        stats = transfer_purchases(cur.connection, client_cur, batch_size,
+                                                   rules=rules, quarantine=quarantine)
+                        stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+                    publish_quality(quarantine)
 
                 # Заполнение агрегирующих таблиц
-                with open('/opt/airflow/SQL_Requests/clickhouse_query/insert_data_to_date_purchases.sql') as f:
-                    client_cur.command(f.read())
-                with open('/opt/airflow/SQL_Requests/clickhouse_query/insert_data_to_date_purchases_by_gender.sql') as f:
-                    client_cur.command(f.read())
-                    
+                with metrics.stage('aggregation'):
+                    fill_aggregates(client_cur, rollup_mode)
+            publish_metrics(metrics)
+
         except Exception as e:
             raise AirflowException(f"Ошибка переноса в ClickHouse: {str(e)}")
 
     # Определение зависимостей
     create_temp_table >> prepared_data >> insert_to_temp_table
-    insert_to_temp_table >> create_normalized_tables >> populate_normalized_tables
+    insert_to_temp_table >> index_temp_table >> create_normalized_tables >> populate_normalized_tables
     populate_normalized_tables >> transfer_to_clickhouse()
\ No newline at end of file
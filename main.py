@@ -1,14 +1,40 @@
-import pandas as pd
+import asyncio
+import os
+from contextlib import nullcontext
 import config as config
-from datetime import datetime
 import SQL_Requests.postgresql_query as query
-import SQL_Requests.clickhouse_query as ch_query
-from DBMS_Classes.PostgreSQLDatabase import PostgreSQLDatabase
+from DBMS_Classes.PostgreSQLDatabase import (PostgreSQLDatabase, connection_source, connection_string,
+                                             table_function_settings)
 from DBMS_Classes.ClickHouseClient import ClickHouseClient
+from DBMS_Classes.ClickHouseClientPool import client_settings
+from ETL_Stages.prepare import prepare_frame
+from ETL_Stages.readers import iter_chunks, DEFAULT_CHUNK_SIZE
+from ETL_Stages.staging import load_temp_data, begin_staging, finish_staging
+from ETL_Stages.normalizer import Normalizer, DEFAULT_CACHE_SIZE
+from ETL_Stages.scheduler import run_normalization, levels, normalization_steps, connections_needed
+from ETL_Stages.transfer import transfer_purchases, DEFAULT_BATCH_SIZE
+from ETL_Stages.partitioned import (PartitionLedger, transfer_partitioned,
+                                    DEFAULT_LEDGER_PATH as PARTITION_LEDGER_PATH)
+from ETL_Stages.incremental import WatermarkStore, load_incremental, DEFAULT_WATERMARK_PATH
+from ETL_Stages.clickhouse_schema import create_tables, drop_tables, fill_aggregates
+from ETL_Stages.async_pipeline import run_pipeline
+from ETL_Stages.metrics import RunMetrics
+from ETL_Stages.parse_cache import ParseCache, DEFAULT_MAX_BYTES
+from ETL_Stages.quality import Quarantine, quality_rules, GENDER_VALUES, TYPE_RULES
+from ETL_Stages.fingerprints import create_fingerprint_tables, load_unseen, load_unseen_purchases, check_dedup_mode
+from ETL_Stages.direct_transfer import check_transfer_strategy, direct_relation, transfer_direct
+from ETL_Stages.checkpoint import (TransferCheckpoint, load_checkpointed, source_signature,
+                                   DEFAULT_CHECKPOINT_PATH, DEFAULT_RETRIES)
+from ETL_Stages.query_service import invalidate_all
+from ETL_Stages.multi_file import (FileLedger, ingest_files, source_files, DEFAULT_WORKERS as INGEST_WORKERS,
+                                   DEFAULT_LEDGER_PATH as INGEST_LEDGER_PATH)
 
 def create_data(cur):
     def create_temp_table(cur):
-        cur.execute(query.create_query)
+        # 'logged' - обычная temp_data, 'optimized' - UNLOGGED, очистка и отложенные индексы
+        staging_mode = getattr(config, 'staging_mode', 'logged')
+        check_dedup_mode(getattr(config, 'dedup_mode', 'off'), staging_mode)
+        begin_staging(cur, staging_mode)
 
     def create_all_tables(cur):
         cur.execute(query.create_query2)
@@ -17,106 +43,339 @@ def create_data(cur):
     create_all_tables(cur)
 
 
-def insert_data(cur, lst_of_tuples):
-    def insert_into_temp_table(cur, lst_of_tuples):
-        cur.executemany(query.insert_query1, lst_of_tuples)
+def insert_data(cur, chunks, metrics=None):
+    metrics = metrics or RunMetrics()
+    # 'off' - строки загружаются как есть, 'fingerprint' - только строки,
+    # которых не было в прошлых прогонах (повтор после падения не дублирует данные)
+    dedup_mode = getattr(config, 'dedup_mode', 'off')
+    steps = normalization_steps(dedup_mode)
+    # Номера одинаковых строк без ID по файлам, см. load_unseen
+    occurrences = {}
+    if dedup_mode == 'fingerprint':
+        create_fingerprint_tables(cur)
+
+    def insert_into_temp_table(cur, prepared):
+        # 'copy' - бинарный COPY, 'executemany' - прежние построчные INSERT
+        mode = getattr(config, 'temp_data_load_mode', 'copy')
+        with metrics.stage('staging') as stage:
+            if dedup_mode == 'fingerprint':
+                loaded = load_unseen(cur, prepared, prepared.source or config.file_path, occurrences)
+            else:
+                load_temp_data(cur, prepared, mode)
+                loaded = prepared
+            stage.add(rows_in=len(prepared), rows_out=len(loaded))
+        return loaded
 
     def insert_into_all_tables(cur):
-        cur.execute(query.insert_into_tmp_table)
+        # Больше одного потока - независимые справочники заполняются параллельно
+        workers = getattr(config, 'normalization_workers', 1)
+        # statement - фиксация каждого шага, level - фиксация уровня,
+        # transaction - все шаги одной транзакцией (см. ETL_Stages.scheduler.COMMIT_MODES)
+        commit_mode = getattr(config, 'normalization_commit', 'statement')
+        with metrics.stage('normalization') as stage:
+            if workers <= 1 or commit_mode == 'transaction':
+                # Те же запросы, что в insert_into_tmp_table, по одному, чтобы замерить
+                # каждый; фиксируются вместе с загрузкой temp_data
+                for level in levels(steps):
+                    for name in level:
+                        stage.execute(cur, name, steps[name][0])
+                return
+            # Другие соединения должны видеть загруженную temp_data
+            cur.connection.commit()
+            # Соединения шагов и карантина берутся сверх соединения cur
+            connect, release = connection_source(connections_needed(workers, commit_mode, steps) + 1)
+            timings = run_normalization(connect, workers, commit_mode, steps, release)
+            for name, timing in timings.items():
+                stage.record_statement(name, timing['seconds'], timing['rows'])
+
+    # 'sql' - insert_into_tmp_table после загрузки,
+    # 'cache' - нормализация каждой порции по кэшам ключей во время загрузки
+    normalizer = None
+    if getattr(config, 'normalization_mode', 'sql') == 'cache':
+        normalizer = Normalizer(getattr(config, 'dimension_cache_size', DEFAULT_CACHE_SIZE))
+        normalizer.load(cur)
+
+    # Порции загружаются по мере чтения файла, весь набор в памяти не собирается
+    for prepared in chunks:
+        prepared = insert_into_temp_table(cur, prepared)
+        if normalizer is not None:
+            with metrics.stage('normalization') as stage:
+                stage.add(rows_in=len(prepared), rows_out=normalizer.process(cur, prepared))
+    with metrics.stage('staging') as stage, stage.statement('finish_staging'):
+        finish_staging(cur, getattr(config, 'staging_mode', 'logged'))
+    if normalizer is None:
+        insert_into_all_tables(cur)
+
+
+def transfer_rules():
+    # Проверки качества включаются явно (quality_checks): без них при переносе
+    # отбрасываются только строки, которые не приводятся к типам purchases
+    if not getattr(config, 'quality_checks', False):
+        return TYPE_RULES
+    return quality_rules(getattr(config, 'gender_values', GENDER_VALUES))
+
+
+def prepare_rules():
+    return transfer_rules() if getattr(config, 'quality_checks', False) else None
+
 
-    insert_into_temp_table(cur, lst_of_tuples)
-    insert_into_all_tables(cur)
+def new_quarantine(source):
+    # Отклонённые строки пишутся в таблицу quarantine отдельным соединением
+    connect, release = connection_source()
+    return Quarantine(connect, release, source=source)
+
+
+def report_quarantine(quarantine):
+    quarantine.flush()
+    for line in quarantine.lines():
+        print(line)
 
 
 def prepare_data(df):
-    my_list = []
-    for _, row in df.iterrows():
-        row = row.where(pd.notnull(row), None)
-        my_list.append(tuple(row))
-    return my_list
+    return prepare_frame(df, required_columns=(), casts={}, rules=prepare_rules())
+
+
+def parse_cache():
+    # Кэш разбора: неизменный файл не разбирается повторно
+    cache_dir = getattr(config, 'parse_cache_dir', None)
+    if not cache_dir:
+        return None
+    return ParseCache(cache_dir, getattr(config, 'parse_cache_max_bytes', DEFAULT_MAX_BYTES))
+
+
+def read_data(metrics, quarantine=None):
+    # Чтение и подготовка замеряются отдельно, хотя порции идут потоком
+    chunk_size = getattr(config, 'chunk_size', DEFAULT_CHUNK_SIZE)
+
+    cache = parse_cache()
+    if cache is not None:
+        with metrics.stage('read'):
+            key = cache.lookup(config.file_path, (), {}, prepare_rules())
+        if key is not None:
+            cached = cache.load(key)
+            while True:
+                with metrics.stage('read') as stage:
+                    prepared = next(cached, None)
+                    if prepared is not None:
+                        stage.add(rows_out=len(prepared), rejected=prepared.rejected)
+                if prepared is None:
+                    return
+                yield prepared
 
+    with metrics.stage('read') as stage:
+        stage.add(nbytes=os.path.getsize(config.file_path))
+        chunks = iter_chunks(config.file_path, chunk_size)
+    with cache.store(config.file_path, (), {}, prepare_rules()) if cache else nullcontext() as writer:
+        while True:
+            with metrics.stage('read') as stage:
+                df = next(chunks, None)
+                if df is not None:
+                    stage.add(rows_out=len(df))
+            if df is None:
+                return
+            with metrics.stage('prepare') as stage:
+                prepared = prepare_data(df)
+                stage.add(rows_in=len(df), rows_out=len(prepared), rejected=prepared.rejected)
+            if quarantine is not None:
+                quarantine.add('prepare', prepared.quarantine)
+            if writer is not None:
+                writer.write(prepared)
+            yield prepared
 
-def init_postgreSQLDatabase(cur):
+
+def read_files(metrics, pattern, quarantine=None):
+    # Файлы каталога (или шаблона glob) разбираются параллельно процессами,
+    # файл с ошибкой пропускается, состояние файлов - в ingest_ledger_path
+    ledger = FileLedger(getattr(config, 'ingest_ledger_path', INGEST_LEDGER_PATH))
+    with metrics.stage('read'):
+        paths = source_files(pattern)
+    chunks = ingest_files(paths, ledger, getattr(config, 'ingest_workers', INGEST_WORKERS),
+                          getattr(config, 'chunk_size', DEFAULT_CHUNK_SIZE), (), {}, prepare_rules(),
+                          getattr(config, 'ingest_staging_dir', None), quarantine)
+    while True:
+        # Время ожидания разбора: сами файлы разбираются в других процессах
+        with metrics.stage('read') as stage:
+            prepared = next(chunks, None)
+            if prepared is not None:
+                stage.add(rows_out=len(prepared), rejected=prepared.rejected)
+        if prepared is None:
+            break
+        yield prepared
+
+    summary = ledger.summary()
+    print(f"Загружено файлов: {summary['loaded']} из {summary['files']}, строк: {summary['rows']}")
+    for path, error in ledger.failed():
+        print(f"Файл не загружен: {path}: {error}")
+
+
+def init_postgreSQLDatabase(cur, metrics=None):
+    metrics = metrics or RunMetrics()
+    # source_pattern - каталог или шаблон glob с несколькими файлами вместо file_path
+    pattern = getattr(config, 'source_pattern', None)
+    quarantine = new_quarantine(pattern or config.file_path)
     try:
-        create_data(cur)
+        with metrics.stage('staging') as stage, stage.statement('create_tables'):
+            create_data(cur)
 
-        cur.execute("SELECT id FROM temp_data LIMIT 1")
-        assert not bool(cur.fetchall())
+        # С отпечатками строк повторный прогон по заполненной temp_data безопасен
+        if getattr(config, 'dedup_mode', 'off') != 'fingerprint':
+            cur.execute("SELECT id FROM temp_data LIMIT 1")
+            assert not bool(cur.fetchall())
 
-        df = pd.read_excel(config.file_path)
-        data = prepare_data(df)
-        insert_data(cur, data)
+        chunks = read_files(metrics, pattern, quarantine) if pattern else read_data(metrics, quarantine)
+        insert_data(cur, chunks, metrics)
+        report_quarantine(quarantine)
         print("Данные успешно загружены")
     except Exception as e:
         print(f"Ошибка при выполнении команд: {e}")
 
 
-def connect_to_clickhouse(client_cur, data):
+def connect_to_clickhouse(client_cur, conn, metrics=None):
+    metrics = metrics or RunMetrics()
+    rules = transfer_rules()
+    quarantine = new_quarantine('temp_data')
     try:
-        client_cur.command("DROP TABLE IF EXISTS purchases")
-        client_cur.command("DROP TABLE IF EXISTS date_purchases")
-        client_cur.command("DROP TABLE IF EXISTS date_purchases_by_gender")
-
-        client_cur.command(ch_query.create_purchases)
-        client_cur.command(ch_query.create_date_purchases)
-        client_cur.command(ch_query.create_date_purchases_by_gender)
-
-        if data:
-            columns = ['clientcode', 'gender', 'price', 'amount', 'timestamp']
-            rows = []
-
-            for row in data:
-                count = 0
-                try:
-                    clientcode = int(row[0])
-                    gender = str(row[1])
-                    price = float(row[2])
-                    amount = float(row[3])
-                    timestamp = row[4] if isinstance(
-                        row[4], datetime) else datetime.now()
-
-                    rows.append([clientcode, gender, price, amount, timestamp])
-                except (ValueError, TypeError, IndexError) as e:
-                    print(
-                        f"Пропуск некорректной строки: {row}. Ошибка: {str(e)}")
-                    continue
-            if rows:
-                client_cur.insert("purchases", rows, column_names=columns)
-
-        client_cur.command("""
-        INSERT INTO date_purchases (day, date_amount, date_price, average_price)
-        SELECT 
-            toStartOfDay(timestamp) AS day, 
-            SUM(amount) as date_amount, 
-            SUM(price) AS date_price, 
-            date_price / date_amount 
-        FROM purchases 
-        GROUP BY day
-        """)
-
-        client_cur.command("""
-        INSERT INTO date_purchases_by_gender (day, gender, date_amount, date_price, average_price)
-        SELECT 
-            toStartOfDay(timestamp) AS day, 
-            gender, 
-            SUM(amount) as date_amount, 
-            SUM(price) AS date_price, 
-            date_price / date_amount 
-        FROM purchases 
-        GROUP BY day, gender
-        """)
+        # 'full' - пересоздание таблиц и полная перезаливка,
+        # 'incremental' - только строки после водяного знака,
+        # 'fingerprint' - только строки, ещё не перенесённые (dedup_mode='fingerprint')
+        mode = getattr(config, 'clickhouse_load_mode', 'full')
+        batch_size = getattr(config, 'transfer_batch_size', DEFAULT_BATCH_SIZE)
+
+        # 'scan' - пересчёт агрегатов после загрузки, 'mv' - при вставке
+        rollup_mode = getattr(config, 'clickhouse_rollup_mode', 'scan')
+        # 'basic' - исходная схема purchases, 'optimized' - партиции, кодеки, ключ по времени
+        purchases_schema = getattr(config, 'clickhouse_purchases_schema', 'basic')
+        projection = getattr(config, 'clickhouse_purchases_projection', False)
+
+        # 'python' - строки проходят через этот процесс, 'clickhouse' - ClickHouse
+        # читает temp_data (или нормализованные таблицы) сам через postgresql(),
+        # 'checkpoint' - пачки с контрольной точкой, повторами и дедупликацией вставок
+        strategy = getattr(config, 'transfer_strategy', 'python')
+        check_transfer_strategy(strategy, mode, table_function_settings())
+
+        # Больше одного процесса - перенос по диапазонам DATE_ или ID параллельно
+        workers = getattr(config, 'transfer_workers', 1)
+        ledger = PartitionLedger(getattr(config, 'transfer_ledger_path', PARTITION_LEDGER_PATH))
+        checkpoint = TransferCheckpoint(getattr(config, 'transfer_checkpoint_path', DEFAULT_CHECKPOINT_PATH))
+        resume = strategy == 'checkpoint' and checkpoint.resumable(source_signature(conn), 'purchases')
+
+        # Незавершённый параллельный перенос или перенос с контрольной точкой
+        # продолжается, таблицы не пересоздаются
+        with metrics.stage('schema'):
+            if mode == 'full' and not (workers > 1 and ledger.unfinished()) and not resume:
+                drop_tables(client_cur)
+            create_tables(client_cur, rollup_mode, purchases_schema, projection)
+
+        if mode == 'fingerprint':
+            with metrics.stage('transfer') as stage:
+                stats = load_unseen_purchases(conn, client_cur, batch_size, rollup_mode=rollup_mode,
+                                              rules=rules, quarantine=quarantine)
+                stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+            print(f"Перенесено новых строк: {stats['inserted']}, пересчитано дней: {len(stats['days'])}")
+            report_quarantine(quarantine)
+            return
+
+        if mode == 'incremental':
+            store = WatermarkStore(getattr(config, 'watermark_path', DEFAULT_WATERMARK_PATH))
+            key = getattr(config, 'watermark_key', 'ID')
+            with metrics.stage('transfer') as stage:
+                stats = load_incremental(conn, client_cur, store, key, batch_size,
+                                         rollup_mode=rollup_mode, rules=rules, quarantine=quarantine)
+                stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+            print(f"Загружено новых строк: {stats['inserted']}, пересчитано дней: {len(stats['days'])}")
+            report_quarantine(quarantine)
+            return
+
+        if strategy == 'clickhouse':
+            with metrics.stage('transfer') as stage:
+                relation = direct_relation(conn, getattr(config, 'direct_transfer_source', 'temp_data'))
+                stats = transfer_direct(conn, client_cur, table_function_settings(), relation, rules=rules)
+                stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+            if stats['rejected']:
+                print(f"Пропущено некорректных строк: {stats['rejected']}")
+        elif strategy == 'checkpoint':
+            with metrics.stage('transfer') as stage:
+                stats = load_checkpointed(conn, client_cur, checkpoint, batch_size, rules=rules,
+                                          quarantine=quarantine,
+                                          retries=getattr(config, 'transfer_batch_retries', DEFAULT_RETRIES))
+                stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+            print(f"Перенесено пачек: {stats['batches']}, строк: {stats['inserted']}, повторов: {stats['retries']}")
+            report_quarantine(quarantine)
+        elif workers > 1:
+            key = getattr(config, 'transfer_partition_key', 'DATE_')
+            with metrics.stage('transfer') as stage:
+                # Процессы диапазонов пишут отклонённые строки в quarantine сами
+                summary = transfer_partitioned(conn, ledger, key, workers, batch_size=batch_size,
+                                               retries=getattr(config, 'transfer_retries', 1),
+                                               rules=rules, quarantine=quarantine)
+                stage.add(rows_out=summary['inserted'], rejected=summary['rejected'])
+            print(f"Перенесено диапазонов: {summary['done']}, строк: {summary['inserted']}")
+            report_quarantine(quarantine)
+        else:
+            # Потоковый перенос temp_data -> purchases без промежуточных списков
+            with metrics.stage('transfer') as stage:
+                stats = transfer_purchases(conn, client_cur, batch_size, rules=rules, quarantine=quarantine)
+                stage.add(stats['read'], stats['inserted'], stats['rejected'], stats['bytes'])
+            report_quarantine(quarantine)
+
+        with metrics.stage('aggregation'):
+            fill_aggregates(client_cur, rollup_mode)
 
     except Exception as e:
         print(f"Ошибка при работе с ClickHouse: {str(e)}")
         raise
+    finally:
+        # Закэшированные итоги запросов устарели, даже если загрузка прервалась
+        invalidate_all()
+
+
+def run_async_pipeline(client_cur):
+    """Полная перезагрузка одним циклом asyncio: несколько файлов, PostgreSQL и ClickHouse одновременно."""
+    rollup_mode = getattr(config, 'clickhouse_rollup_mode', 'scan')
+    quarantine = new_quarantine('temp_data')
+    # Схема ClickHouse создаётся синхронно: это несколько DDL до начала загрузки
+    drop_tables(client_cur)
+    create_tables(client_cur, rollup_mode,
+                  getattr(config, 'clickhouse_purchases_schema', 'basic'),
+                  getattr(config, 'clickhouse_purchases_projection', False))
+
+    stats = asyncio.run(run_pipeline(
+        getattr(config, 'file_paths', [config.file_path]),
+        connection_string(),
+        client_settings(),
+        chunk_size=getattr(config, 'chunk_size', DEFAULT_CHUNK_SIZE),
+        batch_size=getattr(config, 'transfer_batch_size', DEFAULT_BATCH_SIZE),
+        staging_mode=getattr(config, 'staging_mode', 'logged'),
+        rollup_mode=rollup_mode,
+        rules=transfer_rules(),
+        quarantine=quarantine,
+        prepare_rules=prepare_rules(),
+        parse_cache=parse_cache(),
+    ))
+    invalidate_all()
+    print(f"Загружено в temp_data: {stats['staged']}, в purchases: {stats['inserted']}")
+    report_quarantine(quarantine)
 
 
 if __name__ == "__main__":
-    postgre_db = PostgreSQLDatabase()
-    ch_client = ClickHouseClient()
-    with postgre_db as cur:
-        # init_postgreSQLDatabase(cur)
-        data = cur.execute(
-            """SELECT CLIENTCODE, GENDER, PRICE, AMOUNT, DATE_ FROM temp_data""").fetchall()
-    with ch_client as client_cur:
-        connect_to_clickhouse(client_cur, data)
+    # 'sync' - последовательные этапы, 'async' - конвейер asyncio (run_async_pipeline)
+    if getattr(config, 'pipeline_engine', 'sync') == 'async':
+        with ClickHouseClient() as client_cur:
+            run_async_pipeline(client_cur)
+    else:
+        # Этапы под cProfile и tracemalloc включаются явно: они замедляют прогон
+        metrics = RunMetrics(getattr(config, 'profile_stages', ()),
+                             getattr(config, 'trace_memory_stages', ()),
+                             getattr(config, 'profile_dir', None))
+        postgre_db = PostgreSQLDatabase()
+        ch_client = ClickHouseClient()
+        try:
+            with postgre_db as cur, ch_client as client_cur:
+                # init_postgreSQLDatabase(cur, metrics)
+                connect_to_clickhouse(client_cur, cur.connection, metrics)
+        finally:
+            for line in metrics.lines():
+                print(line)
+            report_path = getattr(config, 'metrics_report_path', None)
+            if report_path:
+                metrics.save(report_path)